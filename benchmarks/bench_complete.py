@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+
+# Measures the latency of the substring tab-completion (tabcomplete.completions)
+# and compares it with the previous implementation, which checked every candidate
+# keyword against every chosen host.
+#
+# Usage: benchmarks/bench_complete.py [--customers N] [--lines N] [--keywords N] [--repeat N]
+
+import argparse, json, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fleet import generate_hosts_dir
+from lssh import hostindex, hostlist, tabcomplete
+
+# Completion requests as (COMP_LINE, current argument, previous argument)
+requests = [
+    ('lssh srv1', 'srv1', 'lssh'),
+    ('lssh c', 'c', 'lssh'),
+    ('lssh customer010 ', '', 'customer010'),
+    ('lssh kw1 ', '', 'kw1'),
+    ('lssh srv1 customer01 ', '', 'customer01'),
+    ('lssh bigcustomer ', '', 'bigcustomer'),
+    ('lssh bigcustomer b', 'b', 'bigcustomer'),
+]
+
+def write_big_customer(hosts_dir, hosts=5000, file_keywords=20):
+    # One customer with many hosts that share many file keywords.
+    # None of these keywords restricts the hosts of this customer, this is the
+    # worst case for checking every keyword against every host.
+    lines = ['#lssh:filekeywords ' + ', '.join('bigkw' + str(i) for i in range(file_keywords)), '']
+    for i in range(hosts):
+        lines += ['Host node' + str(i) + '.bigcustomer.example.net', '    User root', '']
+    with open(os.path.join(hosts_dir, 'bigcustomer.txt'), 'w') as f:
+        f.write('\n'.join(lines))
+
+def legacy_completions(current_arg, comp_line):
+    # Substring completion before the bitset implementation, kept for comparison
+    def restricts(new_keyword, host_choices, host_keyword_map):
+        for host in host_choices:
+            if not tabcomplete.contains_substring([host] + host_keyword_map[host], new_keyword):
+                return True
+        return False
+    with open(tabcomplete.host_cache_path(), 'r') as f:
+        hosts = json.load(f)
+    substrings = tabcomplete.find_substrings(comp_line)
+    host_choices = {h for h in hosts if tabcomplete.contains_all_substrings([h] + hosts[h], substrings)}
+    if len(host_choices) == 1 and list(host_choices)[0] in substrings:
+        choices = []
+    else:
+        keyword_options = {keyword for h in host_choices for keyword in hosts[h]}
+        keyword_choices = {keyword for keyword in keyword_options if restricts(keyword, host_choices, hosts)}
+        choices = host_choices | keyword_choices
+    return [x for x in choices if x.startswith(current_arg)]
+
+def measure(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_complete')
+    parser.add_argument('--customers', type=int, default=300)
+    parser.add_argument('--lines', type=int, default=120000)
+    parser.add_argument('--keywords', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['XDG_CACHE_HOME'] = os.path.join(tmp, 'cache')
+        hosts_dir = os.path.join(tmp, 'hosts')
+        generate_hosts_dir(hosts_dir, customers=args.customers, lines=args.lines, keywords=args.keywords)
+        write_big_customer(hosts_dir)
+        entries, _ = hostlist.load_config(hosts_dir, suppress_errors=True)
+        keyword_count = len({k for e in entries.values() for k in e.keywords})
+        print("Fixture: " + str(len(entries)) + " hosts, " + str(keyword_count) + " distinct keywords")
+        print("%-26s %8s %10s %10s %10s" % ('COMP_LINE', 'choices', 'legacy', 'cold', 'warm'))
+        for comp_line, current_arg, previous_arg in requests:
+            legacy_time, legacy_result = min(measure(lambda: legacy_completions(current_arg, comp_line)) for i in range(args.repeat))
+            # cold: like a single lssh __complete__ call, the index is mapped again each time
+            cold_time, cold_result = min(measure(lambda: tabcomplete.completions(hosts_dir, current_arg, previous_arg, comp_line)) for i in range(args.repeat))
+            # warm: like the completion server, the index stays in memory
+            index = hostindex.open_index(hostindex.index_path(), None)
+            tabcomplete.completions(hosts_dir, current_arg, previous_arg, comp_line, index)
+            warm_time, warm_result = min(measure(lambda: tabcomplete.completions(hosts_dir, current_arg, previous_arg, comp_line, index)) for i in range(args.repeat))
+            if not (set(legacy_result) == set(cold_result) == set(warm_result)):
+                print("Error: different completion results for `" + comp_line + "'", file=sys.stderr)
+                sys.exit(1)
+            print("%-26s %8d %8.1fms %8.1fms %8.1fms" % (repr(comp_line), len(legacy_result), legacy_time * 1000, cold_time * 1000, warm_time * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#! /usr/bin/env python3
+
+# Compares the line parser of hostlist.load_config with the previous
+# implementation (one re.match per line kind) and measures load_config
+# with and without the parsed hosts cache.
+#
+# Usage: benchmarks/bench_parser.py [--files N] [--lines N] [--repeat N]
+
+import argparse, os, re, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fleet import generate_hosts_dir
+from lssh import hostindex, hostlist
+from lssh.hostlist import HostEntry
+
+def legacy_parse_file(name, basename):
+    # Parser of load_config before the single-pass tokenizer, kept for comparison.
+    # Returns the same structure as hostlist.parse_config_file.
+    cur_host = [None]
+    file_displayname = [None]
+    file_keywords = {basename}
+    file_hosts = []
+    def handle_line(line):
+        m = re.match('^\\s*Host\\s+([\\S]+)\\s*$', line, re.IGNORECASE)
+        if m:
+            hostname = m.group(1)
+            if '*' not in hostname and '?' not in hostname:
+                cur_host[0] = HostEntry(hostname, basename)
+                file_hosts.append(cur_host[0])
+        m = re.match('^\\s*proxyjump\\s+([\\S]+)\\s*$', line, re.IGNORECASE)
+        if m and cur_host[0] is not None and cur_host[0].jumphost is None:
+            cur_host[0].jumphost = m.group(1)
+        m = re.match('^\\s*#\\s*lssh:(file)?keywords\\s(.*)$', line, re.IGNORECASE)
+        if m:
+            keywords = {k.strip() for k in m.group(2).split(',')}
+            if m.group(1) == 'file':
+                file_keywords.update(keywords)
+            elif cur_host[0] is not None:
+                cur_host[0].keywords |= keywords
+        m = re.match('^\\s*#\\s*lssh:displayname\\s+(\\S.*)$', line, re.IGNORECASE)
+        if m and file_displayname[0] is None:
+            file_displayname[0] = m.group(1)
+        m = re.match('^\\s*#\\s*lssh:assignedcustomer\\s+(\\S.*)$', line, re.IGNORECASE)
+        if m and cur_host[0] is not None:
+            name = m.group(1)
+            if name.endswith(".txt"):
+                name = name[0:-4]
+            cur_host[0].customer = name
+    with open(name, "r") as f:
+        for line in f:
+            handle_line(line)
+    return {
+        "hosts": [[h.display_name, h.customer, h.jumphost, list(h.keywords)] for h in file_hosts],
+        "file_keywords": list(file_keywords),
+        "displayname": file_displayname[0],
+    }
+
+def parse_all(parse_file, path):
+    return {filename: parse_file(path + "/" + filename, filename[0:-4]) for filename in sorted(os.listdir(path))}
+
+def summary(parsed):
+    def file_summary(result):
+        hosts = [(name, customer, jumphost, sorted(keywords)) for name, customer, jumphost, keywords, *alternate_jumps in result["hosts"]]
+        return (hosts, sorted(result["file_keywords"]), result["displayname"])
+    return {filename: file_summary(parsed[filename]) for filename in parsed}
+
+def measure(func, repeat, prepare=None):
+    best = None
+    for i in range(repeat):
+        if prepare is not None:
+            prepare()
+        start = time.perf_counter()
+        result = func()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_parser')
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Do not touch the cache of the calling user
+        os.environ['XDG_CACHE_HOME'] = os.path.join(tmp, 'cache')
+        hosts_dir = os.path.join(tmp, 'hosts')
+        stats = generate_hosts_dir(hosts_dir, customers=args.files, lines=args.lines)
+        print("Generated " + str(stats['files']) + " files, " + str(stats['hosts']) + " hosts, " + str(stats['lines']) + " lines")
+        legacy_time, legacy_result = measure(lambda: parse_all(legacy_parse_file, hosts_dir), args.repeat)
+        new_time, new_result = measure(lambda: parse_all(hostlist.parse_config_file, hosts_dir), args.repeat)
+        if summary(legacy_result) != summary(new_result):
+            print("Error: the parsers produced different results", file=sys.stderr)
+            sys.exit(1)
+        for name, duration in (('legacy parser', legacy_time), ('tokenizer', new_time)):
+            print("%-14s %8.3f s  %12.0f lines/s" % (name, duration, stats['lines'] / duration))
+        print("speedup: %.2fx" % (legacy_time / new_time))
+
+        # Complete load_config, without and with the parsed hosts cache.
+        # The host index is removed each time, otherwise it would not be rebuilt.
+        def remove(path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        def cold():
+            remove(hostlist.parse_cache_path())
+            remove(hostindex.index_path())
+        def warm():
+            remove(hostindex.index_path())
+        load = lambda: hostlist.load_config(hosts_dir, suppress_errors=True)
+        cold_time, _ = measure(load, args.repeat, cold)
+        warm_time, _ = measure(load, args.repeat, warm)
+        print("load_config without parse cache: %.3f s" % cold_time)
+        print("load_config with parse cache:    %.3f s" % warm_time)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#! /usr/bin/env python3
+
+# Compares the throughput of the session recording with script and with the
+# built-in pty recorder (lssh.pty_recorder), for a command that floods the
+# terminal with output like `yes`. The terminal output goes to /dev/null.
+#
+# Usage: benchmarks/bench_recorder.py [--megabytes N] [--repeat N] [--compression METHOD]
+
+import argparse, os, shlex, subprocess, sys, tempfile, time
+
+lib_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Runs the pty recorder in a separate process, like a session started by lssh
+RECORDER = '''
+import pathlib, sys
+sys.path.insert(0, sys.argv[1])
+from lssh import pty_recorder
+compression = sys.argv[3] or None
+sys.exit(pty_recorder.record(sys.argv[4:], dict(__import__("os").environ), pathlib.Path(sys.argv[2]), compression))
+'''
+
+def flood_command(megabytes):
+    return ['sh', '-c', 'yes "line of output with some typical length of a log file line" | head -c ' + str(megabytes * 2**20)]
+
+def run_script(rec_dir, command):
+    subprocess.run(['script', '-q', '-et' + os.path.join(rec_dir, 'timing'), os.path.join(rec_dir, 'output'), '-c', shlex.join(command)], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+
+def run_recorder(rec_dir, command, compression):
+    subprocess.run([sys.executable, '-c', RECORDER, lib_dir, rec_dir, compression or ''] + command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+
+def measure(func, repeat):
+    best = None
+    for i in range(repeat):
+        with tempfile.TemporaryDirectory() as rec_dir:
+            start = time.perf_counter()
+            func(rec_dir)
+            duration = time.perf_counter() - start
+            timing_file = os.path.join(rec_dir, 'timing')
+            records = None
+            if os.path.exists(timing_file):
+                with open(timing_file, 'rb') as f:
+                    records = len(f.read().splitlines())
+            best = (duration, records) if best is None or duration < best[0] else best
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_recorder')
+    parser.add_argument('--megabytes', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--compression', help='compression method of the pty recorder (gzip, lzma, zstd)')
+    args = parser.parse_args()
+
+    command = flood_command(args.megabytes)
+    results = [('script', measure(lambda rec_dir: run_script(rec_dir, command), args.repeat))]
+    results.append(('pty_recorder', measure(lambda rec_dir: run_recorder(rec_dir, command, args.compression), args.repeat)))
+    for name, (duration, records) in results:
+        print("%-13s %8.3f s  %8.1f MiB/s  %s timing records" % (name, duration, args.megabytes / duration, '?' if records is None else str(records)))
+    print("speedup: %.2fx" % (results[0][1][0] / results[1][1][0]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Deterministic generator for synthetic lssh host directories.
+# Used by the benchmarks, the same arguments always create the same files.
+
+import os, random, time
+
+ssh_options = [
+    ('User', ['root', 'admin', 'deploy', 'backup']),
+    ('Port', ['22', '2222', '22022']),
+    ('IdentitiesOnly', ['yes', 'no']),
+    ('ServerAliveInterval', ['30', '60']),
+    ('ConnectTimeout', ['5', '10']),
+    ('Compression', ['yes', 'no']),
+    ('LogLevel', ['ERROR', 'INFO']),
+]
+
+def words(rng, count, prefix):
+    return [prefix + str(i) + rng.choice(['', 'a', 'db', 'web', 'mail']) for i in range(count)]
+
+def generate_hosts_dir(path, customers=500, lines=200000, keywords=2000, seed=1, chains=False):
+    '''
+    Create a directory of host config files.
+
+    Arguments:
+      path:       Target directory, created if needed
+      customers:  Number of *.txt files
+      lines:      Approximate total number of lines over all files
+      keywords:   Size of the keyword pool for #lssh:keywords
+      seed:       Seed of the random generator
+      chains:     Put the jumphosts of the customers behind shared bastions
+                  (with alternate bastions), written to infrastructure.txt
+
+    Return:       A dict with the number of files, hosts and lines written and
+                  the whitelist rows (user, hostname, command) needed for the
+                  generated RemoteCommand options.
+    '''
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    keyword_pool = words(rng, keywords, 'kw')
+    customer_names = ['customer' + str(i).zfill(len(str(customers))) for i in range(customers)]
+    lines_per_file = max(lines // customers, 10)
+    stats = {'files': customers, 'hosts': 0, 'lines': 0, 'whitelist': []}
+    # Separate generator, so the files are the same as without chains otherwise
+    chain_rng = random.Random(seed + 1)
+    bastions = ['bastion' + str(i) + '.example.net' for i in range(4)]
+    if chains:
+        bastion_lines = ['#lssh:displayname Infrastructure', '']
+        for i, bastion in enumerate(bastions):
+            bastion_lines += ['Host ' + bastion, '    HostName 192.0.2.' + str(i + 1), '    User jump', '']
+        with open(os.path.join(path, 'infrastructure.txt'), 'w') as f:
+            f.write('\n'.join(bastion_lines) + '\n')
+        stats['files'] += 1
+        stats['hosts'] += len(bastions)
+        stats['lines'] += len(bastion_lines)
+    for customer in customer_names:
+        domain = customer + '.example.com'
+        file_lines = []
+        if rng.random() < 0.7:
+            file_lines.append('#lssh:displayname ' + customer.capitalize() + ' GmbH')
+        if rng.random() < 0.5:
+            file_lines.append('#lssh:filekeywords ' + ', '.join(rng.sample(keyword_pool, 2)))
+        file_lines.append('')
+        jumphost = None
+        if rng.random() < 0.6:
+            jumphost = 'jump.' + domain
+            file_lines += ['Host ' + jumphost, '    User jump']
+            if chains:
+                bastion = chain_rng.choice(bastions)
+                alternates = [b for b in bastions if b != bastion]
+                file_lines += ['    ProxyJump ' + bastion, '    #lssh:alternatejump ' + ', '.join(chain_rng.sample(alternates, 2))]
+            file_lines.append('')
+        host_nr = 0
+        while len(file_lines) < lines_per_file:
+            host = 'srv' + str(host_nr) + '.' + domain
+            host_nr += 1
+            file_lines.append('Host ' + host)
+            if rng.random() < 0.3:
+                file_lines.append('    #lssh:keywords ' + ', '.join(rng.sample(keyword_pool, rng.randint(1, 3))))
+            hostname = '10.' + str(rng.randrange(256)) + '.' + str(rng.randrange(256)) + '.' + str(rng.randrange(1, 255))
+            file_lines.append('    HostName ' + hostname)
+            for option, values in rng.sample(ssh_options, rng.randint(2, 5)):
+                file_lines.append('    ' + option + ' ' + rng.choice(values))
+            if jumphost is not None:
+                file_lines.append('    ProxyJump ' + jumphost)
+            if rng.random() < 0.02:
+                file_lines.append('    #lssh:assignedcustomer ' + rng.choice(customer_names) + '.txt')
+            if rng.random() < 0.01:
+                file_lines.append('    RemoteCommand tail -f /var/log/syslog')
+                # The whitelist is checked against the HostName
+                stats['whitelist'].append((None, hostname, 'tail'))
+            file_lines.append('')
+            stats['hosts'] += 1
+        file_lines += ['Host *.' + domain, '    ServerAliveCountMax 3']
+        with open(os.path.join(path, customer + '.txt'), 'w') as f:
+            f.write('\n'.join(file_lines) + '\n')
+        stats['lines'] += len(file_lines)
+    return stats
+
+def generate_recordings(path, count=2000, hosts=200, seed=1):
+    '''
+    Create count session recordings (small output and timing files) in the
+    recordings directory path, spread over the given number of host names.
+    Returns the list of host names.
+    '''
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    names = ['srv' + str(i) + '.customer' + str(rng.randrange(hosts)) + '.example.com' for i in range(hosts)]
+    start = time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1))
+    for i in range(count):
+        timestamp = time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(start + 3600 * i + rng.randrange(3600)))
+        recording = os.path.join(path, timestamp + '_' + rng.choice(names))
+        if os.path.exists(recording):
+            continue
+        os.mkdir(recording)
+        chunks = [rng.randrange(1, 400) for j in range(rng.randint(1, 20))]
+        with open(os.path.join(recording, 'output'), 'w') as f:
+            f.write('Script started on ' + timestamp + '\n' + ''.join('x' * size for size in chunks))
+        with open(os.path.join(recording, 'timing'), 'w') as f:
+            f.write(''.join('%.6f %d\n' % (rng.random(), size) for size in chunks))
+    return names
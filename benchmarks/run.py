@@ -0,0 +1,255 @@
+#! /usr/bin/env python3
+
+# Benchmark suite of the hot paths of lssh, on a synthetic fleet (see fleet.py).
+# Runs offline: ssh is replaced by a stub that accepts every config, all
+# lssh files (caches, recordings, whitelist) are written to a temporary directory.
+#
+# The results are written as JSON (--output). Given a stored result as
+# --baseline, every benchmark whose fastest run is slower than the fastest run
+# of the baseline by more than --threshold is reported as regression and the
+# exit code is 1. Differences within the noise of the runs are never reported.
+#
+# Usage: benchmarks/run.py [--customers N] [--lines N] [--recordings N] [--repeat N]
+#                          [--only NAME,...] [--output FILE] [--baseline FILE] [--threshold FRACTION]
+
+import argparse, contextlib, io, json, os, platform, shutil, statistics, subprocess, sys, tempfile, time
+
+lib_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, lib_dir)
+
+from fleet import generate_hosts_dir, generate_recordings
+
+# Differences below this number of seconds are never reported as regression (timer noise)
+MIN_DIFFERENCE = 0.005
+
+def noise(result):
+    # Spread of the runs of one benchmark in seconds
+    return result["median"] - result["min"]
+
+# Completion requests as (COMP_LINE, current argument, previous argument)
+completion_requests = [
+    ('lssh srv1', 'srv1', 'lssh'),
+    ('lssh customer01 ', '', 'customer01'),
+    ('lssh kw1 ', '', 'kw1'),
+]
+
+# Completion in a new process, like bash calls it
+COMPLETE_PROCESS = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+from lssh import main
+hosts_dir = sys.argv[2]
+sys.argv = sys.argv[3:]
+main.main(hosts_dir, None)
+'''
+
+def isolate(tmp):
+    # All lssh files go to tmp, ssh is the stub. Must be called before lssh is imported.
+    for variable, name in (('XDG_CACHE_HOME', 'cache'), ('XDG_DATA_HOME', 'data'), ('XDG_CONFIG_HOME', 'config'), ('XDG_RUNTIME_DIR', 'runtime')):
+        os.environ[variable] = os.path.join(tmp, name)
+    os.makedirs(os.environ['XDG_RUNTIME_DIR'], mode=0o700)
+    stub_dir = os.path.join(tmp, 'bin')
+    os.makedirs(stub_dir)
+    with open(os.path.join(stub_dir, 'ssh'), 'w') as f:
+        f.write('#! /bin/sh\nexit 0\n')
+    os.chmod(os.path.join(stub_dir, 'ssh'), 0o755)
+    os.environ['PATH'] = stub_dir + os.pathsep + os.environ['PATH']
+    os.environ.pop('LSSH_PROFILE', None)
+
+def write_whitelist(rows):
+    from lssh import xdg_compat
+    path = xdg_compat.config_home() / 'lssh' / 'remotecommand-whitelist.csv'
+    os.makedirs(path.parent, exist_ok=True)
+    with open(path, 'w') as f:
+        for user, hostname, command in sorted(set(rows), key=str):
+            f.write(','.join(['*' if user is None else user, hostname, command]) + '\n')
+
+def remove(*paths):
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
+
+def run_silently(func):
+    # Run func without its output, SystemExit (like import_new_config) ends func normally
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        try:
+            return func()
+        except SystemExit as e:
+            return e.code
+
+def benchmarks(fixture):
+    '''
+    The benchmarks as list of (name, prepare, run): prepare is called before
+    each repetition (not measured) and may be None.
+    '''
+    from lssh import cli, config_validation, frecency, hostindex, hostlist, replay, tabcomplete
+    from lssh.command_whitelist import load_default_paths
+    hosts_dir = fixture["hosts_dir"]
+    src_dir = fixture["src_dir"]
+    caches = [hostlist.parse_cache_path(), hostindex.index_path(), tabcomplete.host_cache_path()]
+    contents = []
+    for name in sorted(os.listdir(src_dir)):
+        with open(os.path.join(src_dir, name)) as f:
+            contents.append(f.read())
+    whitelist = load_default_paths()
+    unique_host = fixture["unique_host"]
+    # Usage of some hosts, like after some weeks of connects
+    indexed_hosts = hostlist.load_indexed_config(hosts_dir)[0]
+    used_hosts = sorted(indexed_hosts)[0::max(len(indexed_hosts) // 300, 1)]
+    for i, host in enumerate(used_hosts):
+        frecency.record(host, time.time() - i * 3600)
+    matched_hosts = cli.find_matching_hosts(indexed_hosts, 'srv1', [])
+
+    def complete_in_process():
+        for comp_line, current_arg, previous_arg in completion_requests:
+            os.environ['COMP_LINE'] = comp_line
+            sys.argv[:] = ['lssh', '__complete__', 'lssh', current_arg, previous_arg]
+            run_silently(lambda: tabcomplete.main(hosts_dir))
+
+    def complete_process():
+        comp_line, current_arg, previous_arg = completion_requests[0]
+        env = dict(os.environ, COMP_LINE=comp_line)
+        subprocess.run([sys.executable, '-c', COMPLETE_PROCESS, lib_dir, hosts_dir, 'lssh', '__complete__', 'lssh', current_arg, previous_arg], env=env, stdout=subprocess.DEVNULL, check=True)
+
+    def import_dir():
+        return os.path.join(fixture["tmp"], 'imported')
+
+    def reset_import():
+        remove(import_dir(), import_dir() + '.generations', import_dir() + '.lock', hostlist.validation_cache_path())
+
+    def import_config():
+        code = run_silently(lambda: hostlist.import_new_config(src_dir, import_dir(), None, fixture["jobs"]))
+        if code != 0:
+            raise RuntimeError("import_new_config failed with exit code " + str(code))
+
+    def reset_catalog():
+        from lssh import recordings
+        remove(recordings.catalog_path())
+
+    return [
+        # Parsing all files, writing the parse cache and the host index
+        ('load_config_cold', lambda: remove(*caches), lambda: hostlist.load_config(hosts_dir, suppress_errors=True)),
+        # Unchanged files, taken from the parse cache
+        ('load_config_warm', None, lambda: hostlist.load_config(hosts_dir, suppress_errors=True)),
+        # Up to date host index, like a connect
+        ('load_indexed_config', None, lambda: hostlist.load_indexed_config(hosts_dir)),
+        # Matching on the host index, with several substrings
+        ('matching', None, lambda: [cli.find_matching_hosts(hostlist.load_indexed_config(hosts_dir)[0], substring, additional) for substring, additional in (('srv1', []), ('customer0', ['srv2']), ('kw1', []))]),
+        # select_host with a unique match (without the dialog)
+        ('select_host', None, lambda: cli.select_host(unique_host, [], hosts_dir)),
+        ('complete', None, complete_in_process),
+        ('complete_process', None, complete_process),
+        ('transform_config', None, lambda: [config_validation.transform_config(content, whitelist, None, check_ssh=False) for content in contents]),
+        # The batched ssh check, with the stub ssh
+        ('ssh_check_batch', None, lambda: config_validation.ssh_check_batch(contents)),
+        ('import_new_config_cold', reset_import, import_config),
+        # All files are unchanged and in the validation cache
+        ('import_new_config_warm', None, import_config),
+        # The catalog is built from the recordings directory
+        ('replay_lookup_cold', reset_catalog, lambda: replay.find_recording_names(['srv1'])),
+        ('replay_lookup_warm', None, lambda: replay.find_recording_names(['srv1'])),
+        # Scores of the matching hosts for the selection dialog
+        ('usage_lookup', None, lambda: frecency.scores(matched_hosts)),
+        ('usage_lookup_all', None, lambda: frecency.scores(indexed_hosts)),
+        ('usage_record', None, lambda: frecency.record(unique_host)),
+    ]
+
+def measure(prepare, run, repeat):
+    runs = []
+    for i in range(repeat):
+        if prepare is not None:
+            prepare()
+        start = time.perf_counter()
+        run()
+        runs.append(time.perf_counter() - start)
+    return {"median": statistics.median(runs), "min": min(runs), "runs": runs}
+
+def compare(results, baseline, threshold):
+    # Print the comparison, returns the names of the regressions
+    regressions = []
+    print()
+    print("%-24s %10s %10s %8s" % ('benchmark', 'baseline', 'current', 'change'))
+    for name, result in results.items():
+        if name not in baseline:
+            print("%-24s %10s %8.2fms %8s" % (name, '-', result["min"] * 1000, 'new'))
+            continue
+        before = baseline[name]["min"]
+        change = result["min"] / before - 1 if before > 0 else 0.0
+        floor = max(MIN_DIFFERENCE, 2 * noise(baseline[name]), 2 * noise(result))
+        regression = change > threshold and result["min"] - before > floor
+        if regression:
+            regressions.append(name)
+        print("%-24s %8.2fms %8.2fms %+7.1f%%%s" % (name, before * 1000, result["min"] * 1000, change * 100, '  REGRESSION' if regression else ''))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(prog='run')
+    parser.add_argument('--customers', type=int, default=200)
+    parser.add_argument('--lines', type=int, default=60000)
+    parser.add_argument('--keywords', type=int, default=2000)
+    parser.add_argument('--recordings', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes of import_new_config')
+    parser.add_argument('--only', help='comma-separated names of the benchmarks to run')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown reported as regression (default 0.2 = 20%%)')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    with tempfile.TemporaryDirectory() as tmp:
+        isolate(tmp)
+        src_dir = os.path.join(tmp, 'src')
+        stats = generate_hosts_dir(src_dir, customers=args.customers, lines=args.lines, keywords=args.keywords, chains=True)
+        write_whitelist(stats['whitelist'])
+        from lssh import hostlist, recordings
+        # The validated hosts directory, like after lssh --load-from
+        hosts_dir = os.path.join(tmp, 'hosts')
+        code = run_silently(lambda: hostlist.import_new_config(src_dir, hosts_dir, None, args.jobs))
+        if code != 0:
+            print("Error: The generated fleet could not be imported", file=sys.stderr)
+            sys.exit(1)
+        generate_recordings(recordings.recordings_basedir(), args.recordings)
+        entries, _ = hostlist.load_config(hosts_dir, suppress_errors=True)
+        fixture = {
+            "tmp": tmp,
+            "src_dir": src_dir,
+            "hosts_dir": hosts_dir,
+            "jobs": args.jobs,
+            "unique_host": sorted(entries)[len(entries) // 2],
+        }
+        print("Fixture: " + str(stats['files']) + " files, " + str(len(entries)) + " hosts, " + str(stats['lines']) + " lines, " + str(args.recordings) + " recordings")
+        only = None if args.only is None else set(args.only.split(','))
+        results = {}
+        for name, prepare, run in benchmarks(fixture):
+            if only is not None and name not in only:
+                continue
+            results[name] = measure(prepare, run, args.repeat)
+            print("%-24s %8.2fms (min %.2fms)" % (name, results[name]["median"] * 1000, results[name]["min"] * 1000))
+
+    output = {
+        "version": 1,
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "fixture": {"customers": args.customers, "lines": args.lines, "keywords": args.keywords, "recordings": args.recordings, "hosts": len(entries), "repeat": args.repeat},
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1)
+    if baseline is not None:
+        if baseline.get("fixture", {}).get("hosts") != len(entries):
+            print("Warning: The baseline was measured with another fixture", file=sys.stderr)
+        regressions = compare(results, baseline["results"], args.threshold)
+        if len(regressions) > 0:
+            print(str(len(regressions)) + " regressions: " + ", ".join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,13 @@
-import itertools, os, platform, shlex, subprocess, sys, time
-from lssh import cli_args, hostlist, xdg_compat
+import itertools, os, platform, re, shlex, subprocess, sys, time
+from lssh import cli_args, hostindex, hostlist, profiling
 
 def group_options_by_customer(hosts):
     map_customer = {}
-    for hostname in hosts:
-        customer = hosts[hostname].customer
+    for hostname, host in hosts.items():
+        customer = host.customer
         if customer not in map_customer:
             map_customer[customer] = []
-        map_customer[customer].append(hosts[hostname].display_name)
+        map_customer[customer].append(host.display_name)
     customers = list(map_customer.keys())
     customers.sort()
     def make_option(customer):
@@ -32,6 +32,19 @@ def matches_all_substrings(host, substring, additional_substrings):
             return False
     return True
 
+def find_matching_hosts(hosts, substring, additional_substrings):
+    if isinstance(hosts, hostindex.HostIndex):
+        # Only check the hosts that can match according to the substring index
+        candidates = hosts.candidates([substring] + additional_substrings)
+        entries = (hosts.entry(host_id) for host_id in sorted(candidates))
+    else:
+        entries = hosts.values()
+    matched_hosts = {}
+    for host in entries:
+        if matches_all_substrings(host, substring, additional_substrings):
+            matched_hosts[host.display_name] = host
+    return matched_hosts
+
 def ensure_no_usernames(substrings):
     for substr in substrings:
         if '@' in substr:
@@ -48,21 +61,53 @@ def split_user_from_substring(s):
     return (s[0:idx], s[idx+1:])
 
 def create_recording_directory(hostname):
-    recordings_basedir = xdg_compat.data_home() / 'lssh' / 'recordings'
+    '''
+    Create the recording directory for a session with hostname and add it to
+    the catalog. The directory is locked before, so its stats are not
+    calculated while the session is running (see recordings.update_stats).
+    Returns the directory and the file descriptor holding the lock.
+    '''
+    import sqlite3
+    from lssh import recordings
+    recordings_basedir = recordings.recordings_basedir()
     os.makedirs(recordings_basedir, exist_ok=True)
+    previous_mtime = recordings.basedir_mtime()
     name = time.strftime("%Y-%m-%d_%H-%M-%S") + '_' + hostname
     try:
         d = recordings_basedir / name
         os.mkdir(d)
-        return d
     except FileExistsError:
         for i in itertools.count(2):
             try:
                 d = recordings_basedir / (name + '_' + str(i))
                 os.mkdir(d)
-                return d
+                break
             except FileExistsError:
                 pass
+    # Lock the recording, so it is not removed while the session is running
+    lock = recordings.lock_recording(d)
+    try:
+        recordings.add_recording(d.name, previous_mtime)
+    except sqlite3.Error as e:
+        # The recording will be added to the catalog when it is synchronized
+        print("Warning: Could not add the session recording to the catalog: " + str(e), file=sys.stderr)
+    return d, lock
+
+def finish_recording(rec_dir):
+    import sqlite3
+    from lssh import recordings
+    try:
+        recordings.finish_recording(rec_dir.name)
+    except sqlite3.Error as e:
+        print("Warning: Could not update the session recording in the catalog: " + str(e), file=sys.stderr)
+
+def prune_recordings(recording_retention, compression):
+    import sqlite3
+    from lssh import recording_retention as retention_module
+    try:
+        retention_module.prune_after_connect(recording_retention, compression)
+    except (OSError, sqlite3.Error) as e:
+        print("Warning: Could not remove old session recordings: " + str(e), file=sys.stderr)
 
 def check_for_conflicting_args(args):
     mode = [None] # array to allow access inside of the function add_mode
@@ -85,38 +130,138 @@ def check_for_conflicting_args(args):
         add_mode("replay", "--replay")
     if args.time is not None:
         add_mode("replay", "--timestamp")
+    if args.speed is not None:
+        add_mode("replay", "--speed")
+    if args.seek is not None:
+        add_mode("replay", "--seek")
+    if args.max_idle is not None:
+        add_mode("replay", "--max-idle")
+    if args.grep is not None:
+        add_mode("grep", "--grep")
+    if args.prune:
+        add_mode("prune", "--prune-recordings")
+    if args.exec is not None:
+        add_mode("exec", "--exec")
+    if args.masters:
+        add_mode("masters", "--masters")
+    if args.close_masters:
+        add_mode("close_masters", "--close-masters")
+
+def replay_options(args):
+    from lssh import recording_player
+    if args.speed is not None and args.speed <= 0:
+        print("The argument --speed must be greater than 0", file=sys.stderr)
+        exit(1)
+    if args.max_idle is not None and args.max_idle < 0:
+        print("The argument --max-idle must not be negative", file=sys.stderr)
+        exit(1)
+    start = None
+    if args.seek is not None:
+        start = recording_player.parse_position(args.seek)
+        if start is None:
+            print("Invalid position for --seek, use seconds, [hh:]mm:ss or a percentage", file=sys.stderr)
+            exit(1)
+    return {
+        "speed": 1.0 if args.speed is None else args.speed,
+        "start": start,
+        "max_idle": 2.0 if args.max_idle is None else (args.max_idle or None),
+    }
 
 def main(hosts_dir, update_hosts, attributes):
+    started = time.perf_counter()
     args = cli_args.parse_args()
+    if args.verbose is not None and args.verbose >= 2:
+        profiling.enable('lssh')
+    profiling.add('parse_args', started)
     check_for_conflicting_args(args)
+    if args.jobs is not None and args.jobs < 1:
+        print("The argument --jobs must be at least 1", file=sys.stderr)
+        exit(1)
 
     user, substring = split_user_from_substring(args.substring)
     additional_substrings = args.additional_substrings
     ensure_no_usernames(additional_substrings)
     general_proxy = None if "general_proxy" not in attributes else attributes["general_proxy"]
+    recording_compression = None if "recording_compression" not in attributes else attributes["recording_compression"]
+    if recording_compression is not None:
+        from lssh import compressed_recording
+        if recording_compression not in compressed_recording.methods:
+            print("Error: Unknown recording_compression `" + recording_compression + "', use one of: " + ", ".join(compressed_recording.methods), file=sys.stderr)
+            exit(1)
+        if not compressed_recording.available(recording_compression):
+            print("Warning: The python module for recording_compression `" + recording_compression + "' is not installed, using gzip instead", file=sys.stderr)
+            recording_compression = "gzip"
+    recording_format = None if "recording_format" not in attributes else attributes["recording_format"]
+    if recording_format not in (None, "script", "asciicast"):
+        print("Error: Unknown recording_format `" + str(recording_format) + "', use one of: script, asciicast", file=sys.stderr)
+        exit(1)
+    recording_retention = None if "recording_retention" not in attributes else attributes["recording_retention"]
+    control_persist = None if "control_persist" not in attributes else attributes["control_persist"]
+    if control_persist is not None and type(control_persist) not in (int, str):
+        print("Error: control_persist must be a number of seconds or an ssh time format like 10m", file=sys.stderr)
+        exit(1)
+    autoconnect = None if "frecency_autoconnect" not in attributes else attributes["frecency_autoconnect"]
+    if autoconnect is not None and (type(autoconnect) not in (int, float) or autoconnect <= 1):
+        print("Error: frecency_autoconnect must be a number greater than 1", file=sys.stderr)
+        exit(1)
+    if recording_retention is not None:
+        from lssh import recording_retention as retention_module
+        error = retention_module.check_settings(recording_retention)
+        if error is not None:
+            print("Error: " + error, file=sys.stderr)
+            exit(1)
     if args.version:
         print("lssh version dev")
     elif args.validate is not None:
-        hostlist.validate_config(args.validate, general_proxy)
+        hostlist.validate_config(args.validate, general_proxy, args.jobs, args.verbose is not None)
     elif args.update:
         update_hosts()
     elif args.load is not None:
-        hostlist.import_new_config(args.load, hosts_dir, general_proxy)
-    elif args.replay or args.time is not None:
+        hostlist.import_new_config(args.load, hosts_dir, general_proxy, args.jobs, args.verbose is not None)
+    elif args.prune:
+        if recording_retention is None:
+            print("No recording_retention is configured, see the installation documentation", file=sys.stderr)
+            exit(1)
+        from lssh import recording_retention as retention_module
+        retention_module.main(recording_retention, "gzip" if recording_compression is None else recording_compression)
+    elif args.replay or args.time is not None or args.speed is not None or args.seek is not None or args.max_idle is not None:
         from lssh import replay
         if substring is None:
             all_substrings = []
         else:
             all_substrings = [substring] + additional_substrings
-        replay.replay(all_substrings, args.time)
+        replay.replay(all_substrings, args.time, replay_options(args))
+    elif args.exec is not None:
+        execute_on_hosts(args, user, substring, additional_substrings, hosts_dir, control_persist)
+    elif args.masters or args.close_masters:
+        from lssh import control_master
+        if substring is None:
+            all_substrings = []
+        else:
+            all_substrings = [substring] + additional_substrings
+        control_master.main(args.close_masters, all_substrings)
+    elif args.grep is not None:
+        from lssh import recording_search
+        if substring is None:
+            all_substrings = []
+        else:
+            all_substrings = [substring] + additional_substrings
+        recording_search.main(args.grep, all_substrings, args.verbose is not None)
     else:
-        connect(args, user, substring, additional_substrings, hosts_dir)
+        connect(args, user, substring, additional_substrings, hosts_dir, recording_compression, recording_format, recording_retention, control_persist, autoconnect)
 
-def build_proxy_chain(selected, hosts):
+def configured_jumphost(entry):
+    # ProxyJump none disables the jumphost (and the general_proxy)
+    if entry.jumphost is None or entry.jumphost.lower() == 'none':
+        return None
+    return entry.jumphost
+
+def build_proxy_chain(selected, hosts, jump=None):
+    # jump replaces the configured jumphost of selected
     chain = [selected]
     cur_host = selected
-    while cur_host in hosts and hosts[cur_host].jumphost is not None:
-        cur_host = hosts[cur_host].jumphost
+    while cur_host in hosts and (configured_jumphost(hosts[cur_host]) is not None or (cur_host == selected and jump is not None)):
+        cur_host = jump if cur_host == selected and jump is not None else configured_jumphost(hosts[cur_host])
         if cur_host in chain:
             loop = " -> ".join([cur_host] + chain)
             print("Error: There is a loop in the proxy hosts!", file=sys.stderr)
@@ -132,16 +277,86 @@ def show_proxy_chain(chain):
         print("Connecting via:")
         print("  " + " -> ".join(chain))
 
-def select_host(substring, additional_substrings, hosts_dir):
-    hosts, displaynames = hostlist.load_config(hosts_dir)
-    if substring is None:
-        matched_hosts = hosts
-    else:
-        matched_hosts = {}
-        for display_name in hosts:
-            host = hosts[display_name]
-            if matches_all_substrings(host, substring, additional_substrings):
-                matched_hosts[display_name] = hosts[display_name]
+def given_ssh_options(args):
+    # Lowercase names of the options given with -o
+    return {re.split('[=\\s]', option.strip(), 1)[0].lower() for option in vars(args)['o'] or []}
+
+def choose_jumphost(args, selected, hosts, quiet=False):
+    '''
+    The fastest of the jumphost and the alternate jumphosts of selected,
+    or None if the configured jumphost is used.
+    '''
+    entry = hosts[selected]
+    if len(entry.alternate_jumps) == 0 or vars(args)['J'] is not None or given_ssh_options(args) & {'proxyjump', 'proxycommand'}:
+        return None
+    from lssh import jump_probe
+    jumphost = configured_jumphost(entry)
+    candidates = [] if jumphost is None else [jumphost]
+    candidates += [jump for jump in entry.alternate_jumps if jump != jumphost and jump.lower() != 'none']
+    if len(candidates) == 0:
+        return None
+    jump = jump_probe.fastest(candidates, args.verbose is not None and not quiet)
+    return None if jump == jumphost else jump
+
+def prepare_connection(args, selected, hosts, control_persist, environment, cancelled):
+    '''
+    Prepare the connection to selected while it is highlighted in the tui
+    dialog (see warmup): probe the alternate jumphosts and, if connections
+    are shared, open the connection to the first jumphost.
+    Stops when the event cancelled is set.
+    '''
+    jump = choose_jumphost(args, selected, hosts, quiet=True)
+    if cancelled.is_set() or control_persist is None or vars(args)['S'] is not None or vars(args)['J'] is not None:
+        return
+    if given_ssh_options(args) & {'controlmaster', 'controlpath', 'controlpersist', 'proxyjump', 'proxycommand'}:
+        return
+    # Follow the chain without build_proxy_chain, a loop is reported when connecting
+    hop = configured_jumphost(hosts[selected]) if jump is None else jump
+    seen = {selected}
+    while hop in hosts and configured_jumphost(hosts[hop]) is not None:
+        if hop in seen:
+            return
+        seen.add(hop)
+        hop = configured_jumphost(hosts[hop])
+    if hop is None or ',' in hop:
+        return
+    from lssh import control_master
+    control_master.open_master(hop, control_persist, environment, cancelled)
+
+def usage_scores(hosts):
+    import sqlite3
+    from lssh import frecency
+    try:
+        return frecency.scores(hosts)
+    except (OSError, sqlite3.Error) as e:
+        print("Warning: Could not read the host usage: " + str(e), file=sys.stderr)
+        return {}
+
+def record_usage(selected):
+    import sqlite3
+    from lssh import frecency
+    try:
+        frecency.record(selected)
+    except (OSError, sqlite3.Error) as e:
+        print("Warning: Could not store the host usage: " + str(e), file=sys.stderr)
+
+def select_host(substring, additional_substrings, hosts_dir, on_highlight=None, autoconnect=None):
+    '''
+    Select the host by the substrings, with the tui dialog if several hosts match.
+    The most frequently and recently used host is highlighted first. If
+    autoconnect is given, it is selected without the dialog if its score is at
+    least autoconnect times the score of the other matching hosts.
+    on_highlight is called with the host name and the hosts when a host is
+    highlighted in the dialog.
+    Returns the selected host name and the hosts.
+    '''
+    with profiling.phase('load_config'):
+        hosts, displaynames = hostlist.load_indexed_config(hosts_dir)
+    with profiling.phase('matching'):
+        if substring is None:
+            matched_hosts = hosts
+        else:
+            matched_hosts = find_matching_hosts(hosts, substring, additional_substrings)
 
     if len(matched_hosts) == 0:
         if len(hosts) == 0:
@@ -154,20 +369,39 @@ def select_host(substring, additional_substrings, hosts_dir):
     elif len(matched_hosts) == 1:
         selected = list(matched_hosts.keys())[0]
     else:
-        from lssh import tui_dialog
+        with profiling.phase('usage_lookup'):
+            scores = usage_scores(matched_hosts)
+        from lssh import frecency
+        dominant = None if autoconnect is None or substring is None else frecency.dominant(scores, autoconnect)
+        if dominant is not None:
+            print("Connecting to " + dominant + ", the most used of " + str(len(matched_hosts)) + " matching hosts")
+            return dominant, hosts
+        from lssh import host_picker
         options = group_options_by_customer(matched_hosts)
-        choice = tui_dialog.hierarchical_option_dialog(options, displaynames, 'select customer', 'select host')
+        preselect = None
+        if len(scores) > 0:
+            best = max(sorted(scores), key=lambda host: scores[host])
+            customers = [customer for customer, _ in options]
+            customer_idx = customers.index(matched_hosts[best].customer)
+            preselect = (customer_idx, options[customer_idx][1].index(best))
+        highlight = None
+        if on_highlight is not None:
+            highlight = lambda idx1, idx2: on_highlight(options[idx1][1][idx2], hosts)
+        with profiling.phase('tui'):
+            choice = host_picker.pick(options, displaynames, 'select customer', 'select host', highlight, preselect)
         if choice is None:
             print("No host has been selected")
             sys.exit(1)
         selected = options[choice[0]][1][choice[1]]
-    proxy_chain = build_proxy_chain(selected, hosts)
-    return selected, proxy_chain
-
-def connect(args, user, substring, additional_substrings, hosts_dir):
-    from lssh import ssh_agent
-    selected, proxy_chain = select_host(substring, additional_substrings, hosts_dir)
+    return selected, hosts
 
+def build_ssh_command(args, user, selected, proxy_chain, control_persist, extra_options=[], jump=None, share_target=True):
+    '''
+    The ssh command line to connect to the host selected, with the ssh options
+    given to lssh and extra_options, without a remote command.
+    jump is passed as -J, unless the proxy chain is already given for the connection sharing.
+    If share_target is False, only the connections to the jumphosts are shared.
+    '''
     options_dict = vars(args)
     command = ['ssh']
     for opt in cli_args.parameterless_options:
@@ -181,10 +415,58 @@ def connect(args, user, substring, additional_substrings, hosts_dir):
                 command += ['-' + opt, param]
     if args.verbose is not None:
         command.append('-' + args.verbose * 'v')
+    command += extra_options
     user_prefix = "" if user is None else user + "@"
+    if control_persist is not None and options_dict['S'] is None:
+        from lssh import control_master
+        sharing_options = control_master.ssh_options(user_prefix + selected, proxy_chain[0:-1], control_persist, options_dict['o'] or [], share_target)
+        command += sharing_options
+        if any(option.startswith('ProxyCommand=') for option in sharing_options):
+            jump = None
+    if jump is not None:
+        command += ['-J', jump]
     command.append(user_prefix + selected)
+    return command
+
+def execute_on_hosts(args, user, substring, additional_substrings, hosts_dir, control_persist):
+    from lssh import fanout, ssh_agent
+    if substring is None:
+        print("--exec needs at least one substring to select the hosts", file=sys.stderr)
+        sys.exit(1)
+    with profiling.phase('load_config'):
+        hosts, displaynames = hostlist.load_indexed_config(hosts_dir)
+    with profiling.phase('matching'):
+        matched_hosts = find_matching_hosts(hosts, substring, additional_substrings)
+    if len(matched_hosts) == 0:
+        print("No matching hosts for the given substrings found")
+        sys.exit(1)
+    # Never ask for passwords or host key confirmations of many hosts at once
+    extra_options = ['-o', 'BatchMode=yes'] + (['-T'] if args.t is None else [])
+    targets = []
+    for selected in sorted(matched_hosts):
+        jump = choose_jumphost(args, selected, hosts)
+        proxy_chain = build_proxy_chain(selected, hosts, jump)
+        # Only the jumphosts are used again, a master per target would stay open for nothing
+        command = build_ssh_command(args, user, selected, proxy_chain, control_persist, extra_options, jump, share_target=False) + [args.exec]
+        targets.append((selected, proxy_chain[0:-1], command))
+    fanout.main(targets, fanout.MAX_PARALLEL if args.jobs is None else args.jobs, ssh_agent.get_environment())
+
+def connect(args, user, substring, additional_substrings, hosts_dir, recording_compression, recording_format, recording_retention, control_persist, autoconnect):
+    from lssh import warmup
+    # Start the ssh agent and prepare the highlighted hosts while the user is selecting
+    warm = warmup.Warmup()
+    def on_highlight(host, hosts):
+        warm.highlight(host, lambda environment, cancelled: prepare_connection(args, host, hosts, control_persist, environment, cancelled))
+    selected, hosts = select_host(substring, additional_substrings, hosts_dir, on_highlight, autoconnect)
+    with profiling.phase('warmup_wait'):
+        warm.finish(selected)
+    with profiling.phase('jumphost_selection'):
+        jump = choose_jumphost(args, selected, hosts)
+    proxy_chain = build_proxy_chain(selected, hosts, jump)
+    command = build_ssh_command(args, user, selected, proxy_chain, control_persist, jump=jump)
     try:
-        rec_dir = create_recording_directory(selected)
+        with profiling.phase('recording_setup'):
+            rec_dir, rec_lock = create_recording_directory(selected)
     except Exception as e:
         print("Warning: Could not create directory for session recording: " + str(e), file=sys.stderr)
         rec_dir = None
@@ -192,16 +474,36 @@ def connect(args, user, substring, additional_substrings, hosts_dir):
     show_proxy_chain(proxy_chain)
     if args.verbose is not None:
         print("executing command: " + ssh_commandline)
-    if rec_dir is not None:
-        if platform.system() == "Darwin":
-            final_command = ['script', '-r', str(rec_dir / 'output')] + command
-        else:
-            final_command = ['script', '-et'+str(rec_dir / 'timing'), rec_dir / 'output', '-c', ssh_commandline]
-    else:
-        final_command = command
+    def script_command(output_file):
+        return ['script', '-r', output_file] + command
+    with profiling.phase('agent_wait'):
+        environment = warm.get_environment()
     try:
-        sys.exit(subprocess.run(final_command, env=ssh_agent.get_environment()).returncode)
+        if rec_dir is not None and platform.system() != "Darwin":
+            from lssh import pty_recorder
+            returncode = pty_recorder.record(command, environment, rec_dir, recording_compression, recording_format == "asciicast", selected)
+        elif rec_dir is not None and recording_compression is not None:
+            from lssh import compressed_recording
+            profiling.event('ssh_started')
+            returncode = compressed_recording.record(rec_dir, recording_compression, ['output'], script_command, environment)
+        else:
+            if rec_dir is not None:
+                final_command = script_command(str(rec_dir / 'output'))
+            else:
+                final_command = command
+            profiling.event('ssh_started')
+            returncode = subprocess.run(final_command, env=environment).returncode
     except KeyboardInterrupt:
         # User is allowed to interrupt the ssh process
         # Just ignore this case
-        pass
+        returncode = None
+    if rec_dir is not None:
+        finish_recording(rec_dir)
+        os.close(rec_lock)
+    # ssh exits with 255 if the connection failed
+    if returncode is not None and returncode != 255:
+        record_usage(selected)
+    if recording_retention is not None:
+        prune_recordings(recording_retention, "gzip" if recording_compression is None else recording_compression)
+    if returncode is not None:
+        sys.exit(returncode)
@@ -8,9 +8,18 @@ def parse_args():
 
     parser.add_argument('-r', '--replay', dest='replay', action='store_true', help='Watch a previously recored ssh session.')
     parser.add_argument('--timestamp', metavar='TIME', dest='time', help='The exact timestamp when the session recording was started, in the form YYYY-MM-DD_hh-mm-ss. (Implies --replay)')
+    parser.add_argument('--speed', metavar='FACTOR', type=float, help='Replay the session recording FACTOR times faster (or slower if less than 1). (Implies --replay)')
+    parser.add_argument('--seek', metavar='POSITION', help='Start the replay at POSITION, given in seconds, as [hh:]mm:ss or as percentage like 50%%. (Implies --replay)')
+    parser.add_argument('--max-idle', metavar='SECONDS', dest='max_idle', type=float, help='Wait at most SECONDS between two outputs of the replayed session, 0 for no limit. (Default: 2, implies --replay)')
     parser.add_argument('--update-hosts', dest='update', action='store_true', help='Update the hostlist configuration files using the configured command. (Typically git pull followed by lssh --load-from ...)')
     parser.add_argument('--load-from', dest='load', metavar='SRCDIR', help='Load a new ssh config from the directory SRCDIR (that contains them as *.txt files), validate the config and (if valid) store it at the central location configured in lssh. You should not call this manually but instead run `lssh --update-hosts` that will also pull updates before loading the files.')
     parser.add_argument('--validate', dest='validate', metavar='CONFDIR', help='Load the given ssh config from the directory CONFDIR, validate it, but do not store it anywhere. If valid, lssh will print nothing and exit with 0. If invalid, lssh will print the errors and exit with a non-zero exit status.')
+    parser.add_argument('--grep', metavar='TEXT', help='Search the output of all session recordings for TEXT (case insensitive) and list the recordings that contain it. The search can be restricted to hosts by additional substrings.')
+    parser.add_argument('--prune-recordings', dest='prune', action='store_true', help='Remove and compress old session recordings according to the configured recording_retention.')
+    parser.add_argument('--exec', metavar='COMMAND', dest='exec', help='Run COMMAND on all hosts matching the substrings in parallel (non-interactive), print the output prefixed by the host names and a summary of the exit codes.')
+    parser.add_argument('--masters', dest='masters', action='store_true', help='List the shared connections (ssh ControlMaster) kept open by lssh, restricted to hosts matching all substrings.')
+    parser.add_argument('--close-masters', dest='close_masters', action='store_true', help='Close the shared connections kept open by lssh, restricted to hosts matching all substrings.')
+    parser.add_argument('--jobs', metavar='N', type=int, help='Number of files to validate in parallel with --load-from and --validate (default: number of CPUs), or number of hosts to run the command on in parallel with --exec (default: 32).')
     parser.add_argument('-v', '--verbose', action='count', help='Verbose mode. Enables printing the resulting ssh command line before connecting.')
     parser.add_argument('--version', dest='version', action='store_true', help='Show the current version number and exit.')
 
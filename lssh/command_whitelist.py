@@ -1,4 +1,4 @@
-import csv, sys
+import csv, json, os, sys
 from lssh import xdg_compat
 
 def convert_field(value):
@@ -10,23 +10,103 @@ def convert_row(row):
     user, hostname, command = row
     return convert_field(user), convert_field(hostname), command
 
-def load(filename):
+class CommandWhitelist:
+    '''
+    The rows (user, hostname, command) of the remote command whitelist,
+    indexed by command.
+
+    For each command, a set of the allowed (user, hostname) pairs is kept.
+    user and hostname are None for the wildcard `*`, so a lookup has to check
+    the exact pair and the pairs with wildcards, independent of the number of rows.
+    '''
+    def __init__(self, rows):
+        self.__rows = list(rows)
+        self.__targets = {}
+        for user, hostname, command in self.__rows:
+            self.__targets.setdefault(command, set()).add((user, hostname))
+    def allows(self, command, user, hostname):
+        targets = self.__targets.get(command)
+        if targets is None:
+            return False
+        return (user, hostname) in targets or (None, hostname) in targets or (user, None) in targets or (None, None) in targets
+    def __iter__(self):
+        return iter(self.__rows)
+    def __len__(self):
+        return len(self.__rows)
+
+def parse(filename):
+    # Returns the rows of the csv file and the warnings for invalid lines
+    rows = []
+    warnings = []
     try:
         with open(filename, "r") as f:
             reader = csv.reader(f)
-            result = []
             i = 1
             for row in reader:
                 if len(row) != 3:
-                    print("Warning: Line " + str(i) + " in " + filename + " is invalid - expected 3 columns but found " + str(len(row)), file=sys.stderr)
+                    warnings.append("Warning: Line " + str(i) + " in " + filename + " is invalid - expected 3 columns but found " + str(len(row)))
                 else:
-                    result.append(convert_row(row))
+                    rows.append(convert_row(row))
                 i += 1
-            return result
     except FileNotFoundError:
-        return []
+        pass
+    return (rows, warnings)
+
+def load(filename):
+    rows, warnings = parse(filename)
+    for warning in warnings:
+        print(warning, file=sys.stderr)
+    return rows
+
+def cache_path():
+    return xdg_compat.cache_home() / "lssh" / "command_whitelist.json"
+
+def file_key(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return [filename, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+def load_cached(filenames):
+    '''
+    Load the rows of all given csv files as CommandWhitelist.
+    The parsed rows are cached, the cache is invalidated when one of the files changes.
+    Warnings for invalid lines are shown again when the cache is used.
+    '''
+    key = [file_key(filename) for filename in filenames]
+    try:
+        with open(cache_path(), "r") as f:
+            cache = json.load(f)
+        if cache.get("version") != 1 or cache.get("key") != key:
+            cache = None
+    except (FileNotFoundError, ValueError):
+        cache = None
+    if cache is None:
+        rows = []
+        warnings = []
+        for filename in filenames:
+            file_rows, file_warnings = parse(filename)
+            rows += file_rows
+            warnings += file_warnings
+        cache = {"version": 1, "key": key, "rows": rows, "warnings": warnings}
+        tmp_path = cache_path().with_name(cache_path().name + "." + str(os.getpid()) + ".tmp")
+        try:
+            os.makedirs(cache_path().parent, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path())
+        except OSError:
+            # Not being able to cache the whitelist is not a problem
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+    for warning in cache["warnings"]:
+        print(warning, file=sys.stderr)
+    return CommandWhitelist(tuple(row) for row in cache["rows"])
 
 def load_default_paths():
     global_path = "/etc/lssh/remotecommand-whitelist.csv"
     local_path = xdg_compat.config_home() / "lssh" / "remotecommand-whitelist.csv"
-    return load(global_path) + load(local_path)
+    return load_cached([global_path, str(local_path)])
@@ -0,0 +1,109 @@
+import json, os, signal, socket, sys
+from lssh import hostindex, tabcomplete
+
+# Resident tab-completion server.
+#
+# Started by `lssh __complete_server__`, it keeps the host index in memory and
+# answers the requests of `lssh __complete__` over a unix socket, so pressing
+# tab does not need to load the host data again.
+# If the server is not running, lssh __complete__ calculates the completion itself.
+
+class HostData:
+    '''
+    Keeps the host index of hosts_dir in memory and reloads it when the
+    index or hostlist cache file changes.
+    '''
+    def __init__(self, hosts_dir):
+        self.__hosts_dir = hosts_dir
+        self.__state = None
+        self.__index = None
+
+    def file_state(self):
+        state = []
+        for path in (hostindex.index_path(), tabcomplete.host_cache_path()):
+            try:
+                stat = os.stat(path)
+                state.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                state.append(None)
+        return state
+
+    def index(self):
+        state = self.file_state()
+        if self.__index is None or state != self.__state:
+            self.__index = tabcomplete.load_host_index(self.__hosts_dir)
+            self.__state = state
+        return self.__index
+
+def handle_request(request, hosts_dir, host_data):
+    if request.get('hosts_dir') != hosts_dir:
+        return {'error': 'server is running for another hosts directory'}
+    choices = tabcomplete.completions(hosts_dir, request['current'], request['previous'], request['comp_line'], host_data.index())
+    return {'choices': choices}
+
+def receive_request(conn):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data)
+
+def create_socket(path):
+    os.makedirs(path.parent, mode=0o700, exist_ok=True)
+    # Check if there is already a server listening
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(str(path))
+        probe.close()
+        return None
+    except FileNotFoundError:
+        pass
+    except ConnectionRefusedError:
+        # socket of a server that is no longer running
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(str(path))
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+    return server
+
+def serve(hosts_dir):
+    path = tabcomplete.server_socket_path()
+    try:
+        server = create_socket(path)
+    except OSError as e:
+        print("Error: Could not create the completion server socket " + str(path) + ": " + str(e), file=sys.stderr)
+        sys.exit(1)
+    if server is None:
+        print("The completion server is already running", file=sys.stderr)
+        sys.exit(0)
+    host_data = HostData(hosts_dir)
+    # Remove the socket also when being terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    conn.settimeout(5)
+                    response = handle_request(receive_request(conn), hosts_dir, host_data)
+                except Exception as e:
+                    # Do not stop the server, the client will fall back to its own completion
+                    response = {'error': str(e)}
+                try:
+                    conn.sendall(json.dumps(response).encode())
+                except OSError:
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
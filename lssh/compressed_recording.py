@@ -0,0 +1,160 @@
+import gzip, lzma, os, queue, subprocess, sys, threading
+
+try:
+    from compression import zstd # Python 3.14 or newer
+    def open_zstd(path, mode):
+        return zstd.open(path, mode, level=3) if 'w' in mode else zstd.open(path, mode)
+except ImportError:
+    try:
+        import zstandard
+        def open_zstd(path, mode):
+            return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=3)) if 'w' in mode else zstandard.open(path, mode)
+    except ImportError:
+        open_zstd = None
+
+# Session recordings that are compressed while they are written.
+#
+# The recording command (script) writes to named pipes in the recording
+# directory. For each pipe, a reader thread passes the data through a bounded
+# queue to a writer thread that compresses it into the recording file, so a
+# slow compressor does not directly block the terminal output.
+#
+# For replaying, the files are decompressed by threads into pipes that are
+# given to the replay command, nothing is unpacked to disk.
+
+CHUNK_SIZE = 65536
+# Maximum number of chunks held in memory per stream
+QUEUE_SIZE = 1024
+
+# compression method: (file suffix, open function)
+methods = {
+    'gzip': ('.gz', lambda path, mode: gzip.open(path, mode, compresslevel=6) if 'w' in mode else gzip.open(path, mode)),
+    'lzma': ('.xz', lambda path, mode: lzma.open(path, mode, preset=1) if 'w' in mode else lzma.open(path, mode)),
+    'zstd': ('.zst', open_zstd),
+}
+
+def available(method):
+    return method in methods and methods[method][1] is not None
+
+def find_file(recording_path, name):
+    '''
+    Find the file name of a recording, it may be compressed with any of the methods.
+    Returns a tuple (path, method) with method None for uncompressed files, or None if not found.
+    '''
+    if os.path.exists(recording_path / name):
+        return (recording_path / name, None)
+    for method in methods:
+        path = recording_path / (name + methods[method][0])
+        if os.path.exists(path):
+            return (path, method)
+    return None
+
+def read_pipe(fifo_path, chunks):
+    try:
+        with open(fifo_path, 'rb', buffering=0) as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.put(chunk)
+    finally:
+        chunks.put(None)
+
+def write_compressed(path, method, chunks):
+    try:
+        with methods[method][1](path, 'wb') as f:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                f.write(chunk)
+    except OSError as e:
+        print("Warning: Could not write session recording " + str(path) + ": " + str(e), file=sys.stderr)
+    # Keep on reading, so the recording command is not blocked
+    while chunks.get() is not None:
+        pass
+
+def release_pipe(fifo_path):
+    # Let a reader that still waits for the recording command to open the pipe see the end of file
+    try:
+        os.close(os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
+
+def record(recording_path, method, streams, make_command, env):
+    '''
+    Run the recording command with compression of the recorded files.
+
+    streams are the names of the files written by the recording command
+    (for example output and timing), make_command is called with the paths
+    to write them to and returns the command.
+    The files are stored as <name><suffix> in recording_path.
+    Returns the exit code of the command.
+    '''
+    fifo_paths = [recording_path / (name + '.fifo') for name in streams]
+    threads = []
+    try:
+        for name, fifo_path in zip(streams, fifo_paths):
+            os.mkfifo(fifo_path, 0o600)
+            chunks = queue.Queue(QUEUE_SIZE)
+            file_path = recording_path / (name + methods[method][0])
+            threads.append(threading.Thread(target=read_pipe, args=(fifo_path, chunks), daemon=True))
+            threads.append(threading.Thread(target=write_compressed, args=(file_path, method, chunks), daemon=True))
+            threads[-2].start()
+            threads[-1].start()
+        return subprocess.run(make_command(*[str(path) for path in fifo_paths]), env=env).returncode
+    finally:
+        for fifo_path in fifo_paths:
+            release_pipe(fifo_path)
+        for thread in threads:
+            thread.join()
+        for fifo_path in fifo_paths:
+            try:
+                os.unlink(fifo_path)
+            except FileNotFoundError:
+                pass
+
+def decompress_into(path, method, fd):
+    try:
+        with open(fd, 'wb') as dst, methods[method][1](path, 'rb') as src:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+    except (BrokenPipeError, EOFError):
+        # The replay was stopped, or the recording was not finished properly
+        pass
+
+def replay(files, make_command):
+    '''
+    Run the replay command with the given recording files.
+
+    files is a list of (path, method) tuples as returned by find_file.
+    Compressed files are decompressed on the fly into pipes,
+    make_command is called with the paths to read the files from and returns the command.
+    Returns the exit code of the command.
+    '''
+    paths = []
+    pass_fds = []
+    threads = []
+    try:
+        for path, method in files:
+            if method is None:
+                paths.append(str(path))
+                continue
+            read_fd, write_fd = os.pipe()
+            pass_fds.append(read_fd)
+            paths.append('/dev/fd/' + str(read_fd))
+            threads.append(threading.Thread(target=decompress_into, args=(path, method, write_fd), daemon=True))
+            threads[-1].start()
+        process = subprocess.Popen(make_command(*paths), pass_fds=pass_fds)
+        for fd in pass_fds:
+            os.close(fd)
+        pass_fds = []
+        return process.wait()
+    finally:
+        for fd in pass_fds:
+            os.close(fd)
+        for thread in threads:
+            thread.join()
@@ -1,4 +1,5 @@
-import os, re, shlex, subprocess, tempfile
+import bisect, os, re, shlex, subprocess, tempfile
+from lssh.command_whitelist import CommandWhitelist
 
 instruction_whitelist = {
     'addkeystoagent',
@@ -188,12 +189,7 @@ class HostSection():
             return None
         if self.__command is not None:
             cmdtarget_hostname = self.__connectname if self.__connectname is not None else self.__hostname
-            whitelisted = False
-            for user, hostname, command in self.__context["cmd_whitelist"]:
-                if command == self.__command and (user is None or user == self.__username) and (hostname is None or hostname == cmdtarget_hostname):
-                    whitelisted = True
-                    break
-            if not whitelisted:
+            if not self.__context["cmd_whitelist"].allows(self.__command, self.__username, cmdtarget_hostname):
                 display_username = self.__username if self.__username is not None else "<any user>"
                 self.err("Command `" + self.__command + "' (line " + str(self.__command_linenr) + ") is not whitelisted for " + display_username + "@" + cmdtarget_hostname)
 
@@ -209,41 +205,123 @@ class HostSection():
     def get_lines(self):
         return self.__lines
 
-def ssh_check_validity(content, context):
-    fd, path = tempfile.mkstemp()
-    f = open(fd, "w")
+def ssh_tempdir():
+    # Prefer a memory-backed directory for temporary config files
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
+
+def run_ssh_check(content):
+    '''
+    Let ssh parse the given config content.
+
+    Returns a tuple (returncode, error_lines, path), path is the file name
+    under which ssh has read the config, it appears in the error lines.
+    '''
+    if hasattr(os, "memfd_create") and os.path.isdir("/proc/self/fd"):
+        # Keep the config in memory. ssh closes inherited file descriptors,
+        # so it has to open the file via the /proc entry of this process.
+        fd = os.memfd_create("lssh-config")
+        path = "/proc/" + str(os.getpid()) + "/fd/" + str(fd)
+        remove = lambda: os.close(fd)
+        f = open(fd, "w", closefd=False)
+    else:
+        fd, path = tempfile.mkstemp(dir=ssh_tempdir())
+        remove = lambda: os.unlink(path)
+        f = open(fd, "w")
     try:
         with f:
             f.write(content)
         ssh_result = subprocess.run(["ssh", "-TF", path, "-G", "localhost"], capture_output=True)
-        error_lines = ssh_result.stderr.decode().split("\n")
-        # remove the last line, that is most likely empty
-        if error_lines[-1] == "":
-            error_lines = error_lines[0:-1]
-        def remove_prefix(line):
-            if line.startswith(path + ": "):
-                return line[len(path)+2:]
-            elif line.startswith(path + " "):
-                return line[len(path)+1:]
-            return line
-        error_lines = [remove_prefix(line) for line in error_lines]
-        if ssh_result.returncode != 0 and len(error_lines) == 0:
-            error_lines.append("ssh failed to validate the file (exit " + str(ssh_result.returncode) + ") but did not produce error output")
-        context["errors"] += error_lines
     finally:
-        os.unlink(path)
+        remove()
+    error_lines = ssh_result.stderr.decode().split("\n")
+    # remove the last line, that is most likely empty
+    if error_lines[-1] == "":
+        error_lines = error_lines[0:-1]
+    return (ssh_result.returncode, error_lines, path)
+
+def ssh_check_validity(content, context):
+    returncode, error_lines, path = run_ssh_check(content)
+    def remove_prefix(line):
+        if line.startswith(path + ": "):
+            return line[len(path)+2:]
+        elif line.startswith(path + " "):
+            return line[len(path)+1:]
+        return line
+    error_lines = [remove_prefix(line) for line in error_lines]
+    if returncode != 0 and len(error_lines) == 0:
+        error_lines.append("ssh failed to validate the file (exit " + str(returncode) + ") but did not produce error output")
+    context["errors"] += error_lines
 
-def transform_config(content, cmd_whitelist, general_proxy):
+def ssh_check_batch(contents):
+    '''
+    Check the given config file contents with as few ssh runs as possible.
+
+    All contents are concatenated to one config (each one starting with
+    `Host *`, so its leading options are global like in a separate file) and
+    checked by a single ssh run. Error lines of ssh (`<path> line N: ...`) are
+    mapped back to the contents via their line offsets. Only the contents
+    that produced errors are checked again separately, to get exactly the
+    errors that ssh_check_validity reports for them.
+
+    Returns a list with the error lines for each content.
+    '''
+    results = [[] for content in contents]
+    pending = list(range(len(contents)))
+    while len(pending) > 0:
+        parts = []
+        starts = []
+        line_nr = 1
+        for idx in pending:
+            content = contents[idx]
+            if not content.endswith("\n"):
+                content += "\n"
+            parts.append("Host *\n" + content)
+            starts.append(line_nr + 1)
+            line_nr += 1 + content.count("\n")
+        returncode, error_lines, path = run_ssh_check("".join(parts))
+        if returncode == 0 and len(error_lines) == 0:
+            break
+        error_pattern = re.compile("^" + re.escape(path) + ":? line ([0-9]+):")
+        summary_pattern = re.compile("^" + re.escape(path) + ": terminating, [0-9]+ bad configuration options$")
+        error_positions = set()
+        unmapped = False
+        for line in error_lines:
+            m = error_pattern.match(line)
+            if m:
+                pos = bisect.bisect_right(starts, int(m.group(1))) - 1
+                error_positions.add(max(pos, 0))
+            elif not summary_pattern.match(line):
+                unmapped = True
+        if unmapped or len(error_positions) == 0:
+            # The errors cannot be assigned to a content, check them one by one
+            error_positions = set(range(len(pending)))
+        for pos in error_positions:
+            context = {"errors": []}
+            ssh_check_validity(contents[pending[pos]], context)
+            results[pending[pos]] = context["errors"]
+        # ssh might have stopped at the last error, check the remaining contents again
+        pending = pending[max(error_positions) + 1:]
+    return results
+
+def transform_config(content, cmd_whitelist, general_proxy, check_ssh=True):
     '''
     Check if the given ssh config file content is valid and safe.
     The content is given as a single string.
+    cmd_whitelist is a CommandWhitelist or a list of (user, hostname, command) rows.
     A config is not safe, if it contains instructions that may cause harm to the user.
     An example is executing commands via 'Match exec ...'
 
+    With check_ssh=False, the final check by ssh itself is skipped.
+    The caller has to do it, for example with ssh_check_batch.
+
     A tuple (errors, content) is returned.
     errors is an empty array and content contains the modified file content, if the check was successful.
     errors is a non-empty array and content is None if errors occurred.
     '''
+    if not isinstance(cmd_whitelist, CommandWhitelist):
+        cmd_whitelist = CommandWhitelist(cmd_whitelist)
     lines = content.split("\n")
     context = {
         "cmd_whitelist": cmd_whitelist,
@@ -287,7 +365,7 @@ def transform_config(content, cmd_whitelist, general_proxy):
         line_nr += 1
     cur_section.finalize()
 
-    if len(context["errors"]) == 0:
+    if len(context["errors"]) == 0 and check_ssh:
         ssh_check_validity(content, context)
 
     if len(context["errors"]) > 0:
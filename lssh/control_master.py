@@ -0,0 +1,180 @@
+import hashlib, os, re, shlex, stat, subprocess, sys, time
+from pathlib import Path
+from lssh import xdg_compat
+
+# Connection sharing for jumphosts and repeated connections (ssh ControlMaster)
+#
+# ControlPath is not allowed in the host configuration (see config_validation),
+# so lssh manages the sockets itself, in a private directory of the user.
+# It passes ControlMaster, ControlPath and ControlPersist for the target host.
+# Options on the command line of ssh do not apply to the jumphosts, so the
+# proxy chain is given as nested ProxyCommand instead of ProxyJump, each hop
+# with its own master socket. Following connections through the same jumphost
+# reuse its connection and skip the key exchange.
+
+safe_name_pattern = re.compile('^[A-Za-z0-9._@+-]+$')
+
+# ssh creates the socket with a random suffix of 17 characters before renaming it,
+# and the path of a unix socket is limited to 104 bytes on some systems
+MAX_SOCKET_PATH = 86
+# Seconds to wait for a master opened in advance
+OPEN_TIMEOUT = 15
+
+def socket_dir():
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return Path(os.environ['XDG_RUNTIME_DIR']) / 'lssh' / 'masters'
+    return xdg_compat.cache_home() / 'lssh' / 'masters'
+
+def ensure_socket_dir():
+    '''
+    Create the socket directory if needed. It must be a directory owned by
+    the user, only accessible by the user, otherwise other users could
+    redirect the connections. Raises OSError if it cannot be used.
+    '''
+    path = socket_dir()
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise OSError(str(path) + " is not a directory owned by the user")
+    if st.st_mode & 0o077 != 0:
+        os.chmod(path, 0o700)
+    return path
+
+def socket_path(directory, destination):
+    # Readable socket names where possible, long or unusual names are hashed
+    if safe_name_pattern.match(destination) and not destination.endswith('.host') and len(str(directory / destination)) <= MAX_SOCKET_PATH:
+        return directory / destination
+    name = 'h-' + hashlib.sha1(destination.encode()).hexdigest()[0:24]
+    name_file = directory / (name + '.host')
+    if not os.path.exists(name_file):
+        with open(name_file, 'w') as f:
+            f.write(destination)
+    return directory / name
+
+def ssh_destination(host):
+    # Jumphosts may be given as [user@]host[:port]. The destination is passed
+    # after --, so a name from the config can never be taken as an option.
+    return 'ssh://' + host if ':' in host else host
+
+def escape(text):
+    return text.replace('%', '%%')
+
+def master_options(directory, destination, persist):
+    path = escape(str(socket_path(directory, destination)))
+    return ['-o', 'ControlMaster=auto', '-o', 'ControlPath=' + path, '-o', 'ControlPersist=' + str(persist)]
+
+def proxy_command(directory, hops, persist):
+    # ProxyCommand through the last hop, which is reached through the hops before it.
+    # The ssh running a ProxyCommand expands its % tokens, so everything but
+    # the tokens for the next hop is escaped once more on each nesting level.
+    command = ['ssh'] + master_options(directory, hops[-1], persist)
+    if len(hops) > 1:
+        command += ['-o', 'ProxyCommand=' + proxy_command(directory, hops[0:-1], persist)]
+    return shlex.join([escape(arg) for arg in command] + ['-W', '%h:%p', '--', escape(ssh_destination(hops[-1]))])
+
+def ssh_options(destination, hops, persist, user_options, share_destination=True):
+    '''
+    The ssh options for a shared connection to destination ([user@]host)
+    through the jumphosts hops (first hop first).
+    user_options are the -o options given on the command line, which take precedence.
+    If share_destination is False, only the connections to the hops are shared.
+    Returns an empty list if the connection cannot be shared.
+    '''
+    given = {re.split('[=\\s]', option.strip(), 1)[0].lower() for option in user_options}
+    if given & {'controlmaster', 'controlpath', 'controlpersist'}:
+        return []
+    try:
+        directory = ensure_socket_dir()
+        options = master_options(directory, destination, persist) if share_destination else []
+        if len(hops) > 0 and not given & {'proxyjump', 'proxycommand'} and not any(',' in hop for hop in hops):
+            options += ['-o', 'ProxyCommand=' + proxy_command(directory, hops, persist)]
+    except OSError as e:
+        print("Warning: Connection sharing is not possible: " + str(e), file=sys.stderr)
+        return []
+    return options
+
+def masters():
+    # Iterate over the (destination, socket path) of all master sockets
+    try:
+        entries = sorted(os.scandir(socket_dir()), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if not stat.S_ISSOCK(entry.stat(follow_symlinks=False).st_mode):
+            continue
+        destination = entry.name
+        try:
+            with open(entry.path + '.host') as f:
+                destination = f.read()
+        except FileNotFoundError:
+            pass
+        yield (destination, Path(entry.path))
+
+def control_command(path, destination, command):
+    result = subprocess.run(['ssh', '-o', 'ControlPath=' + escape(str(path)), '-O', command, '--', ssh_destination(destination)], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return result.returncode, (result.stdout + result.stderr).strip()
+
+def open_master(destination, persist, env, cancelled=None):
+    '''
+    Start a master for destination in the background, unless one is running.
+    This opens a connection before it is needed, so ssh must not ask anything:
+    it fails if a password or a confirmation would be needed.
+    The connection attempt is stopped when the event cancelled is set.
+    '''
+    directory = ensure_socket_dir()
+    path = socket_path(directory, destination)
+    if os.path.exists(path):
+        if control_command(path, destination, 'check')[0] == 0:
+            return
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    command = ['ssh', '-o', 'BatchMode=yes', '-f', '-N'] + master_options(directory, destination, persist) + ['--', ssh_destination(destination)]
+    process = subprocess.Popen(command, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + OPEN_TIMEOUT
+    # ssh exits when the master runs in the background (-f)
+    while True:
+        try:
+            process.wait(timeout=0.05)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+        if (cancelled is not None and cancelled.is_set()) or time.monotonic() > deadline:
+            process.kill()
+            process.wait()
+            return
+
+def remove_stale(path):
+    for stale in (path, Path(str(path) + '.host')):
+        try:
+            os.unlink(stale)
+        except FileNotFoundError:
+            pass
+
+def main(close, substrings):
+    '''
+    List the running masters, or close those whose destination contains all substrings.
+    '''
+    count = 0
+    for destination, path in masters():
+        if not all(substring in destination for substring in substrings):
+            continue
+        returncode, message = control_command(path, destination, 'check')
+        if returncode != 0:
+            # The master has ended without removing its socket
+            remove_stale(path)
+            continue
+        count += 1
+        if close:
+            returncode, message = control_command(path, destination, 'exit')
+            if returncode != 0:
+                print("Warning: Could not close the master for " + destination + ": " + message, file=sys.stderr)
+            continue
+        m = re.search('pid=([0-9]+)', message)
+        print(destination + ("" if m is None else "  (pid " + m.group(1) + ")"))
+    if close:
+        print("Closed " + str(count) + " masters")
+    elif count == 0:
+        print("No masters are running")
+    sys.exit(0)
@@ -0,0 +1,105 @@
+import asyncio, contextlib, sys, time
+
+# Runs a command on all matching hosts in parallel (lssh --exec)
+#
+# The ssh processes are started by an asyncio scheduler. The number of
+# parallel connections is limited globally and per jumphost, because sshd
+# only accepts a few unauthenticated connections at once (MaxStartups).
+# The output is forwarded line by line, prefixed with the host name.
+
+MAX_PARALLEL = 32
+MAX_PER_JUMPHOST = 8
+# Longer output lines are forwarded in pieces
+LINE_LIMIT = 2**20
+
+async def forward_lines(stream, prefix, output):
+    piece = False
+    while True:
+        try:
+            line = await stream.readuntil(b'\n')
+            if piece and line == b'\n':
+                # End of a line that was forwarded in pieces
+                piece = False
+                continue
+            piece = False
+        except asyncio.IncompleteReadError as e:
+            # Last line without a newline
+            line = e.partial
+        except asyncio.LimitOverrunError as e:
+            # Line longer than LINE_LIMIT, forward what has been read so far
+            line = await stream.readexactly(e.consumed)
+            piece = True
+        if not line:
+            return
+        output.write(prefix + line.decode(errors='replace').rstrip('\r\n') + '\n')
+        output.flush()
+
+async def run_host(host, command, env, limits, prefix, results):
+    # Acquire the limits of the jumphosts first (in a fixed order, so there are no deadlocks),
+    # so a host waiting for a busy jumphost does not block a global slot
+    async with contextlib.AsyncExitStack() as stack:
+        for limit in limits:
+            await stack.enter_async_context(limit)
+        start = time.monotonic()
+        try:
+            process = await asyncio.create_subprocess_exec(*command, env=env, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, limit=LINE_LIMIT)
+        except OSError as e:
+            sys.stderr.write(prefix + "Could not start ssh: " + str(e) + '\n')
+            results[host] = (None, 0.0)
+            return
+        try:
+            await asyncio.gather(forward_lines(process.stdout, prefix, sys.stdout), forward_lines(process.stderr, prefix, sys.stderr))
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        results[host] = (returncode, time.monotonic() - start)
+
+async def run_all(targets, parallel, env, results):
+    global_limit = asyncio.Semaphore(parallel)
+    jumphost_limits = {}
+    width = max(len(host) for host, jumphosts, command in targets)
+    tasks = []
+    for host, jumphosts, command in targets:
+        limits = []
+        for jumphost in sorted(set(jumphosts)):
+            if jumphost not in jumphost_limits:
+                jumphost_limits[jumphost] = asyncio.Semaphore(MAX_PER_JUMPHOST)
+            limits.append(jumphost_limits[jumphost])
+        limits.append(global_limit)
+        tasks.append(run_host(host, command, env, limits, host.ljust(width) + ' | ', results))
+    await asyncio.gather(*tasks)
+
+def print_summary(targets, results):
+    width = max([len(host) for host, jumphosts, command in targets] + [4])
+    print()
+    print("host".ljust(width) + "  exit      time")
+    failed = 0
+    for host, jumphosts, command in targets:
+        if host not in results:
+            returncode, duration = ("-", None)
+        else:
+            returncode, duration = results[host]
+        if returncode != 0:
+            failed += 1
+        exit_text = "-" if returncode is None else str(returncode)
+        time_text = "-" if duration is None else "%.2f s" % duration
+        print(host.ljust(width) + "  " + exit_text.rjust(4) + "  " + time_text.rjust(8))
+    print(str(len(targets)) + " hosts, " + str(failed) + " failed")
+    return failed
+
+def main(targets, parallel, env):
+    '''
+    Run the commands and print the summary.
+
+    targets is a list of (host, jumphosts, command) tuples, command is the
+    complete ssh command line. Exits with 0 if the command succeeded on all hosts.
+    '''
+    results = {}
+    try:
+        asyncio.run(run_all(targets, parallel, env, results))
+    except KeyboardInterrupt:
+        print("Interrupted, the remaining hosts were skipped", file=sys.stderr)
+    failed = print_summary(targets, results)
+    sys.exit(0 if failed == 0 else 1)
@@ -0,0 +1,95 @@
+import math, os, sqlite3, time
+from lssh import xdg_compat
+
+# Usage store of the connected hosts, to rank the hosts by frecency
+#
+# Each successful connect adds 1 to the score of the host, and the scores
+# decay exponentially with HALF_LIFE. Instead of the score, the database
+# stores rank = log2(score) + time / HALF_LIFE, which does not change while
+# the score decays: the order of the hosts is the order of the ranks and the
+# current score is 2 ** (rank - now / HALF_LIFE). Only the MAX_HOSTS hosts
+# with the highest ranks are kept.
+#
+# The database is written in WAL mode, so concurrent lssh processes can read
+# while another one records a connect.
+
+HALF_LIFE = 7 * 24 * 3600
+MAX_HOSTS = 1000
+# Number of hosts looked up with one query
+QUERY_CHUNK = 500
+
+def store_path():
+    return xdg_compat.data_home() / 'lssh' / 'usage.sqlite'
+
+def open_store():
+    path = store_path()
+    os.makedirs(path.parent, exist_ok=True)
+    conn = sqlite3.connect(str(path), timeout=10)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS usage (host TEXT PRIMARY KEY, rank REAL NOT NULL, count INTEGER NOT NULL, last_used REAL NOT NULL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS usage_rank ON usage (rank)')
+    return conn
+
+def record(host, now=None):
+    '''
+    Add a successful connect to host.
+    '''
+    if now is None:
+        now = time.time()
+    conn = open_store()
+    try:
+        # Take the write lock before reading, so concurrent connects are not lost
+        conn.isolation_level = None
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT rank, count FROM usage WHERE host = ?', (host,)).fetchone()
+            score = 1.0 if row is None else 2 ** (row[0] - now / HALF_LIFE) + 1
+            count = 1 if row is None else row[1] + 1
+            conn.execute('INSERT OR REPLACE INTO usage VALUES (?, ?, ?, ?)', (host, math.log2(score) + now / HALF_LIFE, count, now))
+            conn.execute('DELETE FROM usage WHERE host NOT IN (SELECT host FROM usage ORDER BY rank DESC LIMIT ?)', (MAX_HOSTS,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
+
+def scores(hosts, now=None):
+    '''
+    The current scores of the hosts (names, like the keys of a dict of hosts)
+    that have been connected to, other hosts are not contained.
+    '''
+    if now is None:
+        now = time.time()
+    path = store_path()
+    if not path.exists():
+        return {}
+    conn = open_store()
+    try:
+        if len(hosts) > MAX_HOSTS:
+            # The store is smaller than the list of hosts
+            rows = [row for row in conn.execute('SELECT host, rank FROM usage') if row[0] in hosts]
+        else:
+            names = list(hosts)
+            rows = []
+            for i in range(0, len(names), QUERY_CHUNK):
+                chunk = names[i:i + QUERY_CHUNK]
+                rows += conn.execute('SELECT host, rank FROM usage WHERE host IN (' + ','.join('?' * len(chunk)) + ')', chunk).fetchall()
+    finally:
+        conn.close()
+    return {host: 2 ** (rank - now / HALF_LIFE) for host, rank in rows}
+
+def dominant(host_scores, factor):
+    '''
+    The host whose score is at least factor times the score of every other
+    host (and at least factor), or None.
+    '''
+    if len(host_scores) == 0:
+        return None
+    ranked = sorted(host_scores.items(), key=lambda item: item[1], reverse=True)
+    best, best_score = ranked[0]
+    if best_score < factor:
+        return None
+    if len(ranked) > 1 and best_score < factor * ranked[1][1]:
+        return None
+    return best
@@ -0,0 +1,259 @@
+import curses
+from bisect import bisect_left
+
+# Dialogs to select a host (or a recording), drawn directly with curses.
+#
+# The customers are listed on the left, the hosts of the highlighted customer
+# on the right (pick_list shows a single list). Only the visible rows are
+# drawn, so customers with thousands of hosts do not slow down the
+# navigation. Typing filters the focused list:
+# every space-separated word has to be contained in the entry (case-insensitive).
+# The lowercase entries are prepared once per list, and a longer filter only
+# checks the entries that matched the shorter one.
+#
+# Keys:
+#   up, down, page up/down, home, end    move
+#   right, tab, enter on a customer      go to the hosts of the customer
+#   left, backspace with empty filter    back to the customers
+#   enter on a host                      select the host
+#   typing, backspace                    change the filter of the focused list
+#   escape                               clear the filter, or quit if it is empty
+#
+# Letters filter the list, so q does not quit (use escape).
+
+ESCAPE_DELAY = 25
+
+class FilteredList:
+    '''
+    The entries of one list with the filter, the cursor and the scroll position.
+    Positions refer to the matching entries, indexes to all entries.
+    '''
+    def __init__(self, entries, haystack):
+        self.entries = entries
+        self.haystack = haystack
+        self.query = ''
+        # Matching indexes (ascending) of the current query and its prefixes
+        self.matches = {'': range(len(entries))}
+        self.cursor = 0
+        self.top = 0
+
+    def visible(self):
+        return self.matches[self.query]
+
+    def current(self):
+        # Index of the entry at the cursor or None if nothing matches
+        visible = self.visible()
+        return visible[self.cursor] if self.cursor < len(visible) else None
+
+    def set_query(self, query):
+        selected = self.current()
+        if query not in self.matches:
+            # Every entry that matches the query also matches each prefix of it
+            base = max((q for q in self.matches if query.startswith(q)), key=len)
+            base_words = base.lower().split()
+            haystack = self.haystack
+            matches = self.matches[base]
+            for word in query.lower().split():
+                if word not in base_words:
+                    matches = [idx for idx in matches if word in haystack[idx]]
+            self.matches[query] = matches
+        # Keep only the results that can be used for further typing or deleting
+        self.matches = {q: matches for q, matches in self.matches.items() if query.startswith(q)}
+        self.query = query
+        visible = self.visible()
+        pos = len(visible) if selected is None else bisect_left(visible, selected)
+        self.cursor = pos if pos < len(visible) and visible[pos] == selected else 0
+        self.top = 0
+
+    def move(self, delta):
+        self.cursor = max(0, min(self.cursor + delta, len(self.visible()) - 1))
+
+    def scroll(self, height):
+        # Keep the cursor inside the visible rows
+        if self.cursor < self.top:
+            self.top = self.cursor
+        elif self.cursor >= self.top + height:
+            self.top = self.cursor - height + 1
+        self.top = max(0, min(self.top, len(self.visible()) - height))
+
+def draw_list(screen, lst, x, width, height, heading, focused):
+    lst.scroll(height)
+    visible = lst.visible()
+    title = heading + ' (' + str(len(visible)) + '/' + str(len(lst.entries)) + ')'
+    if lst.query:
+        title += ' filter: ' + lst.query
+    screen.addnstr(0, x, title, width - 1, curses.A_BOLD)
+    for row, pos in enumerate(range(lst.top, min(lst.top + height, len(visible)))):
+        attr = curses.A_NORMAL
+        if pos == lst.cursor:
+            attr = curses.A_REVERSE if focused else curses.A_UNDERLINE
+        screen.addnstr(row + 1, x, ' ' + lst.entries[visible[pos]].ljust(width - 2), width - 1, attr)
+
+def draw(screen, state):
+    screen.erase()
+    height, width = screen.getmaxyx()
+    if height < 3 or width < 20:
+        return
+    list_height = height - 2
+    left_width = width // 3 if state["columns"] == 2 else width
+    customers = state["customers"]
+    draw_list(screen, customers, 0, left_width, list_height, state["heading_left"], state["focus"] == 'left')
+    hosts = state["hosts"]()
+    if hosts is not None:
+        draw_list(screen, hosts, left_width, width - left_width, list_height, state["heading_right"], state["focus"] == 'right')
+    help_text = 'type to filter, enter: select, esc: clear filter / quit'
+    screen.addnstr(height - 1, 0, help_text, width - 1, curses.A_DIM)
+
+def handle_key(state, key, page):
+    # Returns True if the dialog is finished
+    lst = state["customers"] if state["focus"] == 'left' else state["hosts"]()
+    if key in (curses.KEY_UP, curses.KEY_DOWN, curses.KEY_PPAGE, curses.KEY_NPAGE):
+        lst.move({curses.KEY_UP: -1, curses.KEY_DOWN: 1, curses.KEY_PPAGE: -page, curses.KEY_NPAGE: page}[key])
+    elif key == curses.KEY_HOME:
+        lst.cursor = 0
+    elif key == curses.KEY_END:
+        lst.move(len(lst.visible()))
+    elif key in ('\n', '\r', curses.KEY_ENTER):
+        if lst.current() is None:
+            return False
+        if state["focus"] == 'left' and state["columns"] == 2:
+            state["focus"] = 'right'
+            return False
+        state["result"] = (state["customers"].current(), lst.current())
+        return True
+    elif key in (curses.KEY_RIGHT, '\t'):
+        if state["focus"] == 'left' and state["columns"] == 2 and lst.current() is not None:
+            state["focus"] = 'right'
+    elif key == curses.KEY_LEFT:
+        state["focus"] = 'left'
+    elif key in (curses.KEY_BACKSPACE, '\x7f', '\b'):
+        if lst.query:
+            lst.set_query(lst.query[0:-1])
+        else:
+            state["focus"] = 'left'
+    elif key == '\x1b':
+        if not lst.query:
+            return True
+        lst.set_query('')
+    elif type(key) is str and key.isprintable():
+        lst.set_query(lst.query + key)
+    return False
+
+def pick(options, displaynames, heading_left, heading_right, on_highlight=None, preselect=None):
+    '''
+    Let the user choose an element from a two-layer hierarchical option tree.
+
+    Arguments:
+      options:       A list of tuples in the form (heading, child_elems) where
+                     heading is a string naming one main node and child_elems
+                     is a list of its subnodes.
+      displaynames:  Names to show for the headings, by heading
+      heading_left:  Header string for the main node option list
+      heading_right: Header string for the subnodes option list
+      on_highlight:  Optional function that is called with (idx1, idx2) when
+                     another subnode is highlighted. While the main nodes are
+                     navigated, it is the subnode highlighted on the right.
+      preselect:     Optional tuple (idx1, idx2) of the subnode to highlight first
+
+    Return:          Returns a tuple (idx1, idx2) where idx1 is the index of
+                     the selected main node and idx2 is the index of the
+                     selected subnode.
+                     Or returns None if the user aborted during selection.
+    '''
+    def display(heading):
+        return displaynames[heading] if heading in displaynames else heading
+    # Sort by display names (case-insensitive sort if possible)
+    order = sorted(range(len(options)), key=lambda idx: (display(options[idx][0]).lower(), display(options[idx][0]), options[idx][0]))
+    names = [display(options[idx][0]) for idx in order]
+    # The file name of a customer can be searched as well
+    customers = FilteredList(names, [names[pos].lower() + '\0' + options[idx][0].lower() for pos, idx in enumerate(order)])
+    host_lists = {}
+    def hosts():
+        # Host list of the highlighted customer, created when it is shown first
+        pos = customers.current()
+        if pos is None:
+            return None
+        if pos not in host_lists:
+            entries = options[order[pos]][1]
+            host_lists[pos] = FilteredList(entries, [entry.lower() for entry in entries])
+        return host_lists[pos]
+    if preselect is not None:
+        customers.cursor = order.index(preselect[0])
+        hosts().cursor = preselect[1]
+    state = {
+        "columns": 2,
+        "customers": customers,
+        "hosts": hosts,
+        "focus": 'left',
+        "heading_left": heading_left,
+        "heading_right": heading_right,
+        "result": None,
+    }
+
+    def highlight():
+        host_list = hosts()
+        if on_highlight is None or host_list is None or host_list.current() is None:
+            return None
+        return (order[customers.current()], host_list.current())
+
+    if not run(state, highlight, on_highlight):
+        return None
+    pos, host_idx = state["result"]
+    return (order[pos], host_idx)
+
+def pick_list(options, heading):
+    '''
+    Let the user choose an element from a list.
+
+    Arguments:
+      options:  A list of strings containing the options
+      heading:  A header string to show above the dialog
+
+    Return:     Returns the index of the chosen element or None if the user
+                aborted during selection.
+    '''
+    state = {
+        "columns": 1,
+        "customers": FilteredList(options, [option.lower() for option in options]),
+        "hosts": lambda: None,
+        "focus": 'left',
+        "heading_left": heading,
+        "heading_right": None,
+        "result": None,
+    }
+    if not run(state, lambda: None, None):
+        return None
+    return state["result"][0]
+
+def run(state, highlight, on_highlight):
+    # Show the dialog until an entry is selected (returns True) or the user quits.
+    # on_highlight is called with the result of highlight() whenever it changes.
+    def loop(screen):
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+        if hasattr(curses, 'set_escdelay'):
+            curses.set_escdelay(ESCAPE_DELAY)
+        highlighted = None
+        while True:
+            draw(screen, state)
+            screen.refresh()
+            current = highlight()
+            if current is not None and current != highlighted:
+                highlighted = current
+                on_highlight(*current)
+            try:
+                key = screen.get_wch()
+            except curses.error:
+                continue
+            if key == curses.KEY_RESIZE:
+                continue
+            if handle_key(state, key, max(screen.getmaxyx()[0] - 3, 1)):
+                return
+
+    try:
+        curses.wrapper(loop)
+    except KeyboardInterrupt:
+        return False
+    return state["result"] is not None
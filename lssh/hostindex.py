@@ -0,0 +1,413 @@
+import mmap, os, struct
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from lssh import xdg_compat
+
+# Compact binary representation of the parsed host configuration.
+# It is written by hostlist.load_config and read via mmap, so selecting a host
+# does not need to parse all config files again.
+#
+# Layout (native byte order, all offsets relative to the start of the file):
+#   header
+#   string offsets   (string_count + 1) x uint32, relative to the string blob
+#   string blob      utf-8 encoded strings, each one stored only once
+#   hosts            host_count x (name, customer, jumphost, alternate jumphosts) string ids, sorted by name,
+#                    the alternate jumphosts are stored as one comma-separated string
+#   keyword starts   (host_count + 1) x uint32, index into the keyword ids
+#   keyword ids      string ids of all host keywords
+#   displaynames     displayname_count x (basename, displayname) string ids
+#   name trigrams    postings (see below) of the lowercase display names to host ids
+#   keywords         keyword_count x string id of all distinct keywords
+#   keyword hosts    postings from keywords (by position) to host ids
+#   keyword trigrams postings of the keywords (case-sensitive) to keyword positions
+#
+# A postings section consists of key_count sorted uint64 keys,
+# (key_count + 1) x uint32 start positions and the sorted uint32 ids.
+# Every section starts at a multiple of 8.
+
+MAGIC = b'LSSHIDX\0'
+VERSION = 3
+HEADER = struct.Struct('=8sId' + 22 * 'I')
+NO_STRING = 0xffffffff
+
+class HostEntry:
+    def __init__(self, display_name, customer):
+        self.display_name = display_name
+        self.customer = customer
+        self.keywords = set()
+        self.jumphost = None
+        self.alternate_jumps = []
+    def add_customer_as_keyword(self):
+        self.keywords.add(self.customer)
+
+def index_path():
+    return xdg_compat.cache_home() / 'lssh' / 'hosts.idx'
+
+def uint_array(values):
+    result = array('I', values)
+    assert result.itemsize == 4
+    return result
+
+def trigrams(s):
+    # Each trigram is encoded as one integer (code points have at most 21 bits)
+    return {(ord(s[i]) << 42) | (ord(s[i + 1]) << 21) | ord(s[i + 2]) for i in range(len(s) - 2)}
+
+def postings_sections(postings):
+    # postings: dict from integer key to a collection of ids
+    keys = array('Q', sorted(postings))
+    assert keys.itemsize == 8
+    starts = uint_array([0])
+    ids = uint_array([])
+    for key in keys:
+        ids.extend(sorted(postings[key]))
+        starts.append(len(ids))
+    return [keys.tobytes(), starts.tobytes(), ids.tobytes()]
+
+def serialize(entries, displaynames, stamp):
+    string_ids = {}
+    strings = []
+    def string_id(s):
+        if s is None:
+            return NO_STRING
+        idx = string_ids.get(s)
+        if idx is None:
+            idx = len(strings)
+            string_ids[s] = idx
+            strings.append(s.encode())
+        return idx
+
+    names = sorted(entries)
+    hosts = uint_array([])
+    keyword_starts = uint_array([0])
+    keyword_ids = uint_array([])
+    for name in names:
+        entry = entries[name]
+        alternate_jumps = ','.join(entry.alternate_jumps) if len(entry.alternate_jumps) > 0 else None
+        hosts.extend((string_id(name), string_id(entry.customer), string_id(entry.jumphost), string_id(alternate_jumps)))
+        keyword_ids.extend(sorted(string_id(k) for k in entry.keywords))
+        keyword_starts.append(len(keyword_ids))
+    displayname_ids = uint_array([])
+    for basename in sorted(displaynames):
+        displayname_ids.extend((string_id(basename), string_id(displaynames[basename])))
+
+    # Substring search structures
+    name_trigrams = {}
+    keyword_hosts = {}
+    for host_id, name in enumerate(names):
+        for trigram in trigrams(name.lower()):
+            name_trigrams.setdefault(trigram, []).append(host_id)
+        for keyword in entries[name].keywords:
+            keyword_hosts.setdefault(string_id(keyword), []).append(host_id)
+    keywords = uint_array(sorted(keyword_hosts))
+    keyword_trigrams = {}
+    for keyword_pos, keyword_id in enumerate(keywords):
+        for trigram in trigrams(strings[keyword_id].decode()):
+            keyword_trigrams.setdefault(trigram, []).append(keyword_pos)
+
+    string_offsets = uint_array([0])
+    for s in strings:
+        string_offsets.append(string_offsets[-1] + len(s))
+    blob = b''.join(strings)
+    blob += b'\0' * (-len(blob) % 4)
+
+    sections = [string_offsets.tobytes(), blob, hosts.tobytes(), keyword_starts.tobytes(), keyword_ids.tobytes(), displayname_ids.tobytes()]
+    sections += postings_sections(name_trigrams)
+    sections.append(keywords.tobytes())
+    sections += postings_sections({pos: keyword_hosts[keyword_id] for pos, keyword_id in enumerate(keywords)})
+    sections += postings_sections(keyword_trigrams)
+    offsets = []
+    pos = HEADER.size
+    for i, section in enumerate(sections):
+        padding = -len(section) % 8
+        sections[i] = section + b'\0' * padding
+        offsets.append(pos)
+        pos += len(section) + padding
+    header = HEADER.pack(MAGIC, VERSION, stamp, len(strings), len(names), len(displaynames),
+                         len(name_trigrams), len(keywords), len(keyword_trigrams), *offsets)
+    return b''.join([header] + sections)
+
+def write_index(path, entries, displaynames, stamp):
+    data = serialize(entries, displaynames, stamp)
+    os.makedirs(path.parent, exist_ok=True)
+    # Write to a temporary file first, readers may have mapped the old index
+    tmp_path = path.with_name(path.name + '.' + str(os.getpid()) + '.tmp')
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+class HostIndex(Mapping):
+    '''
+    Read-only mapping from display name to HostEntry, backed by a buffer in the
+    format created by serialize(). Entries are decoded on access.
+    '''
+    def __init__(self, buf):
+        if len(buf) < HEADER.size:
+            raise ValueError("host index is truncated")
+        (magic, version, self.stamp, string_count, host_count, displayname_count,
+         name_trigram_count, keyword_count, keyword_trigram_count,
+         strings_pos, blob_pos, hosts_pos, keyword_starts_pos, keyword_ids_pos, displaynames_pos,
+         name_trigrams_pos, name_trigram_starts_pos, name_trigram_ids_pos, keywords_pos,
+         keyword_hosts_pos, keyword_host_starts_pos, keyword_host_ids_pos,
+         keyword_trigrams_pos, keyword_trigram_starts_pos, keyword_trigram_ids_pos) = HEADER.unpack_from(buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("unsupported host index format")
+        self.__buf = buf
+        view = memoryview(buf)
+        def uints(pos, count):
+            return view[pos:pos + 4 * count].cast('I')
+        def postings(keys_pos, starts_pos, ids_pos, count):
+            starts = uints(starts_pos, count + 1)
+            return Postings(view[keys_pos:keys_pos + 8 * count].cast('Q'), starts, uints(ids_pos, starts[count]))
+        self.__name_trigrams = postings(name_trigrams_pos, name_trigram_starts_pos, name_trigram_ids_pos, name_trigram_count)
+        self.__keywords = uints(keywords_pos, keyword_count)
+        self.__keyword_hosts = postings(keyword_hosts_pos, keyword_host_starts_pos, keyword_host_ids_pos, keyword_count)
+        self.__keyword_trigrams = postings(keyword_trigrams_pos, keyword_trigram_starts_pos, keyword_trigram_ids_pos, keyword_trigram_count)
+        self.__string_offsets = uints(strings_pos, string_count + 1)
+        self.__blob_pos = blob_pos
+        self.__hosts = uints(hosts_pos, 4 * host_count)
+        self.__keyword_starts = uints(keyword_starts_pos, host_count + 1)
+        self.__keyword_ids = uints(keyword_ids_pos, self.__keyword_starts[host_count])
+        self.__displaynames = uints(displaynames_pos, 2 * displayname_count)
+        self.__host_count = host_count
+        self.__names = {}
+        self.__strings = {}
+        self.__keyword_bitsets = {}
+        self.__substring_bitsets = {}
+
+    def string(self, idx):
+        if idx == NO_STRING:
+            return None
+        s = self.__strings.get(idx)
+        if s is None:
+            start = self.__blob_pos + self.__string_offsets[idx]
+            end = self.__blob_pos + self.__string_offsets[idx + 1]
+            s = self.__buf[start:end].decode()
+            self.__strings[idx] = s
+        return s
+
+    def name(self, host_id):
+        return self.string(self.__hosts[4 * host_id])
+
+    def host_keywords(self, host_id):
+        keyword_ids = self.__keyword_ids[self.__keyword_starts[host_id]:self.__keyword_starts[host_id + 1]]
+        return [self.string(k) for k in keyword_ids]
+
+    def entry(self, host_id):
+        name_id, customer_id, jumphost_id, alternate_jumps_id = self.__hosts[4 * host_id:4 * host_id + 4]
+        entry = HostEntry(self.string(name_id), self.string(customer_id))
+        entry.jumphost = self.string(jumphost_id)
+        if alternate_jumps_id != NO_STRING:
+            entry.alternate_jumps = self.string(alternate_jumps_id).split(',')
+        entry.keywords = set(self.host_keywords(host_id))
+        return entry
+
+    def find(self, name):
+        # Hosts are sorted by name, so a binary search is possible
+        names = _NameSequence(self)
+        host_id = bisect_left(names, name)
+        if host_id < len(names) and names[host_id] == name:
+            return host_id
+        return None
+
+    def matching_keywords(self, substring):
+        '''
+        Returns the positions of all keywords that contain the given substring (case-sensitive).
+        '''
+        if len(substring) >= 3:
+            candidates = self.__keyword_trigrams.intersection(trigrams(substring))
+        else:
+            candidates = range(len(self.__keywords))
+        return [pos for pos in candidates if substring in self.string(self.__keywords[pos])]
+
+    def keyword_hosts(self, keyword_pos):
+        # sorted ids of all hosts with the keyword at the given position
+        return self.__keyword_hosts.ids(keyword_pos)
+
+    def bitset(self, host_ids):
+        # Python integer with the bits of the given host ids set
+        bits = bytearray((self.__host_count + 7) // 8)
+        for host_id in host_ids:
+            bits[host_id >> 3] |= 1 << (host_id & 7)
+        return int.from_bytes(bits, 'little')
+
+    def all_bitset(self):
+        return (1 << self.__host_count) - 1
+
+    def bitset_ids(self, bits):
+        # Sorted list of the host ids in the given bitset
+        ids = []
+        for byte_pos, byte in enumerate(bits.to_bytes((self.__host_count + 7) // 8, 'little')):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        ids.append(8 * byte_pos + bit)
+        return ids
+
+    def bitset_keywords(self, bits, host_ids):
+        '''
+        Set of all keywords of the given hosts.
+        host_ids must contain the same hosts as the bitset bits.
+        '''
+        if len(host_ids) * 4 < len(self.__keywords):
+            return {keyword for host_id in host_ids for keyword in self.host_keywords(host_id)}
+        # Many hosts, check the hosts of each keyword instead
+        return {self.string(self.__keywords[pos]) for pos in range(len(self.__keywords)) if self.keyword_bitset(pos) & bits}
+
+    def keyword_bitset(self, keyword_pos):
+        bits = self.__keyword_bitsets.get(keyword_pos)
+        if bits is None:
+            bits = self.bitset(self.keyword_hosts(keyword_pos))
+            self.__keyword_bitsets[keyword_pos] = bits
+        return bits
+
+    def substring_bitset(self, substring):
+        '''
+        Bitset of all hosts whose display name or one of whose keywords contains
+        the given substring (both case-sensitive). Results are kept in memory.
+        '''
+        bits = self.__substring_bitsets.get(substring)
+        if bits is not None:
+            return bits
+        if len(substring) >= 3 and substring.isascii():
+            candidates = self.__name_trigrams.intersection(trigrams(substring.lower()))
+            names = self.names()
+            bits = self.bitset(host_id for host_id in candidates if substring in names[host_id])
+        else:
+            bits = self.bitset(host_id for host_id, name in enumerate(self.names()) if substring in name)
+        for keyword_pos in self.matching_keywords(substring):
+            bits |= self.keyword_bitset(keyword_pos)
+        self.__substring_bitsets[substring] = bits
+        return bits
+
+    def names(self, lower=False):
+        # List of all display names, decoded once per index
+        key = 'lower' if lower else 'names'
+        if key not in self.__names:
+            if lower:
+                self.__names[key] = [name.lower() for name in self.names()]
+            else:
+                self.__names[key] = list(self)
+        return self.__names[key]
+
+    def candidates(self, substrings):
+        '''
+        Find the hosts that may match all given substrings.
+
+        A host matches a substring if its display name contains the substring
+        (case-insensitive) or one of its keywords contains the substring
+        (case-sensitive).
+
+        Returns a set of host ids that is a superset of the matching hosts,
+        so every candidate still needs an exact check. Returns None if
+        no substrings are given (every host is a candidate).
+        '''
+        result = None
+        for substring in substrings:
+            lower = substring.lower()
+            if len(lower) >= 3:
+                hosts = self.__name_trigrams.intersection(trigrams(lower))
+            else:
+                # Too short for the trigrams, check the display names directly
+                hosts = {host_id for host_id, name in enumerate(self.names(lower=True)) if lower in name}
+            for keyword_pos in self.matching_keywords(substring):
+                hosts.update(self.keyword_hosts(keyword_pos))
+            result = hosts if result is None else result & hosts
+        return result
+
+    def displaynames(self):
+        ids = self.__displaynames
+        return {self.string(ids[i]): self.string(ids[i + 1]) for i in range(0, len(ids), 2)}
+
+    def __len__(self):
+        return self.__host_count
+
+    def __iter__(self):
+        for host_id in range(self.__host_count):
+            yield self.name(host_id)
+
+    def items(self):
+        for host_id in range(self.__host_count):
+            entry = self.entry(host_id)
+            yield (entry.display_name, entry)
+
+    def values(self):
+        for host_id in range(self.__host_count):
+            yield self.entry(host_id)
+
+    def __contains__(self, name):
+        return type(name) is str and self.find(name) is not None
+
+    def __getitem__(self, name):
+        host_id = self.find(name) if type(name) is str else None
+        if host_id is None:
+            raise KeyError(name)
+        return self.entry(host_id)
+
+class Postings:
+    # Sorted integer keys, each one with a sorted list of ids
+    def __init__(self, keys, starts, ids):
+        self.__keys = keys
+        self.__starts = starts
+        self.__ids = ids
+        self.__sets = {}
+
+    def ids(self, key_pos):
+        return self.__ids[self.__starts[key_pos]:self.__starts[key_pos + 1]]
+
+    def lookup_set(self, key):
+        # The ids of the given key as set, kept in memory for further lookups
+        result = self.__sets.get(key)
+        if result is None:
+            key_pos = bisect_left(self.__keys, key)
+            if key_pos < len(self.__keys) and self.__keys[key_pos] == key:
+                result = set(self.ids(key_pos))
+            else:
+                result = set()
+            self.__sets[key] = result
+        return result
+
+    def intersection(self, keys):
+        # New set of the ids that appear in the postings of all given keys
+        sets = sorted((self.lookup_set(key) for key in keys), key=len)
+        if len(sets) == 0:
+            return set()
+        return sets[0].intersection(*sets[1:])
+
+class _NameSequence:
+    # Sequence view on the sorted host names, used for the binary search
+    def __init__(self, index):
+        self.__index = index
+    def __len__(self):
+        return len(self.__index)
+    def __getitem__(self, host_id):
+        return self.__index.name(host_id)
+
+def open_index(path, stamp):
+    '''
+    Map the host index at the given path into memory.
+
+    Returns a HostIndex or None if the index does not exist, is damaged or
+    was created for another state of the config files (stamp mismatch).
+    If stamp is None, the state of the config files is not checked.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        # ValueError: the file is empty and cannot be mapped
+        return None
+    try:
+        index = HostIndex(buf)
+    except ValueError:
+        return None
+    if stamp is not None and index.stamp != stamp:
+        return None
+    return index
@@ -1,18 +1,10 @@
-import csv, json, os, pathlib, re, sys
+import csv, fcntl, hashlib, itertools, json, os, pathlib, re, shutil, sys, time
 
-from lssh import config_validation
+from lssh import config_validation, hostindex, profiling, xdg_compat
 from lssh.command_whitelist import load_default_paths
+from lssh.hostindex import HostEntry
 from lssh.tabcomplete import host_cache_path
 
-class HostEntry:
-    def __init__(self, display_name, customer):
-        self.display_name = display_name
-        self.customer = customer
-        self.keywords = set()
-        self.jumphost = None
-    def add_customer_as_keyword(self):
-        self.keywords.add(self.customer)
-
 def update_display_name_cache(entries, newest_timestamp, suppress_errors):
     try:
         cache_stat = os.stat(host_cache_path())
@@ -31,87 +23,423 @@ def update_display_name_cache(entries, newest_timestamp, suppress_errors):
             if not suppress_errors:
                 print("Warning: failed to create hostlist cache file: " + str(e), file=sys.stderr)
 
-def load_config(path, suppress_errors=False):
-    entries = {}
-    displaynames = {}
-    cur_host = [None] # array is used to make the value mutable for the handle_line function
+def update_host_index(entries, displaynames, newest_timestamp, suppress_errors):
+    if hostindex.open_index(hostindex.index_path(), newest_timestamp) is not None:
+        # Index is up to date
+        return
+    try:
+        hostindex.write_index(hostindex.index_path(), entries, displaynames, newest_timestamp)
+    except Exception as e:
+        if not suppress_errors:
+            print("Warning: failed to create host index file: " + str(e), file=sys.stderr)
+
+def parse_cache_path():
+    return xdg_compat.cache_home() / 'lssh' / 'parsed_hosts.json'
+
+def scan_config_files(path):
+    '''
+    List the config files (*.txt) in the given directory with a single scandir pass.
+
+    Returns a tuple (newest_timestamp, files, files_path) where files is a
+    sorted list of (filename, stat) tuples and newest_timestamp is the newest
+    modification time of the directory and these files.
+    files_path is the resolved directory that contains the files. The hosts
+    directory is a symlink to the current generation (see import_new_config),
+    it is resolved once so all files are read from the same generation.
+    '''
+    path = os.path.realpath(path)
+    newest_timestamp = os.stat(path).st_mtime
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.endswith(".txt"):
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # File has been removed in the meantime
+                    continue
+                files.append((entry.name, stat))
+                newest_timestamp = max(newest_timestamp, stat.st_mtime)
+    files.sort()
+    return (newest_timestamp, files, path)
+
+def config_timestamp(path):
+    # Same timestamp as calculated by load_config, but without reading the files
+    return scan_config_files(path)[0]
+
+def load_indexed_config(path, suppress_errors=False):
+    '''
+    Like load_config, but use the host index if it is up to date.
+    The returned hosts are a mapping from display name to HostEntry.
+    '''
+    index = hostindex.open_index(hostindex.index_path(), config_timestamp(path))
+    if index is not None:
+        return (index, index.displaynames())
+    return load_config(path, suppress_errors)
+
+# Matches all lines that are relevant for the hostlist, most lines of a config file
+# (ordinary ssh options) are rejected by this single match.
+# The name of the last matched group tells which kind of line was found.
+config_line_pattern = re.compile(
+    '\\s*(?:'
+    'host\\s+(?P<host>\\S+)\\s*'
+    '|proxyjump\\s+(?P<proxyjump>\\S+)\\s*'
+    '|#\\s*lssh:(?:'
+    '(?P<file>file)?keywords\\s(?P<keywords>.*)'
+    '|displayname\\s+(?P<displayname>\\S.*)'
+    '|assignedcustomer\\s+(?P<assignedcustomer>\\S.*)'
+    '|alternatejump\\s+(?P<alternatejump>\\S.*)'
+    '))$', re.IGNORECASE)
+
+# Alternate jumphosts are passed to ssh -J, so they must be plain [user@]host[:port] names
+jump_name_pattern = re.compile('^[A-Za-z0-9_.@:\\[\\]][A-Za-z0-9_.@:\\[\\]-]*$')
+
+def parse_config_file(name, basename):
+    '''
+    Parse the lssh relevant parts of one config file.
+
+    Returns a dict with the keys
+      hosts:          list of [display_name, customer, jumphost, keywords, alternate_jumps]
+                      for all hosts of this file (keywords without the file keywords)
+      file_keywords:  list of keywords for all hosts of this file
+      displayname:    the displayname of this file or None
+    '''
+    cur_host = [None] # array is used to make the value mutable for the handler functions
     file_displayname = [None]
-    def handle_line(line, customer, file_keywords, file_hosts):
-        m = re.match('^\\s*Host\\s+([\\S]+)\\s*$', line, re.IGNORECASE)
-        if m:
-            hostname = m.group(1)
-            if '*' not in hostname and '?' not in hostname:
-                cur_host[0] = HostEntry(hostname, customer)
-                if hostname not in entries:
-                    entries[hostname] = cur_host[0]
-                file_hosts.append(cur_host[0])
-        m = re.match('^\\s*proxyjump\\s+([\\S]+)\\s*$', line, re.IGNORECASE)
-        if m and cur_host[0] is not None and cur_host[0].jumphost is None:
-            cur_host[0].jumphost = m.group(1)
-        m = re.match('^\\s*#\\s*lssh:(file)?keywords\\s(.*)$', line, re.IGNORECASE)
-        if m:
-            keywords_str = m.group(2)
-            keywords = {k.strip() for k in keywords_str.split(',')}
-            if m.group(1) == 'file':
-                # keywords for the entire file
-                file_keywords |= keywords
-            elif cur_host[0] is not None:
-                # keywords only for this host
-                cur_host[0].keywords |= keywords
-        m = re.match('^\\s*#\\s*lssh:displayname\\s+(\\S.*)$', line, re.IGNORECASE)
-        if m and file_displayname[0] is None:
-            file_displayname[0] = m.group(1)
-        m = re.match('^\\s*#\\s*lssh:assignedcustomer\\s+(\\S.*)$', line, re.IGNORECASE)
-        if m and cur_host[0] is not None:
-            name = m.group(1)
+    file_keywords = {basename}
+    file_hosts = []
+    def handle_host(m):
+        hostname = m.group('host')
+        if '*' not in hostname and '?' not in hostname:
+            cur_host[0] = HostEntry(hostname, basename)
+            file_hosts.append(cur_host[0])
+    def handle_proxyjump(m):
+        if cur_host[0] is not None and cur_host[0].jumphost is None:
+            cur_host[0].jumphost = m.group('proxyjump')
+    def handle_keywords(m):
+        keywords = {k.strip() for k in m.group('keywords').split(',')}
+        if m.group('file') == 'file':
+            # keywords for the entire file
+            file_keywords.update(keywords)
+        elif cur_host[0] is not None:
+            # keywords only for this host
+            cur_host[0].keywords |= keywords
+    def handle_displayname(m):
+        if file_displayname[0] is None:
+            file_displayname[0] = m.group('displayname')
+    def handle_assignedcustomer(m):
+        if cur_host[0] is not None:
+            name = m.group('assignedcustomer')
             # allow both: with or without file ending .txt
             if name.endswith(".txt"):
                 name = name[0:-4]
             cur_host[0].customer = name
-    files = os.listdir(path)
-    files.sort()
-    newest_timestamp = os.stat(path).st_mtime
-    for filename in files:
-        name = path + "/" + filename
-        if filename.endswith(".txt") and os.path.isfile(name):
-            basename = filename[0:-4]
-            with open(name, "r") as f:
-                cur_host[0] = None
-                file_keywords = {basename}
-                file_hosts = []
-                file_displayname = [None]
-                for line in f:
-                    handle_line(line, basename, file_keywords, file_hosts)
+    def handle_alternatejump(m):
+        if cur_host[0] is not None:
+            for name in m.group('alternatejump').split(','):
+                name = name.strip()
+                if jump_name_pattern.match(name) and name not in cur_host[0].alternate_jumps:
+                    cur_host[0].alternate_jumps.append(name)
+    handlers = {
+        'host': handle_host,
+        'proxyjump': handle_proxyjump,
+        'keywords': handle_keywords,
+        'displayname': handle_displayname,
+        'assignedcustomer': handle_assignedcustomer,
+        'alternatejump': handle_alternatejump,
+    }
+    match_line = config_line_pattern.match
+    with open(name, "r") as f:
+        for line in f:
+            m = match_line(line)
+            if m:
+                handlers[m.lastgroup](m)
+    return {
+        "hosts": [[h.display_name, h.customer, h.jumphost, list(h.keywords), h.alternate_jumps] for h in file_hosts],
+        "file_keywords": list(file_keywords),
+        "displayname": file_displayname[0],
+    }
+
+def load_parse_cache(path):
+    # Returns the cached parse results of the files in path, by filename
+    try:
+        with open(parse_cache_path(), "r") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if cache.get("version") != 2 or cache.get("path") != path:
+        return {}
+    return cache["files"]
+
+def store_parse_cache(path, files, suppress_errors):
+    cache_path = parse_cache_path()
+    tmp_path = cache_path.with_name(cache_path.name + "." + str(os.getpid()) + ".tmp")
+    try:
+        os.makedirs(cache_path.parent, exist_ok=True)
+        with open(tmp_path, "w") as f:
+            json.dump({"version": 2, "path": path, "files": files}, f)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        if not suppress_errors:
+            print("Warning: failed to create the parsed hosts cache file: " + str(e), file=sys.stderr)
+
+def load_config(path, suppress_errors=False):
+    entries = {}
+    displaynames = {}
+    newest_timestamp, files, files_path = scan_config_files(path)
+    # Only parse files that are new or changed since the last run
+    cached = load_parse_cache(path)
+    parsed_files = {}
+    cache_changed = len(cached) != len(files)
+    for filename, stat in files:
+        basename = filename[0:-4]
+        key = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+        parsed = cached.get(filename)
+        if parsed is None or parsed["key"] != key:
+            parsed = parse_config_file(files_path + "/" + filename, basename)
+            parsed["key"] = key
+            cache_changed = True
+        parsed_files[filename] = parsed
+        file_keywords = set(parsed["file_keywords"])
+        for display_name, customer, jumphost, keywords, alternate_jumps in parsed["hosts"]:
+            if display_name not in entries:
+                entry = HostEntry(display_name, customer)
+                entry.jumphost = jumphost
+                entry.alternate_jumps = alternate_jumps
                 # add the file keywords to all hosts of this file
-                for host in file_hosts:
-                    host.keywords |= file_keywords
-                # store the displayname
-                if file_displayname[0] is not None:
-                    displaynames[basename] = file_displayname[0]
-            stat = os.stat(name)
-            newest_timestamp = max(newest_timestamp, stat.st_mtime)
+                entry.keywords = set(keywords) | file_keywords
+                entries[display_name] = entry
+        # store the displayname
+        if parsed["displayname"] is not None:
+            displaynames[basename] = parsed["displayname"]
     for entry in entries.values():
         entry.add_customer_as_keyword()
-    update_display_name_cache(entries, newest_timestamp, suppress_errors)
+    with profiling.phase('cache_update'):
+        if cache_changed:
+            store_parse_cache(path, parsed_files, suppress_errors)
+        update_display_name_cache(entries, newest_timestamp, suppress_errors)
+        update_host_index(entries, displaynames, newest_timestamp, suppress_errors)
 
     return (entries, displaynames)
 
-def import_new_config(srcpath, dstpath, general_proxy):
-    srcpath = pathlib.Path(srcpath)
+# Number of config files that are checked by a single ssh run
+ssh_batch_size = 200
+
+def transform_content(content, cmd_whitelist, general_proxy):
+    # The ssh check is done afterwards for many files at once, see transform_files
+    return config_validation.transform_config(content, cmd_whitelist, general_proxy, check_ssh=False)
+
+def validation_cache_path():
+    return xdg_compat.cache_home() / 'lssh' / 'validation_cache.json'
+
+def validation_key(cmd_whitelist, general_proxy):
+    # Everything besides the file content that influences the validation result.
+    # The validator itself is included, so an lssh update invalidates the cache.
+    validator_stat = os.stat(config_validation.__file__)
+    data = [[list(row) for row in cmd_whitelist], general_proxy, validator_stat.st_size, validator_stat.st_mtime_ns]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+def load_validation_cache(key):
+    # Returns the cached transformed contents of valid files, by content hash
+    try:
+        with open(validation_cache_path(), "r") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if cache.get("version") != 1 or cache.get("key") != key:
+        return {}
+    return cache["files"]
+
+def store_validation_cache(key, files, verbose=False):
+    # The cache only saves time, so a failure is reported in verbose mode only
+    cache_path = validation_cache_path()
+    tmp_path = cache_path.with_name(cache_path.name + "." + str(os.getpid()) + ".tmp")
+    try:
+        os.makedirs(cache_path.parent, exist_ok=True)
+        with open(tmp_path, "w") as f:
+            json.dump({"version": 1, "key": key, "files": files}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        if verbose:
+            print("Warning: failed to create the validation cache file: " + str(e), file=sys.stderr)
+
+def transform_files(srcpath, srcfiles, cmd_whitelist, general_proxy, jobs, verbose=False):
+    '''
+    Validate and transform the given files (see config_validation.transform_config)
+    using up to jobs worker processes.
+
+    The files that pass the lssh checks are then checked by ssh in batches,
+    so that ssh is not started once per file.
+    Files whose content has been validated successfully before (with the same
+    command whitelist and general_proxy) are taken from the validation cache.
+
+    Returns the (errors, content) tuples in the order of srcfiles.
+    '''
+    contents = []
+    for name in srcfiles:
+        with open(srcpath / name, "r") as f:
+            contents.append(f.read())
+    hashes = [hashlib.sha256(content.encode()).hexdigest() for content in contents]
+    key = validation_key(cmd_whitelist, general_proxy)
+    cached = load_validation_cache(key)
+    results = [None] * len(contents)
+    misses = []
+    for idx, content_hash in enumerate(hashes):
+        if content_hash in cached:
+            results[idx] = ([], cached[content_hash])
+        else:
+            misses.append(idx)
+    if verbose:
+        print("Validation cache: " + str(len(contents) - len(misses)) + " hits, " + str(len(misses)) + " misses")
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(misses))
+    if jobs <= 1:
+        executor = None
+        run_map = map
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        run_map = executor.map
+    try:
+        transformed = run_map(transform_content, [contents[idx] for idx in misses], itertools.repeat(cmd_whitelist), itertools.repeat(general_proxy))
+        for idx, result in zip(misses, transformed):
+            results[idx] = result
+        valid = [idx for idx in misses if len(results[idx][0]) == 0]
+        # Give every worker at least one batch
+        batch_size = max(1, min(ssh_batch_size, -(-len(valid) // max(jobs, 1))))
+        batches = [valid[i:i+batch_size] for i in range(0, len(valid), batch_size)]
+        batch_errors = run_map(config_validation.ssh_check_batch, [[contents[idx] for idx in batch] for batch in batches])
+        for batch, errors in zip(batches, batch_errors):
+            for idx, file_errors in zip(batch, errors):
+                if len(file_errors) > 0:
+                    results[idx] = (file_errors, None)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # Keep only the successfully validated current files in the cache
+    new_cache = {}
+    for content_hash, (errors, content) in zip(hashes, results):
+        if len(errors) == 0:
+            new_cache[content_hash] = content
+    if new_cache != cached:
+        store_validation_cache(key, new_cache, verbose)
+    return results
+
+# The validated hosts directory is a symlink to a generation directory inside
+# <hosts>.generations. An import builds a complete new generation and then
+# replaces the symlink atomically, so readers (lssh and ssh itself) always see
+# a consistent set of files.
+
+def generations_path(dstpath):
+    return dstpath.with_name(dstpath.name + ".generations")
+
+def new_generation_path(dstpath):
+    return generations_path(dstpath) / ("gen-" + str(time.time_ns()))
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_synced(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+
+def point_to_generation(dstpath, generation):
+    # Replace the symlink dstpath atomically with a link to the generation
+    tmp_link = dstpath.with_name(dstpath.name + ".new")
+    try:
+        os.unlink(tmp_link)
+    except FileNotFoundError:
+        pass
+    os.symlink(os.path.relpath(generation, dstpath.parent), tmp_link)
+    os.replace(tmp_link, dstpath)
+    fsync_dir(dstpath.parent)
+
+def migrate_to_generations(dstpath):
+    # Turn a plain hosts directory (from older lssh versions or the installer) into the first generation
+    if os.path.islink(dstpath) or not os.path.isdir(dstpath):
+        return
+    generation = new_generation_path(dstpath)
+    os.makedirs(generation.parent, exist_ok=True)
+    os.rename(dstpath, generation)
+    point_to_generation(dstpath, generation)
+
+def remove_old_generations(dstpath, keep):
+    generations = generations_path(dstpath)
+    for name in os.listdir(generations):
+        if name not in keep:
+            shutil.rmtree(generations / name, ignore_errors=True)
+
+def import_new_config(srcpath, dstpath, general_proxy, jobs=None, verbose=False):
+    '''
+    Validate the config files of srcpath and import them to dstpath.
+
+    Concurrent imports are serialized by a lock on <dstpath>.lock. An import
+    that has been waiting for the lock is skipped, if another import has
+    started after it was requested, because that one has already imported
+    the current config.
+    '''
+    requested = time.time()
     dstpath = pathlib.Path(dstpath)
+    with open(dstpath.with_name(dstpath.name + ".lock"), "a+") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # The lock file contains the start time and exit code of the last import
+        lock_file.seek(0)
+        try:
+            last_started, last_exit_code = lock_file.read().split()
+            last_started = float(last_started)
+            last_exit_code = int(last_exit_code)
+        except ValueError:
+            last_started = None
+        if last_started is not None and last_started > requested:
+            if verbose:
+                print("The config has just been imported by another lssh process")
+            exit(last_exit_code)
+        started = time.time()
+        exit_code = import_generation(pathlib.Path(srcpath), dstpath, general_proxy, jobs, verbose)
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(repr(started) + " " + str(exit_code) + "\n")
+    exit(exit_code)
+
+def import_generation(srcpath, dstpath, general_proxy, jobs, verbose):
+    # Build a new generation with the validated files of srcpath and switch dstpath to it.
+    # Returns the exit code for import_new_config.
     srcfiles = [name for name in os.listdir(srcpath) if name.endswith(".txt") and os.path.isfile(srcpath / name)]
     srcfiles.sort()
-    dstfiles = [name for name in os.listdir(dstpath) if name.endswith(".txt") and os.path.isfile(dstpath / name)]
+    migrate_to_generations(dstpath)
+    if os.path.isdir(dstpath):
+        current = pathlib.Path(os.path.realpath(dstpath))
+        dstfiles = [name for name in os.listdir(current) if name.endswith(".txt") and os.path.isfile(current / name)]
+    else:
+        current = None
+        dstfiles = []
 
     contents = {}
     error_files = set()
     errors = []
     cmd_whitelist = load_default_paths()
 
-    for name in srcfiles:
-        with open(srcpath / name, "r") as f:
-            content = f.read()
-        file_errors, content = config_validation.transform_config(content, cmd_whitelist, general_proxy)
+    results = transform_files(srcpath, srcfiles, cmd_whitelist, general_proxy, jobs, verbose)
+    for name, (file_errors, content) in zip(srcfiles, results):
         if len(file_errors) > 0:
             error_files.add(name)
             errors += [name + ": " + e for e in file_errors]
@@ -123,32 +451,52 @@ def import_new_config(srcpath, dstpath, general_proxy):
         print("Could not completely import the new config because of " + ("this error" if len(errors) == 1 else "these errors"), file=sys.stderr)
         print("Files containing errors will not be updated.", file=sys.stderr)
 
-    # Write new config to destination dir
-    for name in srcfiles:
-        if name not in error_files:
-            try:
-                with open(dstpath / name, "r+") as f:
-                    # First check, if the file did actually change
-                    # Simply overwriting would change the file's modification date, resulting in cache-rebuilds
-                    content = f.read()
-                    if content != contents[name]:
-                        f.seek(0)
-                        f.truncate()
-                        f.write(contents[name])
-            except FileNotFoundError:
-                # File does not exist yet, just create it
-                with open(dstpath / name, "w") as f:
-                    f.write(contents[name])
-
-    # Delete files from destination that were removed in source
-    for name in set(dstfiles) - set(srcfiles):
-        os.unlink(dstpath / name)
+    # Write new config to a new generation directory
+    generation = new_generation_path(dstpath)
+    os.makedirs(generation)
+    generation_files = set()
+    changed = False
+    swapped = False
+    try:
+        for name in srcfiles:
+            if name in error_files:
+                # Keep the previous version of files containing errors
+                if name in dstfiles:
+                    os.link(current / name, generation / name)
+                    generation_files.add(name)
+                continue
+            old_content = None
+            if name in dstfiles:
+                with open(current / name, "r") as f:
+                    old_content = f.read()
+            if old_content == contents[name]:
+                # Link unchanged files, a new file would change the modification date, resulting in cache-rebuilds
+                os.link(current / name, generation / name)
+            else:
+                write_synced(generation / name, contents[name])
+                changed = True
+            generation_files.add(name)
+        # Files that were removed in source are not part of the new generation
+        if changed or generation_files != set(dstfiles):
+            fsync_dir(generation)
+            point_to_generation(dstpath, generation)
+            swapped = True
+    finally:
+        if not swapped:
+            shutil.rmtree(generation, ignore_errors=True)
+    # Keep the previous generation for readers that are still using it
+    keep = set()
+    if swapped:
+        keep.add(generation.name)
+    if current is not None:
+        keep.add(current.name)
+    remove_old_generations(dstpath, keep)
 
     if len(errors) > 0:
-        exit(1)
-    exit(0)
+        return 1
+    return 0
 
-def validate_config(srcdir, general_proxy):
+def validate_config(srcdir, general_proxy, jobs=None, verbose=False):
     srcpath = pathlib.Path(srcdir)
     srcfiles = [name for name in os.listdir(srcpath) if name.endswith(".txt") and os.path.isfile(srcpath / name)]
     srcfiles.sort()
@@ -156,10 +504,8 @@ def validate_config(srcdir, general_proxy):
     errors = []
     cmd_whitelist = load_default_paths()
 
-    for name in srcfiles:
-        with open(srcpath / name, "r") as f:
-            content = f.read()
-        file_errors, _ = config_validation.transform_config(content, cmd_whitelist, general_proxy)
+    results = transform_files(srcpath, srcfiles, cmd_whitelist, general_proxy, jobs, verbose)
+    for name, (file_errors, _) in zip(srcfiles, results):
         errors += [name + ": " + e for e in file_errors]
     if len(errors) > 0:
         for error in errors:
@@ -0,0 +1,159 @@
+import asyncio, json, os, time
+from lssh import xdg_compat
+from lssh.control_master import ssh_destination
+
+# Chooses the fastest of several equivalent jumphosts (# lssh:alternatejump)
+#
+# The address of each candidate is resolved by `ssh -G`, then TCP connections
+# to all candidates are opened at the same time. The first candidate that
+# accepts the connection is the fastest one, the remaining probes are cancelled.
+# The results are kept for CACHE_TTL seconds, so following connections (and
+# --exec on many hosts) do not probe again. Candidates that are reached through
+# another jumphost or a ProxyCommand cannot be probed from here and are not chosen.
+
+# Seconds to wait for a connection to the jumphosts
+PROBE_TIMEOUT = 0.5
+# Seconds to wait for `ssh -G`
+RESOLVE_TIMEOUT = 2
+# Seconds the probe results are reused
+CACHE_TTL = 300
+
+def cache_path():
+    return xdg_compat.cache_home() / 'lssh' / 'jump_latency.json'
+
+def load_cache():
+    try:
+        with open(cache_path(), 'r') as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if type(cache) is not dict or cache.get("version") != 1:
+        return {}
+    return cache["hosts"]
+
+def store_cache(hosts):
+    path = cache_path()
+    tmp_path = path.with_name(path.name + '.' + str(os.getpid()) + '.tmp')
+    try:
+        os.makedirs(path.parent, exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump({"version": 1, "hosts": hosts}, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        # The cache only saves some probes
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+async def resolve(candidate):
+    # Returns [hostname, port] of the candidate, or None if it cannot be connected to directly
+    try:
+        process = await asyncio.create_subprocess_exec('ssh', '-G', '--', ssh_destination(candidate), stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    except OSError:
+        return None
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), RESOLVE_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return None
+    if process.returncode != 0:
+        return None
+    settings = {}
+    for line in output.decode(errors='replace').splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            settings[parts[0].lower()] = parts[1]
+    if settings.get('proxyjump', 'none') != 'none' or settings.get('proxycommand', 'none') != 'none':
+        return None
+    try:
+        return [settings['hostname'], int(settings.get('port', '22'))]
+    except (KeyError, ValueError):
+        return None
+
+async def probe(address):
+    # Returns the seconds until the connection was accepted, or None if it failed
+    start = time.monotonic()
+    try:
+        reader, writer = await asyncio.open_connection(address[0], address[1])
+    except OSError:
+        return None
+    latency = time.monotonic() - start
+    writer.close()
+    return latency
+
+async def probe_all(addresses, timeout, results):
+    # Probe the candidates (dict to address) until the first one answers or timeout is reached,
+    # the latencies of the finished probes are stored in results (None for failed ones)
+    tasks = {asyncio.ensure_future(probe(address)): candidate for candidate, address in addresses.items()}
+    deadline = time.monotonic() + timeout
+    pending = set(tasks)
+    try:
+        while len(pending) > 0:
+            done, pending = await asyncio.wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+                break
+            for task in done:
+                results[tasks[task]] = task.result()
+            if any(results[tasks[task]] is not None for task in done):
+                break
+        if timeout >= PROBE_TIMEOUT:
+            # Not answered in time
+            for task in pending:
+                results[tasks[task]] = None
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def measure(candidates, entries):
+    unresolved = [candidate for candidate in candidates if "address" not in entries[candidate]]
+    for candidate, address in zip(unresolved, await asyncio.gather(*[resolve(candidate) for candidate in unresolved])):
+        entries[candidate]["address"] = address
+    results = {}
+    addresses = {}
+    for candidate in candidates:
+        if "latency" in entries[candidate]:
+            results[candidate] = entries[candidate]["latency"]
+        elif entries[candidate]["address"] is None:
+            results[candidate] = None
+        else:
+            addresses[candidate] = entries[candidate]["address"]
+    if len(addresses) > 0:
+        # A probe that takes longer than a known latency cannot win
+        timeout = min([PROBE_TIMEOUT] + [latency for latency in results.values() if latency is not None])
+        await probe_all(addresses, timeout, results)
+    return results
+
+def describe(candidate, entries, results):
+    if candidate not in results:
+        return candidate + " slower"
+    if results[candidate] is not None:
+        return candidate + " %.1f ms" % (1000 * results[candidate])
+    return candidate + (" not probed" if entries[candidate]["address"] is None else " unreachable")
+
+def fastest(candidates, verbose=False):
+    '''
+    Probe the jumphosts candidates ([user@]host[:port] names, as given to ssh -J).
+    Returns the fastest reachable candidate, the first one if several are
+    equally fast, or None if none of them could be reached.
+    '''
+    now = time.time()
+    stored = load_cache()
+    cache = {name: entry for name, entry in stored.items() if type(entry) is dict and now - entry.get("time", 0) < CACHE_TTL}
+    entries = {candidate: dict(cache.get(candidate, {"time": now})) for candidate in candidates}
+    results = asyncio.run(measure(candidates, entries))
+    for candidate in candidates:
+        if candidate in results and "latency" not in entries[candidate]:
+            entries[candidate] = {"time": now, "address": entries[candidate]["address"], "latency": results[candidate]}
+        if "address" in entries[candidate]:
+            cache[candidate] = entries[candidate]
+    if cache != stored:
+        store_cache(cache)
+    if verbose:
+        print("Jumphost probes: " + ", ".join(describe(candidate, entries, results) for candidate in candidates))
+    reachable = [candidate for candidate in candidates if results.get(candidate) is not None]
+    if len(reachable) == 0:
+        return None
+    return min(reachable, key=lambda candidate: results[candidate])
@@ -5,16 +5,29 @@
 # Load only necessary modules to minimize the reaction time when user presses tab
 # Especially do not load cli when called for completion
 
-import sys
+import sys, time
+from lssh import profiling
 
 DEFAULT = {}
 def main(hosts_dir, update_hosts, cmd_whitelist_func = DEFAULT, attributes={}):
     if len(sys.argv) >= 2 and sys.argv[1] == '__complete__':
+        if profiling.requested():
+            profiling.enable('complete')
+        started = time.perf_counter()
         from lssh import tabcomplete
+        profiling.add('import', started)
         tabcomplete.main(hosts_dir)
+    elif len(sys.argv) >= 2 and sys.argv[1] == '__complete_server__':
+        from lssh import complete_server
+        complete_server.serve(hosts_dir)
     else:
         if cmd_whitelist_func is not DEFAULT:
             print("Warning: The third argument of main, cmd_whitelist_func, is no longer in use. (removed in version 0.5.0)", file=sys.stderr)
             print("Please update your lssh executable and remove this argument, otherwise this will become a hard error in future versions.", file=sys.stderr)
+        if profiling.requested():
+            profiling.enable('lssh')
+        # Includes the import of hostlist and config_validation
+        started = time.perf_counter()
         from lssh import cli
+        profiling.add('import', started)
         cli.main(hosts_dir, update_hosts, attributes)
@@ -0,0 +1,152 @@
+import os, sys, time
+
+# Timing of the startup phases, from calling lssh until ssh has been started.
+#
+# Enabled by the environment variable LSSH_PROFILE (or lssh -vv). Its value is
+# a comma-separated list of modes: 1 measures the phases only, cprofile also
+# collects a cProfile of the startup (stored in ~/.cache/lssh/profiles) and
+# tracemalloc also reports the memory allocated during the startup. At exit,
+# one JSON line is written to stderr, or appended to the file LSSH_PROFILE_LOG.
+#
+# This module is imported for the tab-completion as well, so it must stay
+# light. When disabled, phase() returns a shared context manager that does nothing.
+
+START = time.perf_counter()
+state = None
+# Phases measured before it is known whether profiling is enabled (see add)
+early_phases = []
+
+class NoPhase:
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        return False
+
+NO_PHASE = NoPhase()
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *exc_info):
+        add(self.name, self.start)
+        return False
+
+def phase(name):
+    '''
+    Context manager measuring the phase name. Repeated phases are summed up.
+    '''
+    if state is None:
+        return NO_PHASE
+    return Phase(name)
+
+def add(name, start):
+    # Add the time from start until now to the phase name. Also used before
+    # enable (for the phases before the arguments are parsed), so it is cheap.
+    duration = time.perf_counter() - start
+    if state is None:
+        early_phases.append((name, duration))
+        return
+    phases = state["phases"]
+    phases[name] = phases.get(name, 0.0) + duration
+
+def event(name):
+    '''
+    Record the time of an event since the start, e.g. when ssh has been started.
+    The cProfile and tracemalloc collection stops at the first event.
+    '''
+    if state is None:
+        return
+    state["events"][name] = time.perf_counter() - START
+    stop_collecting()
+
+def requested():
+    return os.environ.get('LSSH_PROFILE', '') not in ('', '0')
+
+def enable(command):
+    '''
+    Start profiling the run of command (like connect or complete), the result
+    is written at exit. Modes are taken from LSSH_PROFILE (default: 1).
+    '''
+    global state
+    if state is not None:
+        return
+    import atexit
+    modes = {mode.strip() for mode in os.environ.get('LSSH_PROFILE', '1').split(',')}
+    state = {
+        "command": command,
+        "time": time.time() - (time.perf_counter() - START),
+        "phases": {},
+        "events": {},
+        "profile": None,
+        "tracemalloc": False,
+        "result": {},
+    }
+    for name, duration in early_phases:
+        state["phases"][name] = state["phases"].get(name, 0.0) + duration
+    if 'cprofile' in modes:
+        import cProfile
+        state["profile"] = cProfile.Profile()
+        state["profile"].enable()
+    if 'tracemalloc' in modes:
+        import tracemalloc
+        tracemalloc.start()
+        state["tracemalloc"] = True
+    atexit.register(finish)
+
+def stop_collecting():
+    if state["profile"] is not None:
+        state["profile"].disable()
+        from lssh import xdg_compat
+        directory = xdg_compat.cache_home() / 'lssh' / 'profiles'
+        path = directory / (time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(state["time"])) + '_' + str(os.getpid()) + '.prof')
+        try:
+            os.makedirs(directory, exist_ok=True)
+            state["profile"].dump_stats(path)
+            state["result"]["cprofile"] = str(path)
+        except OSError as e:
+            state["result"]["cprofile_error"] = str(e)
+        state["profile"] = None
+    if state["tracemalloc"]:
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[0:10]
+        tracemalloc.stop()
+        state["result"]["memory"] = {
+            "current_kib": current // 1024,
+            "peak_kib": peak // 1024,
+            "top": [str(stat.traceback[0]) + " " + str(stat.size // 1024) + " KiB" for stat in top],
+        }
+        state["tracemalloc"] = False
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 3)
+
+def finish():
+    # Write the JSON line, called at exit
+    import json
+    stop_collecting()
+    line = {
+        "lssh_profile": 1,
+        "command": state["command"],
+        "argv": sys.argv[1:],
+        "pid": os.getpid(),
+        "time": round(state["time"], 3),
+        "total_ms": milliseconds(time.perf_counter() - START),
+        "phases_ms": {name: milliseconds(duration) for name, duration in state["phases"].items()},
+        "events_ms": {name: milliseconds(t) for name, t in state["events"].items()},
+    }
+    line.update(state["result"])
+    text = json.dumps(line) + '\n'
+    log_path = os.environ.get('LSSH_PROFILE_LOG')
+    try:
+        if log_path:
+            with open(log_path, 'a') as f:
+                f.write(text)
+        else:
+            sys.stderr.write(text)
+            sys.stderr.flush()
+    except OSError as e:
+        print("Warning: Could not write the profile: " + str(e), file=sys.stderr)
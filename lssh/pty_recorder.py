@@ -0,0 +1,291 @@
+import codecs, fcntl, json, os, pty, queue, select, shlex, signal, sys, termios, threading, time, tty
+from lssh import compressed_recording, profiling
+
+# Records a session in-process, instead of running the command inside script.
+#
+# The command runs on a new pseudo terminal. The output is relayed to the
+# terminal immediately and collected for the recording: all output that
+# arrives within FLUSH_INTERVAL is written as one timing record, so floods
+# of output do not produce one record per read. The files have the same
+# format as written by `script -et<timing> <output>` (classic timing format),
+# so the replay and search work on both. Optionally, an asciicast v2 file is
+# written in addition, which can be played by asciinema.
+
+# A pseudo terminal returns at most a few KiB per read, larger buffers only cost allocation time
+READ_SIZE = 16384
+# Maximum number of bytes relayed at once
+RELAY_SIZE = 2**18
+# Output arriving within this number of seconds is stored as one timing record
+FLUSH_INTERVAL = 0.01
+# Maximum size of one timing record
+MAX_RECORD_SIZE = 2**20
+BUFFER_SIZE = 2**20
+ASCIICAST_NAME = 'session.cast'
+
+class RecordingFile:
+    '''
+    A file of the recording. Compressed files are written by a thread (see
+    compressed_recording.write_compressed), so a slow compressor does not
+    block the session.
+    '''
+    def __init__(self, path, method=None):
+        self.chunks = None
+        if method is None:
+            self.file = open(path, 'wb', buffering=BUFFER_SIZE)
+        else:
+            self.file = None
+            self.chunks = queue.Queue(compressed_recording.QUEUE_SIZE)
+            self.thread = threading.Thread(target=compressed_recording.write_compressed, args=(path, method, self.chunks), daemon=True)
+            self.thread.start()
+
+    def write(self, data):
+        if self.file is not None:
+            self.file.write(data)
+        else:
+            self.chunks.put(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        else:
+            self.chunks.put(None)
+            self.thread.join()
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+
+def write_output(state, data):
+    if state["stdout"] is None:
+        return
+    try:
+        write_all(state["stdout"], data)
+    except BrokenPipeError:
+        # Output is piped into a command that has ended, keep on recording
+        state["stdout"] = None
+
+def write_input(master, data):
+    # The terminal is not blocking, wait until the session has read the input
+    view = memoryview(data)
+    while len(view) > 0:
+        try:
+            view = view[os.write(master, view):]
+        except BlockingIOError:
+            select.select([], [master], [])
+
+def terminal_size(fd):
+    # Returns the packed window size of the terminal fd or None
+    try:
+        return fcntl.ioctl(fd, termios.TIOCGWINSZ, b'\0' * 8)
+    except OSError:
+        return None
+
+def columns_and_rows(winsize):
+    if winsize is None:
+        return (80, 24)
+    rows, cols = int.from_bytes(winsize[0:2], sys.byteorder), int.from_bytes(winsize[2:4], sys.byteorder)
+    return (cols or 80, rows or 24)
+
+def flush(state):
+    # Write the collected output as one timing record
+    if len(state["pending"]) == 0:
+        return
+    data = b''.join(state["pending"])
+    state["pending"] = []
+    state["pending_size"] = 0
+    state["output"].write(data)
+    state["timing"].write(('%.6f %d\n' % (state["pending_since"] - state["last_record"], len(data))).encode())
+    state["last_record"] = state["pending_since"]
+    if state["asciicast"] is not None:
+        text = state["decoder"].decode(data)
+        if text:
+            write_event(state, state["pending_since"], 'o', text)
+
+def write_event(state, when, kind, data):
+    state["asciicast"].write((json.dumps([round(when - state["start"], 6), kind, data]) + '\n').encode())
+
+def add_output(state, data, now):
+    if len(state["pending"]) == 0:
+        state["pending_since"] = now
+    state["pending"].append(data)
+    state["pending_size"] += len(data)
+    if state["pending_size"] >= MAX_RECORD_SIZE:
+        flush(state)
+
+def resize(state):
+    # Pass a changed size of the terminal on to the session
+    winsize = terminal_size(state["stdin"])
+    if winsize is None:
+        return
+    try:
+        fcntl.ioctl(state["master"], termios.TIOCSWINSZ, winsize)
+    except OSError:
+        return
+    if state["asciicast"] is not None:
+        flush(state)
+        cols, rows = columns_and_rows(winsize)
+        write_event(state, time.monotonic(), 'r', str(cols) + 'x' + str(rows))
+
+def read_available(master):
+    # Read all output that is available at once (a pseudo terminal returns small pieces),
+    # returns None at the end of the session
+    chunks = []
+    size = 0
+    while size < RELAY_SIZE:
+        try:
+            data = os.read(master, READ_SIZE)
+        except BlockingIOError:
+            break
+        except OSError:
+            # EIO: the session has ended
+            data = b''
+        if not data:
+            if len(chunks) == 0:
+                return None
+            break
+        chunks.append(data)
+        size += len(data)
+    return b''.join(chunks)
+
+def relay(state):
+    # Copy the input to the session and the output of the session to the terminal and the recording
+    master = state["master"]
+    fds = [master, state["stdin"], state["wakeup"]]
+    while True:
+        timeout = None
+        if len(state["pending"]) > 0:
+            timeout = max(state["pending_since"] + FLUSH_INTERVAL - time.monotonic(), 0)
+        readable, _, _ = select.select(fds, [], [], timeout)
+        now = time.monotonic()
+        if master in readable:
+            data = read_available(master)
+            if data is None:
+                break
+            write_output(state, data)
+            add_output(state, data, now)
+        if state["wakeup"] in readable:
+            signals = os.read(state["wakeup"], 64)
+            if b'w' in signals:
+                resize(state)
+            if b'c' in signals and child_exited(state):
+                # Processes started in the background (like a persisting ssh master)
+                # may keep the terminal open, so do not wait for its end
+                data = read_available(master)
+                if data:
+                    write_output(state, data)
+                    add_output(state, data, now)
+                break
+        if state["stdin"] in readable:
+            data = os.read(state["stdin"], READ_SIZE)
+            if data:
+                write_input(master, data)
+            else:
+                fds.remove(state["stdin"])
+        if len(state["pending"]) > 0 and now >= state["pending_since"] + FLUSH_INTERVAL:
+            flush(state)
+    flush(state)
+
+def child_exited(state):
+    pid, status = os.waitpid(state["pid"], os.WNOHANG)
+    if pid == 0:
+        return False
+    state["status"] = status
+    return True
+
+def exit_code(status):
+    # Same as script -e: the exit code of the command, or 128 + signal number if it was killed
+    code = os.waitstatus_to_exitcode(status)
+    return 128 - code if code < 0 else code
+
+def record(command, env, recording_path, compression=None, asciicast=False, title=None):
+    '''
+    Run command on a pseudo terminal and record the session in recording_path.
+
+    The output and timing files are compressed with compression (see
+    compressed_recording.methods) if given, the asciicast file is not.
+    Returns the exit code of the command.
+    '''
+    stdin = sys.stdin.fileno()
+    stdout = sys.stdout.fileno()
+    winsize = terminal_size(stdin)
+    suffix = '' if compression is None else compressed_recording.methods[compression][0]
+    cmdline = shlex.join(command)
+    state = {
+        "master": None,
+        "pid": None,
+        "status": None,
+        "stdin": stdin,
+        "stdout": stdout,
+        "output": RecordingFile(recording_path / ('output' + suffix), compression),
+        "timing": RecordingFile(recording_path / ('timing' + suffix), compression),
+        "asciicast": None,
+        "decoder": codecs.getincrementaldecoder('utf-8')(errors='replace'),
+        "pending": [],
+        "pending_size": 0,
+        "pending_since": None,
+        "start": None,
+        "last_record": None,
+    }
+    # The header line is skipped by scriptreplay and the replay of lssh
+    state["output"].write(('Script started on ' + time.strftime('%Y-%m-%d %H:%M:%S%z') + ' [COMMAND="' + cmdline + '"]\n').encode())
+    if asciicast:
+        cols, rows = columns_and_rows(winsize)
+        header = {"version": 2, "width": cols, "height": rows, "timestamp": int(time.time()), "env": {"TERM": env.get("TERM", "")}}
+        if title is not None:
+            header["title"] = title
+        state["asciicast"] = RecordingFile(recording_path / ASCIICAST_NAME)
+        state["asciicast"].write((json.dumps(header) + '\n').encode())
+
+    sys.stdout.flush()
+    pid, master = pty.fork()
+    if pid == 0:
+        # child process, on the new terminal
+        try:
+            if winsize is not None:
+                fcntl.ioctl(0, termios.TIOCSWINSZ, winsize)
+            os.execvpe(command[0], command, env)
+        except OSError as e:
+            print("Error: Could not execute " + command[0] + ": " + str(e), file=sys.stderr)
+        os._exit(127)
+
+    profiling.event('ssh_started')
+    state["master"] = master
+    state["pid"] = pid
+    os.set_blocking(master, False)
+    state["start"] = state["last_record"] = time.monotonic()
+    terminal_settings = None
+    if os.isatty(stdin):
+        terminal_settings = termios.tcgetattr(stdin)
+        tty.setraw(stdin)
+    # The signal handlers only wake up the relay loop, which handles the signals
+    wakeup, wakeup_notify = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+    state["wakeup"] = wakeup
+    def notify(signum, frame):
+        try:
+            os.write(wakeup_notify, b'w' if signum == signal.SIGWINCH else b'c')
+        except BlockingIOError:
+            pass
+    previous_handlers = [signal.signal(signum, notify) for signum in (signal.SIGWINCH, signal.SIGCHLD)]
+    try:
+        if not child_exited(state):
+            relay(state)
+        if state["status"] is None:
+            _, state["status"] = os.waitpid(pid, 0)
+    finally:
+        signal.signal(signal.SIGWINCH, previous_handlers[0])
+        signal.signal(signal.SIGCHLD, previous_handlers[1])
+        os.close(wakeup)
+        os.close(wakeup_notify)
+        if terminal_settings is not None:
+            termios.tcsetattr(stdin, termios.TCSADRAIN, terminal_settings)
+        os.close(master)
+        if state["status"] is None:
+            # Interrupted, the session gets a hangup by closing the terminal
+            _, state["status"] = os.waitpid(pid, 0)
+        code = exit_code(state["status"])
+        state["output"].write(('\nScript done on ' + time.strftime('%Y-%m-%d %H:%M:%S%z') + ' [COMMAND_EXIT_CODE="' + str(code) + '"]\n').encode())
+        for name in ("output", "timing", "asciicast"):
+            if state[name] is not None:
+                state[name].close()
+    return code
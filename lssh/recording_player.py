@@ -0,0 +1,336 @@
+import array, bisect, json, mmap, os, re, select, sys, termios, time, tty
+from lssh import compressed_recording
+
+# Replays session recordings without scriptreplay.
+#
+# The timing file written by script lists the delay and the number of bytes
+# of each chunk of output. It is converted once into an index of the
+# recording time and output offset after each chunk, which is stored next to
+# the recording files. With the index, any position of the recording is found
+# by a binary search: the output up to that position is written at once and
+# the replay continues from there.
+#
+# Keys during the replay (if stdin is a terminal):
+#   space         pause / continue
+#   right, left   jump 10 seconds forward / backward
+#   up, down      double / halve the speed
+#   q             quit
+
+INDEX_NAME = 'timing.index'
+INDEX_VERSION = 1
+SEEK_STEP = 10
+MIN_SPEED = 1 / 64
+MAX_SPEED = 64
+# Maximum number of bytes read and written at once
+WRITE_SIZE = 2**20
+
+# Single key presses, the arrow keys are escape sequences
+key_pattern = re.compile(b'\x1b[\\[O].|.', re.DOTALL)
+position_pattern = re.compile('^(?:(?:([0-9]+):)?([0-9]+):)?([0-9]+(?:\\.[0-9]*)?)(%?)$')
+
+def parse_position(text):
+    '''
+    Parse a replay start position: seconds, [hh:]mm:ss or a percentage like 50%.
+    Returns a tuple (value, is_percentage) or None if the text is invalid.
+    '''
+    m = position_pattern.match(text)
+    if not m or (m.group(4) and (m.group(1) or m.group(2))):
+        return None
+    value = float(m.group(3)) + 60 * int(m.group(2) or 0) + 3600 * int(m.group(1) or 0)
+    if m.group(4) and value > 100:
+        return None
+    return (value, m.group(4) == '%')
+
+def parse_timing(f):
+    # Returns the arrays of the recording time and the output offset after each chunk
+    times = array.array('d')
+    offsets = array.array('q')
+    elapsed = 0.0
+    offset = 0
+    for line in f:
+        parts = line.split()
+        try:
+            if len(parts) == 2:
+                # classic format: <delay> <bytes>
+                elapsed += float(parts[0])
+                offset += int(parts[1])
+            elif len(parts) >= 3 and parts[0] in (b'O', b'I', b'S'):
+                # advanced format: <type> <delay> <data>, only O is written to the output file
+                elapsed += float(parts[1])
+                if parts[0] == b'O':
+                    offset += int(parts[2])
+            else:
+                continue
+        except ValueError:
+            # Incomplete last line of a recording that was not finished properly
+            continue
+        times.append(elapsed)
+        offsets.append(offset)
+    return (times, offsets)
+
+def index_key(timing_file):
+    path, method = timing_file
+    stat = os.stat(path)
+    return [path.name, stat.st_size, stat.st_mtime_ns]
+
+def load_index(recording_path, key):
+    try:
+        with open(recording_path / INDEX_NAME, 'rb') as f:
+            header = json.loads(f.readline())
+            if header["version"] != INDEX_VERSION or header["key"] != key:
+                return None
+            times = array.array('d')
+            offsets = array.array('q')
+            times.fromfile(f, header["count"])
+            offsets.fromfile(f, header["count"])
+            return (times, offsets)
+    except (OSError, ValueError, EOFError, KeyError, TypeError):
+        return None
+
+def store_index(recording_path, key, times, offsets):
+    header = json.dumps({"version": INDEX_VERSION, "key": key, "count": len(times)})
+    tmp_path = recording_path / (INDEX_NAME + '.tmp')
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(header.encode() + b'\n')
+            times.tofile(f)
+            offsets.tofile(f)
+        os.replace(tmp_path, recording_path / INDEX_NAME)
+    except OSError:
+        # The index is only a cache, the recording might be read-only
+        pass
+
+def timing_index(recording_path, timing_file):
+    '''
+    Load the index of the timing file, build and store it if it is missing or outdated.
+    Returns a tuple of arrays (times, offsets).
+    '''
+    key = index_key(timing_file)
+    index = load_index(recording_path, key)
+    if index is not None:
+        return index
+    times, offsets = parse_timing(timing_lines(*timing_file))
+    store_index(recording_path, key, times, offsets)
+    return (times, offsets)
+
+def timing_lines(path, method):
+    with (open(path, 'rb') if method is None else compressed_recording.methods[method][1](path, 'rb')) as f:
+        try:
+            for line in f:
+                yield line
+        except EOFError:
+            # The recording was not finished properly
+            return
+
+class OutputFile:
+    '''
+    Random access to the output file of a recording. Uncompressed files are
+    mapped into memory, compressed files are decompressed as a stream that is
+    reopened when reading backwards.
+    '''
+    def __init__(self, output_file):
+        self.path, self.method = output_file
+        self.map = None
+        self.stream = None
+        self.position = 0
+        if self.method is None:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size > 0:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self.map = b''
+
+    def read(self, start, end):
+        if self.map is not None:
+            return self.map[start:end]
+        if self.stream is None or start < self.position:
+            self.close()
+            self.stream = compressed_recording.methods[self.method][1](self.path, 'rb')
+            self.position = 0
+        try:
+            while self.position < start:
+                skipped = self.stream.read(min(start - self.position, WRITE_SIZE))
+                if not skipped:
+                    return b''
+                self.position += len(skipped)
+            data = self.stream.read(end - start)
+        except EOFError:
+            # The recording was not finished properly
+            data = b''
+        self.position += len(data)
+        return data
+
+    def header_length(self):
+        # script writes a header line to the output file that is not part of the timing
+        first_line = self.read(0, 4096)
+        if not first_line.startswith(b'Script started'):
+            return 0
+        return first_line.find(b'\n') + 1
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if type(self.map) is mmap.mmap:
+            self.map.close()
+            self.map = None
+
+def write_range(state, start, end):
+    # Write the recorded output between the offsets start and end
+    output = state["output"]
+    while start < end:
+        data = output.read(start, min(end, start + WRITE_SIZE))
+        if not data:
+            break
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(state["fd"], view):]
+        start += len(data)
+
+def offset_before(state, k):
+    # Output offset before the chunk k
+    return state["base"] + (state["offsets"][k - 1] if k > 0 else 0)
+
+def delay(state, k, clock):
+    # Wall clock seconds until chunk k is due, when the replay is at the recording time clock
+    gap = state["times"][k] - clock
+    if state["max_idle"] is not None and gap > state["max_idle"]:
+        gap = state["max_idle"]
+    return gap / state["speed"]
+
+def seek(state, t):
+    # Jump to the recording time t
+    times = state["times"]
+    t = max(0.0, min(t, times[-1]))
+    k = bisect.bisect_right(times, t)
+    if k < state["next"]:
+        # Going backwards, the terminal has to be reset and all output up to there replayed
+        os.write(state["fd"], b'\x1bc')
+        write_range(state, state["base"], offset_before(state, k))
+    else:
+        write_range(state, offset_before(state, state["next"]), offset_before(state, k))
+    state["next"] = k
+    state["clock"] = t
+
+def due_after_seek(state, now):
+    if state["next"] >= len(state["times"]):
+        return now
+    remaining = delay(state, state["next"], state["clock"])
+    if state["paused"] is not None:
+        state["paused"] = remaining
+    return now + remaining
+
+def handle_keys(state, key, now, due):
+    # Returns the new time when the next chunk is due, or None to quit
+    if key == b'q':
+        return None
+    elif key == b' ':
+        if state["paused"] is None:
+            state["paused"] = due - now
+            return due
+        due = now + state["paused"]
+        state["paused"] = None
+        return due
+    elif key in (b'\x1b[A', b'\x1bOA', b'+'):
+        new_speed = min(state["speed"] * 2, MAX_SPEED)
+    elif key in (b'\x1b[B', b'\x1bOB', b'-'):
+        new_speed = max(state["speed"] / 2, MIN_SPEED)
+    elif key in (b'\x1b[C', b'\x1bOC'):
+        seek(state, state["clock"] + SEEK_STEP)
+        return due_after_seek(state, now)
+    elif key in (b'\x1b[D', b'\x1bOD'):
+        seek(state, state["clock"] - SEEK_STEP)
+        return due_after_seek(state, now)
+    else:
+        return due
+    if state["paused"] is not None:
+        state["paused"] = state["paused"] * state["speed"] / new_speed
+    due = now + (due - now) * state["speed"] / new_speed
+    state["speed"] = new_speed
+    return due
+
+def wait(state, now, due):
+    # Wait until due or until a key is pressed, returns the new due time or None to quit
+    timeout = None if state["paused"] is not None else max(due - now, 0)
+    if state["keys_fd"] is None:
+        time.sleep(timeout)
+        return due
+    readable, _, _ = select.select([state["keys_fd"]], [], [], timeout)
+    if not readable:
+        return due
+    keys = os.read(state["keys_fd"], 32)
+    if not keys:
+        state["keys_fd"] = None
+        return due
+    for key in key_pattern.findall(keys):
+        due = handle_keys(state, key, time.monotonic(), due)
+        if due is None:
+            return None
+    return due
+
+def play(state):
+    times = state["times"]
+    n = len(times)
+    due = time.monotonic() + delay(state, state["next"], state["clock"]) if state["next"] < n else 0
+    while state["next"] < n:
+        now = time.monotonic()
+        if state["paused"] is not None or due > now:
+            due = wait(state, now, due)
+            if due is None:
+                return
+            continue
+        # Write all chunks that are due at once
+        k = state["next"]
+        end = k
+        while end < n and due <= now:
+            state["clock"] = times[end]
+            end += 1
+            if end < n:
+                due += delay(state, end, state["clock"])
+        write_range(state, offset_before(state, k), offset_before(state, end))
+        state["next"] = end
+
+def replay(recording_path, output_file, timing_file, speed=1.0, start=None, max_idle=2.0):
+    '''
+    Replay a recording in the terminal.
+
+    start is a position as returned by parse_position or None,
+    max_idle limits the waiting time between two chunks of output (None for no limit).
+    Returns False if the timing file could not be read, so the recording cannot
+    be replayed by this player.
+    '''
+    times, offsets = timing_index(recording_path, timing_file)
+    if len(times) == 0:
+        return False
+    output = OutputFile(output_file)
+    state = {
+        "output": output,
+        "fd": sys.stdout.fileno(),
+        "keys_fd": None,
+        "times": times,
+        "offsets": offsets,
+        "base": output.header_length(),
+        "speed": speed,
+        "max_idle": max_idle,
+        "next": 0,
+        "clock": 0.0,
+        "paused": None,
+    }
+    sys.stdout.flush()
+    terminal_settings = None
+    if sys.stdin.isatty():
+        state["keys_fd"] = sys.stdin.fileno()
+        terminal_settings = termios.tcgetattr(sys.stdin.fileno())
+        tty.setcbreak(sys.stdin.fileno())
+    try:
+        if start is not None:
+            value, is_percentage = start
+            seek(state, times[-1] * value / 100 if is_percentage else value)
+        play(state)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        if terminal_settings is not None:
+            termios.tcsetattr(sys.stdin.fileno(), termios.TCSADRAIN, terminal_settings)
+        output.close()
+    return True
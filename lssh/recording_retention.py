@@ -0,0 +1,226 @@
+import os, shutil, sys, time
+from lssh import compressed_recording, recording_player, recordings
+
+# Removes and compresses old session recordings, configured by the attribute
+# recording_retention, for example:
+#
+#   "recording_retention": {
+#       "max_age_days": 365,          # remove recordings older than this
+#       "max_total_bytes": 10 * 2**30, # remove the oldest recordings above this size
+#       "max_per_host": 200,          # keep only the newest recordings of each host
+#       "compress_after_days": 7,     # compress recordings older than this
+#   }
+#
+# All settings are optional. The recordings are found with queries on the
+# recordings catalog in small batches, so the recordings directory is never
+# loaded into memory at once. Recordings that are still being written are
+# locked (see recordings.lock_recording) and skipped.
+
+settings = ('max_age_days', 'max_total_bytes', 'max_per_host', 'compress_after_days')
+
+# Recordings with files modified within this number of seconds are never touched,
+# they might be written by an older lssh version that does not lock them
+ACTIVE_GUARD = 600
+
+# Run the pruning after connect at most once in this number of seconds
+AUTO_PRUNE_INTERVAL = 3600
+# Time limit for the pruning after connect, the remaining work is done after the next connect
+AUTO_PRUNE_TIME = 1.0
+
+def check_settings(retention):
+    # Returns an error message for invalid settings or None
+    if type(retention) is not dict:
+        return "recording_retention must be a dict"
+    for key in retention:
+        if key not in settings:
+            return "Unknown setting `" + str(key) + "' in recording_retention, use one of: " + ", ".join(settings)
+        if type(retention[key]) not in (int, float) or retention[key] < 0:
+            return "The setting `" + key + "' in recording_retention must be a non-negative number"
+    return None
+
+def time_string(seconds_ago):
+    # Timestamp in the format of the recording names
+    return time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime(time.time() - seconds_ago))
+
+def batches(state, source, condition, params, start=('', ''), batch_size=200):
+    # Iterate over the (dirname, size) of the matching recordings after the
+    # key start (timestamp, dirname), oldest first. Only one batch is loaded
+    # at a time, the recordings may be removed while iterating.
+    # The changes to the catalog are committed after each batch.
+    last = start
+    while not state["interrupted"]:
+        state["conn"].commit()
+        rows = state["conn"].execute('SELECT dirname, timestamp, size FROM ' + source + ' WHERE ' + condition + ' AND (timestamp, dirname) > (?, ?) ORDER BY timestamp, dirname LIMIT ?', params + [last[0], last[1], batch_size]).fetchall()
+        if len(rows) == 0:
+            return
+        for dirname, timestamp, size in rows:
+            if state["deadline"] is not None and time.monotonic() > state["deadline"]:
+                state["interrupted"] = True
+                return
+            yield (dirname, size)
+        last = (rows[-1][1], rows[-1][0])
+
+def recently_modified(path):
+    limit = time.time() - ACTIVE_GUARD
+    with os.scandir(path) as it:
+        for entry in it:
+            # The replay index is written when an old recording is replayed
+            if entry.name.startswith(recording_player.INDEX_NAME):
+                continue
+            if entry.stat(follow_symlinks=False).st_mtime > limit:
+                return True
+    return False
+
+def with_recording_locked(dirname, action):
+    # Run action(path) if the recording is not in use, returns False if it was skipped
+    path = recordings.recordings_basedir() / dirname
+    try:
+        fd = recordings.lock_recording(path, blocking=False)
+    except FileNotFoundError:
+        # Already removed, the catalog will be synchronized
+        return False
+    if fd is None:
+        return False
+    try:
+        if recently_modified(path):
+            return False
+        action(path)
+        return True
+    finally:
+        os.close(fd)
+
+def remove_recording(state, dirname, size):
+    previous_mtime = [None]
+    def remove(path):
+        previous_mtime[0] = recordings.basedir_mtime()
+        shutil.rmtree(path)
+    if not with_recording_locked(dirname, remove):
+        return False
+    conn = state["conn"]
+    conn.execute('DELETE FROM recordings WHERE dirname = ?', (dirname,))
+    # The catalog is still in sync, if only this directory was removed
+    conn.execute("UPDATE meta SET value = ? WHERE key = 'mtime' AND value = ?", (recordings.basedir_mtime(), previous_mtime[0]))
+    state["removed"] += 1
+    state["removed_bytes"] += size or 0
+    return True
+
+def compress_file(path, name, method):
+    src = path / name
+    if not os.path.exists(src):
+        return False
+    dst = path / (name + compressed_recording.methods[method][0])
+    tmp = path / (name + compressed_recording.methods[method][0] + '.tmp')
+    with open(src, 'rb') as f_in, compressed_recording.methods[method][1](tmp, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, compressed_recording.CHUNK_SIZE)
+    # Keep the modification time, it tells when the recording was written
+    stat = os.stat(src)
+    os.utime(tmp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmp, dst)
+    os.unlink(src)
+    return True
+
+def compress_recording(state, dirname):
+    # Returns False if the recording was skipped because it is in use
+    compressed = [False]
+    def compress(path):
+        for name in ('output', 'timing'):
+            if compress_file(path, name, state["compression"]):
+                compressed[0] = True
+    if not with_recording_locked(dirname, compress):
+        return not os.path.exists(recordings.recordings_basedir() / dirname)
+    if not compressed[0]:
+        return True
+    size, duration = recordings.recording_stats(recordings.recordings_basedir() / dirname)
+    state["conn"].execute('UPDATE recordings SET size = ? WHERE dirname = ?', (size, dirname))
+    state["compressed"] += 1
+    return True
+
+def get_meta(conn, key):
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return None if row is None else row[0]
+
+def set_meta(conn, key, value):
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+def prune(conn, retention, compression, deadline=None):
+    '''
+    Remove and compress recordings according to the retention settings.
+    Stops when the deadline (time.monotonic) is reached.
+    Returns the state dict with the statistics and whether it was interrupted.
+    '''
+    state = {
+        "conn": conn,
+        "compression": compression,
+        "deadline": deadline,
+        "interrupted": False,
+        "removed": 0,
+        "removed_bytes": 0,
+        "compressed": 0,
+    }
+    if deadline is not None and time.monotonic() > deadline:
+        state["interrupted"] = True
+        return state
+    recordings.sync_catalog(conn)
+    if "max_age_days" in retention:
+        for dirname, size in batches(state, 'recordings', 'timestamp < ?', [time_string(retention["max_age_days"] * 86400)]):
+            remove_recording(state, dirname, size)
+    if "max_per_host" in retention:
+        newest_first = '(SELECT dirname, timestamp, size, ROW_NUMBER() OVER (PARTITION BY name ORDER BY timestamp DESC, dirname DESC) AS newer FROM recordings)'
+        for dirname, size in batches(state, newest_first, 'newer > ?', [int(retention["max_per_host"])]):
+            remove_recording(state, dirname, size)
+    # The sizes are needed for max_total_bytes, recordings found on disk and
+    # recordings of sessions that were not finished properly have none yet
+    if not state["interrupted"] and not recordings.update_stats(conn, deadline):
+        state["interrupted"] = True
+    if "max_total_bytes" in retention and not state["interrupted"]:
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM recordings').fetchone()[0]
+        if total > retention["max_total_bytes"]:
+            for dirname, size in batches(state, 'recordings', '1', []):
+                if remove_recording(state, dirname, size):
+                    total -= size or 0
+                    if total <= retention["max_total_bytes"]:
+                        break
+    if "compress_after_days" in retention:
+        # Recordings up to the key (timestamp, dirname) have already been compressed by a previous run
+        cutoff = time_string(retention["compress_after_days"] * 86400)
+        start = (get_meta(conn, 'compressed_until') or '', get_meta(conn, 'compressed_until_dirname') or '')
+        # Recordings in use are skipped, the key stays before the oldest of them
+        skipped = False
+        for dirname, size in batches(state, 'recordings', 'timestamp < ?', [cutoff], start):
+            if not compress_recording(state, dirname):
+                skipped = True
+            if not skipped:
+                # Committed with the batch, so the progress is kept if the time runs out
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('compressed_until', ?)", (recordings.name_pattern.match(dirname).group(1),))
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('compressed_until_dirname', ?)", (dirname,))
+    conn.commit()
+    return state
+
+def open_catalog():
+    os.makedirs(recordings.catalog_path().parent, exist_ok=True)
+    return recordings.open_catalog()
+
+def prune_after_connect(retention, compression):
+    # Prune a part of the recordings, if it is time for it
+    conn = open_catalog()
+    try:
+        last_prune = get_meta(conn, 'last_prune')
+        if last_prune is not None and last_prune > time.time() - AUTO_PRUNE_INTERVAL:
+            return
+        state = prune(conn, retention, compression, time.monotonic() + AUTO_PRUNE_TIME)
+        if not state["interrupted"]:
+            # Otherwise continue after the next connect
+            set_meta(conn, 'last_prune', time.time())
+    finally:
+        conn.close()
+
+def main(retention, compression):
+    conn = open_catalog()
+    try:
+        state = prune(conn, retention, compression)
+        set_meta(conn, 'last_prune', time.time())
+    finally:
+        conn.close()
+    print("Removed " + str(state["removed"]) + " recordings (" + str(state["removed_bytes"] // 2**20) + " MiB), compressed " + str(state["compressed"]) + " recordings")
+    sys.exit(0)
@@ -0,0 +1,193 @@
+import mmap, os, re, sys
+from lssh import compressed_recording, recordings
+
+# Full-text search in the output of session recordings (lssh --grep)
+#
+# Terminal control sequences are removed before searching. To avoid reading
+# all recordings for every search, the words of each recording are stored in
+# an index in the recordings catalog (token postings per recording). It is
+# updated incrementally, only new and changed recordings are read. A search
+# first selects the recordings that contain all words of the search text and
+# then checks only those line by line.
+
+# Control sequences: CSI, OSC (terminated by BEL or ST), charset selection and other escapes
+control_sequence_pattern = re.compile(b'\x1b\\[[0-?]*[ -/]*[@-~]|\x1b\\][^\x07\x1b]*(?:\x07|\x1b\\\\)?|\x1b[()*+][ -~]|\x1b[ -~]|[\x00-\x08\x0b-\x1f\x7f]')
+token_pattern = re.compile(b'[a-z0-9_]+')
+# Longer tokens are not indexed (mostly binary garbage, hashes or base64 data)
+MAX_TOKEN_LENGTH = 64
+BLOCK_SIZE = 16 * 2**20
+
+def create_tables(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS search_recordings (id INTEGER PRIMARY KEY, dirname TEXT UNIQUE NOT NULL, key TEXT NOT NULL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS search_tokens (id INTEGER PRIMARY KEY, token TEXT UNIQUE NOT NULL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS search_postings (token_id INTEGER NOT NULL, recording_id INTEGER NOT NULL, PRIMARY KEY (token_id, recording_id)) WITHOUT ROWID')
+    conn.execute('CREATE INDEX IF NOT EXISTS search_postings_recording ON search_postings (recording_id)')
+
+def blocks(path, method):
+    '''
+    Iterate over the content of a recording file in blocks of complete lines.
+    Uncompressed files are read through mmap.
+    '''
+    if method is None:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                start = 0
+                while start < len(m):
+                    end = m.rfind(b'\n', start, start + BLOCK_SIZE) + 1 if start + BLOCK_SIZE < len(m) else len(m)
+                    if end <= start:
+                        # very long line
+                        end = min(start + BLOCK_SIZE, len(m))
+                    yield m[start:end]
+                    start = end
+        return
+    rest = b''
+    with compressed_recording.methods[method][1](path, 'rb') as f:
+        while True:
+            try:
+                data = f.read(BLOCK_SIZE)
+            except EOFError:
+                # recording was not finished properly
+                data = b''
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b'\n') + 1
+            if end == 0 and len(data) < BLOCK_SIZE:
+                rest = data
+                continue
+            if end == 0:
+                end = len(data)
+            rest = data[end:]
+            yield data[0:end]
+    if rest:
+        yield rest
+
+def strip_control_sequences(data):
+    return control_sequence_pattern.sub(b'', data.replace(b'\r\n', b'\n').replace(b'\r', b'\n'))
+
+def recording_key(output_file):
+    path, method = output_file
+    stat = os.stat(path)
+    return str(path.name) + ':' + str(stat.st_size) + ':' + str(stat.st_mtime_ns)
+
+def index_recording(conn, dirname, output_file, key):
+    tokens = set()
+    for block in blocks(*output_file):
+        for token in token_pattern.findall(strip_control_sequences(block).lower()):
+            if len(token) <= MAX_TOKEN_LENGTH:
+                tokens.add(token)
+    conn.execute('INSERT OR IGNORE INTO search_recordings (dirname, key) VALUES (?, ?)', (dirname, key))
+    conn.execute('UPDATE search_recordings SET key = ? WHERE dirname = ?', (key, dirname))
+    recording_id = conn.execute('SELECT id FROM search_recordings WHERE dirname = ?', (dirname,)).fetchone()[0]
+    conn.execute('DELETE FROM search_postings WHERE recording_id = ?', (recording_id,))
+    token_list = [(token.decode(),) for token in tokens]
+    conn.executemany('INSERT OR IGNORE INTO search_tokens (token) VALUES (?)', token_list)
+    conn.executemany('INSERT INTO search_postings SELECT id, ? FROM search_tokens WHERE token = ?', [(recording_id, token) for (token,) in token_list])
+
+def update_index(conn, verbose=False):
+    # Index the new and changed recordings, remove the removed ones
+    with conn:
+        conn.execute('DELETE FROM search_postings WHERE recording_id IN (SELECT id FROM search_recordings WHERE dirname NOT IN (SELECT dirname FROM recordings))')
+        conn.execute('DELETE FROM search_recordings WHERE dirname NOT IN (SELECT dirname FROM recordings)')
+    keys = dict(conn.execute('SELECT dirname, key FROM search_recordings'))
+    count = 0
+    for (dirname,) in conn.execute('SELECT dirname FROM recordings ORDER BY dirname').fetchall():
+        output_file = compressed_recording.find_file(recordings.recordings_basedir() / dirname, 'output')
+        if output_file is None:
+            continue
+        try:
+            key = recording_key(output_file)
+            if keys.get(dirname) == key:
+                continue
+            with conn:
+                index_recording(conn, dirname, output_file, key)
+        except OSError:
+            # Removed in the meantime
+            continue
+        count += 1
+    if verbose:
+        print("Indexed " + str(count) + " new or changed recordings", file=sys.stderr)
+
+def token_condition(token, left_open, right_open):
+    # Returns the condition for the indexed tokens that can contain this part of the search text.
+    # At the beginning and end of the search text, the words may continue in the recording.
+    if not left_open and not right_open:
+        return ('token = ?', [token])
+    elif not left_open:
+        return ('token >= ? AND token < ?', [token, token + '\U0010ffff'])
+    elif not right_open:
+        return ('substr(token, -?) = ?', [len(token), token])
+    return ('instr(token, ?) > 0', [token])
+
+def candidates(conn, text):
+    '''
+    Returns the dirnames of the indexed recordings that contain all words of text
+    (a superset of the recordings containing text).
+    '''
+    needle = text.encode().lower()
+    result = None
+    for m in token_pattern.finditer(needle):
+        token = m.group(0).decode()
+        if len(token) > MAX_TOKEN_LENGTH:
+            continue
+        condition, params = token_condition(token, m.start() == 0, m.end() == len(needle))
+        query = 'SELECT dirname FROM search_recordings WHERE id IN (SELECT recording_id FROM search_postings WHERE token_id IN (SELECT id FROM search_tokens WHERE ' + condition + '))'
+        dirnames = {row[0] for row in conn.execute(query, params)}
+        result = dirnames if result is None else result & dirnames
+        if len(result) == 0:
+            break
+    if result is None:
+        result = {row[0] for row in conn.execute('SELECT dirname FROM search_recordings')}
+    return result
+
+def first_matching_line(output_file, text):
+    # Returns the first line containing text (case insensitive) or None
+    needle = text.encode().lower()
+    for block in blocks(*output_file):
+        stripped = strip_control_sequences(block)
+        pos = stripped.lower().find(needle)
+        if pos != -1:
+            start = stripped.rfind(b'\n', 0, pos) + 1
+            end = stripped.find(b'\n', pos)
+            return stripped[start:end if end != -1 else len(stripped)].decode(errors='replace').strip()
+    return None
+
+def search(text, substrings, verbose=False):
+    '''
+    Find the recordings that contain text, restricted to the hosts matching all substrings.
+    Returns a list of (dirname, timestamp, name, line) tuples, sorted by dirname.
+    '''
+    os.makedirs(recordings.catalog_path().parent, exist_ok=True)
+    conn = recordings.open_catalog()
+    try:
+        create_tables(conn)
+        recordings.sync_catalog(conn)
+        update_index(conn, verbose)
+        found = candidates(conn, text)
+        results = []
+        for dirname, timestamp, name in recordings.find_recordings(substrings):
+            if dirname not in found:
+                continue
+            output_file = compressed_recording.find_file(recordings.recordings_basedir() / dirname, 'output')
+            if output_file is None:
+                continue
+            try:
+                line = first_matching_line(output_file, text)
+            except OSError:
+                continue
+            if line is not None:
+                results.append((dirname, timestamp, name, line))
+        return results
+    finally:
+        conn.close()
+
+def main(text, substrings, verbose=False):
+    results = search(text, substrings, verbose)
+    if len(results) == 0:
+        print("No matching recording was found")
+        sys.exit(1)
+    for dirname, timestamp, name, line in results:
+        print(timestamp + "  " + name + "  " + line)
+    sys.exit(0)
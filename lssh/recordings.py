@@ -1,16 +1,209 @@
-import os, re
+import fcntl, os, re, sqlite3, time
 from lssh import xdg_compat
 
+# Catalog of the session recordings
+#
+# Listing and matching the names of the recordings directory becomes slow with
+# many recordings, so they are kept in a sqlite database. The catalog is
+# updated when a session is recorded (see cli.connect) and synchronized with
+# the recordings directory whenever its modification time has changed, so it
+# can always be rebuilt from disk.
+#
+# Size and duration of a recording are stored when its session has ended
+# (finished = 1). Recordings found on disk and recordings of sessions that
+# ended without finish_recording are added with finished = 0. Their stats are
+# calculated later by update_stats, in batches, once they are no longer locked.
+
+name_pattern = re.compile('^([0-9\\-]+_[0-9\\-]+)_(.*)$')
+
+def recordings_basedir():
+    return xdg_compat.data_home() / 'lssh' / 'recordings'
+
+def catalog_path():
+    return xdg_compat.data_home() / 'lssh' / 'recordings.sqlite'
+
+def recording_stats(path):
+    '''
+    Calculate the size (bytes of all files) and duration (seconds, from the
+    timing file or None) of the recording in the directory path.
+    '''
+    from lssh import compressed_recording
+    size = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_file():
+                    size += entry.stat().st_size
+    except FileNotFoundError:
+        return (0, None)
+    timing_file = compressed_recording.find_file(path, 'timing')
+    if timing_file is None:
+        return (size, None)
+    timing_path, method = timing_file
+    duration = 0.0
+    try:
+        if method is None:
+            f = open(timing_path, 'rb')
+        else:
+            f = compressed_recording.methods[method][1](timing_path, 'rb')
+        with f:
+            for line in f:
+                parts = line.split()
+                try:
+                    if len(parts) == 2:
+                        # classic format: <delay> <bytes>
+                        duration += float(parts[0])
+                    elif len(parts) >= 3 and parts[0] in (b'O', b'I', b'S'):
+                        # advanced format: <type> <delay> <data>
+                        duration += float(parts[1])
+                except ValueError:
+                    pass
+    except (OSError, EOFError):
+        # Unreadable or truncated timing file, use the duration read so far
+        pass
+    return (size, duration)
+
+def open_catalog():
+    conn = sqlite3.connect(str(catalog_path()), timeout=10)
+    conn.execute('CREATE TABLE IF NOT EXISTS recordings (dirname TEXT PRIMARY KEY, timestamp TEXT NOT NULL, name TEXT NOT NULL, size INTEGER, duration REAL, finished INTEGER NOT NULL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS recordings_timestamp ON recordings (timestamp)')
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+    return conn
+
+def basedir_mtime():
+    try:
+        return os.stat(recordings_basedir()).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def scan_basedir():
+    # Names of all directories in the recordings directory, without listing them at once
+    try:
+        with os.scandir(recordings_basedir()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    yield (entry.name,)
+    except FileNotFoundError:
+        pass
+
+def sync_catalog(conn):
+    # Add and remove recordings that were changed on disk without updating the catalog
+    mtime = basedir_mtime()
+    row = conn.execute("SELECT value FROM meta WHERE key = 'mtime'").fetchone()
+    if row is not None and row[0] == mtime:
+        return
+    with conn:
+        # The names are compared in the database, so even huge directories are not loaded into memory
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen (dirname TEXT PRIMARY KEY)')
+        conn.execute('DELETE FROM seen')
+        conn.executemany('INSERT OR IGNORE INTO seen VALUES (?)', scan_basedir())
+        conn.execute('DELETE FROM recordings WHERE dirname NOT IN (SELECT dirname FROM seen)')
+        # Only the new recordings remain in seen
+        conn.execute('DELETE FROM seen WHERE dirname IN (SELECT dirname FROM recordings)')
+        for (name,) in conn.execute('SELECT dirname FROM seen'):
+            m = name_pattern.match(name)
+            if not m:
+                # If regex does not fit, it cannot be a recording
+                continue
+            # The stats are calculated by update_stats
+            conn.execute('INSERT INTO recordings VALUES (?, ?, ?, NULL, NULL, 0)', (name, m.group(1), m.group(2)))
+        conn.execute('DELETE FROM seen')
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('mtime', ?)", (mtime,))
+
+def update_stats(conn, deadline=None, batch_size=200):
+    '''
+    Calculate size and duration of the unfinished recordings that are not
+    locked (anymore), committed after each batch. Stops when the deadline
+    (time.monotonic) is reached, returns False in that case.
+    '''
+    last = ''
+    while True:
+        rows = conn.execute('SELECT dirname FROM recordings WHERE finished = 0 AND dirname > ? ORDER BY dirname LIMIT ?', (last, batch_size)).fetchall()
+        if len(rows) == 0:
+            return True
+        with conn:
+            for (dirname,) in rows:
+                if deadline is not None and time.monotonic() > deadline:
+                    return False
+                path = recordings_basedir() / dirname
+                try:
+                    fd = lock_recording(path, blocking=False)
+                except FileNotFoundError:
+                    # Removed, the catalog will be synchronized
+                    continue
+                if fd is None:
+                    # The session is still running
+                    continue
+                try:
+                    size, duration = recording_stats(path)
+                finally:
+                    os.close(fd)
+                conn.execute('UPDATE recordings SET size = ?, duration = ?, finished = 1 WHERE dirname = ?', (size, duration, dirname))
+        last = rows[-1][0]
+
+def add_recording(dirname, previous_mtime):
+    '''
+    Add a new recording directory to the catalog, called right after creating it.
+    previous_mtime is the modification time of the recordings directory
+    before it was created (see basedir_mtime).
+    '''
+    m = name_pattern.match(dirname)
+    conn = open_catalog()
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, NULL, NULL, 0)', (dirname, m.group(1), m.group(2)))
+            # The catalog is still in sync, if only this directory was added
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'mtime' AND value = ?", (basedir_mtime(), previous_mtime))
+    finally:
+        conn.close()
+
+def finish_recording(dirname):
+    # Store size and duration after the session has ended
+    size, duration = recording_stats(recordings_basedir() / dirname)
+    conn = open_catalog()
+    try:
+        with conn:
+            conn.execute('UPDATE recordings SET size = ?, duration = ?, finished = 1 WHERE dirname = ?', (size, duration, dirname))
+    finally:
+        conn.close()
+
+def lock_recording(path, blocking=True):
+    '''
+    Lock the recording directory path. A recording is locked as long as the
+    session is recorded, so it is not removed or compressed in the meantime.
+    Returns the file descriptor that holds the lock,
+    or None if blocking is False and the recording is locked by another process.
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def find_recordings(substrings, timestamp=None):
+    '''
+    Find the recordings whose host name contains all substrings,
+    restricted to the exact timestamp if given.
+    Returns a list of (dirname, timestamp, name) tuples, sorted by dirname.
+    '''
+    conditions = ['instr(name, ?) > 0' for substring in substrings]
+    params = list(substrings)
+    if timestamp is not None:
+        conditions.append('timestamp = ?')
+        params.append(timestamp)
+    query = 'SELECT dirname, timestamp, name FROM recordings'
+    if len(conditions) > 0:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY dirname'
+    os.makedirs(catalog_path().parent, exist_ok=True)
+    conn = open_catalog()
+    try:
+        sync_catalog(conn)
+        return conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
 def find_recording_files():
-    recordings_basedir = xdg_compat.data_home() / 'lssh' / 'recordings'
-    rec_files = os.listdir(recordings_basedir)
-    file_entries = []
-    for file_name in rec_files:
-        m = re.match('^([0-9\\-]+_[0-9\\-]+)_(.*)$', file_name)
-        if not m:
-            # If regex does not fit, it cannot be a recording
-            continue
-        t = m.group(1)
-        name = m.group(2)
-        file_entries.append((file_name, t, name))
-    return file_entries
+    return find_recordings([])
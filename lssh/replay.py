@@ -1,48 +1,49 @@
-import re, os, platform, subprocess, sys
-from lssh import tui_dialog, xdg_compat
+import platform, sys
+from lssh import host_picker, recordings
 
-def name_matches(name, substrings, timestamp):
-    m = re.match('^([0-9\\-]+_[0-9\\-]+)_(.*)$', name)
-    if not m:
-        # If regex does not fit, it cannot be a recording
-        return False
-    t = m.group(1)
-    if timestamp is not None and t != timestamp:
-        # Timestamp does not fit
-        return False
-    name = m.group(2)
-    # name might contain a trailing counter value, but this does not matter for substring match
-    for sub in substrings:
-        if sub not in name:
-            # One substring does not match
-            return False
-    return True
-
-def replay_recording(dirname):
+def replay_recording(dirname, options):
+    from lssh import compressed_recording
     print("Replaying " + dirname + " ...")
-    recording_path = xdg_compat.data_home() / 'lssh' / 'recordings' / dirname
-    timing_file = str(recording_path / 'timing')
-    output_file = str(recording_path / 'output')
+    recording_path = recordings.recordings_basedir() / dirname
+    # The recording files might be compressed, see compressed_recording
+    output_file = compressed_recording.find_file(recording_path, 'output')
+    if output_file is None:
+        print("The recording " + dirname + " does not contain an output file")
+        sys.exit(1)
     if platform.system() == "Darwin":
-        command = ['script', '-p', output_file]
+        files = [output_file]
+        make_command = lambda output: ['script', '-p', output]
     else:
-        command = ['scriptreplay', '-m', '2', '-t', timing_file, output_file]
-    sys.exit(subprocess.run(command).returncode)
+        timing_file = compressed_recording.find_file(recording_path, 'timing')
+        if timing_file is None:
+            print("The recording " + dirname + " does not contain a timing file")
+            sys.exit(1)
+        from lssh import recording_player
+        if recording_player.replay(recording_path, output_file, timing_file, options["speed"], options["start"], options["max_idle"]):
+            sys.exit(0)
+        # Unknown timing format, let scriptreplay try it
+        if options["start"] is not None:
+            print("Warning: Seeking is not possible in this recording, replaying from the beginning", file=sys.stderr)
+        files = [output_file, timing_file]
+        max_delay = ['-m', str(options["max_idle"])] if options["max_idle"] is not None else []
+        make_command = lambda output, timing: ['scriptreplay'] + max_delay + ['-d', str(options["speed"]), '-t', timing, output]
+    sys.exit(compressed_recording.replay(files, make_command))
+
+def find_recording_names(substrings, timestamp=None):
+    # Names of the recordings to choose from, see recordings.find_recordings
+    return [entry[0] for entry in recordings.find_recordings(substrings, timestamp)]
 
-def replay(substrings, timestamp):
-    recordings_basedir = xdg_compat.data_home() / 'lssh' / 'recordings'
-    rec_files = os.listdir(recordings_basedir)
-    matching_rec_files = [name for name in rec_files if name_matches(name, substrings, timestamp)]
+def replay(substrings, timestamp, options):
+    matching_rec_files = find_recording_names(substrings, timestamp)
     if len(matching_rec_files) == 0:
         print("No matching recording was found")
         sys.exit(1)
     elif len(matching_rec_files) == 1:
-        replay_recording(matching_rec_files[0])
+        replay_recording(matching_rec_files[0], options)
     else:
-        matching_rec_files.sort()
-        choice_idx = tui_dialog.flat_option_dialog(matching_rec_files, "Please choose a recording to replay")
+        choice_idx = host_picker.pick_list(matching_rec_files, "Please choose a recording to replay")
         if choice_idx is None:
             print("No recording has been selected")
             sys.exit(1)
         choice = matching_rec_files[choice_idx]
-        replay_recording(choice)
+        replay_recording(choice, options)
@@ -24,11 +24,11 @@ def valid_config(config):
     except (FileNotFoundError, ConnectionRefusedError):
         return False
 
-def start_agent():
+def start_agent(messages=None):
     try:
         os.makedirs(ssh_agent_config_filename().parent, exist_ok=True)
     except Exception as e:
-        print("Warning: Failed to store ssh agent configuration: " + str(e), file=sys.stderr)
+        print("Warning: Failed to store ssh agent configuration: " + str(e), file=sys.stderr if messages is None else messages)
         return {}
     sock_path = ssh_agent_socket_filename()
     if os.path.exists(sock_path):
@@ -51,18 +51,22 @@ def apply_config(config):
     output.update(config)
     return output
 
-def get_environment():
+def get_environment(messages=None):
+    '''
+    The environment with the ssh agent, which is started if needed.
+    Warnings are written to messages (default: stderr).
+    '''
     if os.environ.get('SSH_AUTH_SOCK') is not None:
         # agent already started by user or system, do not start another one
         return os.environ.copy()
     ssh_agent_config = load_config()
     if ssh_agent_config is None:
         # No valid config found, start a new agent
-        new_config = start_agent()
+        new_config = start_agent(messages)
         return apply_config(new_config)
     if valid_config(ssh_agent_config):
         # Agent was previously started by lssh, use its settings
         return apply_config(ssh_agent_config)
     # Agent is no longer running, start a new one
-    new_config = start_agent()
+    new_config = start_agent(messages)
     return apply_config(new_config)
@@ -8,16 +8,18 @@ try:
 except ImportError:
     from xdg.BaseDirectory import xdg_cache_home # Fallback for old xdg version (debian)
 
-from lssh import recordings
+from lssh import profiling
 
 # To activate tab completion in bash:
 # complete -C 'lssh __complete__' lssh
 
-def find_substrings():
-    if 'COMP_LINE' not in environ:
+def find_substrings(comp_line=None):
+    if comp_line is None:
+        comp_line = environ.get('COMP_LINE')
+    if comp_line is None:
         return []
     # very rudimentary parsing of a bash commandline
-    parts = environ['COMP_LINE'].split(' ')[1:]
+    parts = comp_line.split(' ')[1:]
     option_val = False
     substrings = []
     for part in parts:
@@ -25,7 +27,7 @@ def find_substrings():
             option_val = False
         elif part.startswith('-'):
             # List of options that consume a value
-            option_val = part in ('--timestamp', '--load-from', '--validate')
+            option_val = part in ('--timestamp', '--grep', '--exec', '--speed', '--seek', '--max-idle', '--load-from', '--validate', '--jobs')
         else:
             substrings.append(part)
     if len(substrings) > 0:
@@ -41,16 +43,9 @@ def contains_substring(keywords, substring):
             return True
     return False
 
-def contains_all_substrings(keywords, substrings):
-    for substr in substrings:
-        if not contains_substring(keywords, substr):
-            return False
-    return True
-
 def timestamp_completions(substrings):
-    def matches(entry):
-        return contains_all_substrings(entry[2], substrings)
-    return [entry[1] for entry in recordings.find_recording_files() if matches(entry)]
+    from lssh import recordings
+    return [entry[1] for entry in recordings.find_recordings(substrings)]
 
 def parse_hosts(hosts_dir):
     from json import dump
@@ -62,6 +57,30 @@ def parse_hosts(hosts_dir):
         hosts[display_name] = list(config[display_name].keywords)
     return hosts
 
+def load_host_index(hosts_dir):
+    from lssh import hostindex
+    index = hostindex.open_index(hostindex.index_path(), None)
+    if index is not None:
+        return index
+    # No index available, build it in memory from the hostlist cache
+    try:
+        with open(host_cache_path(), 'r') as f:
+            hosts = load(f)
+    except FileNotFoundError:
+        hosts = parse_hosts(hosts_dir)
+    entries = {}
+    for display_name in hosts:
+        entries[display_name] = hostindex.HostEntry(display_name, None)
+        entries[display_name].keywords = set(hosts[display_name])
+    return hostindex.HostIndex(hostindex.serialize(entries, {}, 0))
+
+def find_host_choices(index, substrings):
+    # Returns the bitset of all hosts that match all substrings
+    bits = index.all_bitset()
+    for substring in substrings:
+        bits &= index.substring_bitset(substring)
+    return bits
+
 def host_cache_path():
     if type(xdg_cache_home) is str:
         cache = Path(xdg_cache_home)
@@ -69,51 +88,112 @@ def host_cache_path():
         cache = xdg_cache_home()
     return cache / 'lssh' / 'hosts.json'
 
-# Check if the given new_keyword reduces the given hosts in host_choices
+# Check if the given new_keyword reduces the hosts in the bitset choice_bits
 # True, if there is at least one host that does not match the new_keyword
-def restricts(new_keyword, host_choices, host_keyword_map):
-    for host in host_choices:
-        if not contains_substring([host] + host_keyword_map[host], new_keyword):
+def restricts(new_keyword, choice_bits, index, sample_hosts):
+    # Most keywords do not match one of a few sample hosts, this is checked first
+    for host, keywords in sample_hosts:
+        if not contains_substring([host] + keywords, new_keyword):
             return True
-    return False
+    return choice_bits & ~index.substring_bitset(new_keyword) != 0
 
-def main(hosts_dir):
-    if len(argv) < 5:
-        return
-    current_arg = argv[3]
-    previous_arg = argv[4]
+def sample_hosts(index, host_ids, count=8):
+    # Hosts spread over the given hosts (sorted by name, so not all of one customer)
+    step = max(len(host_ids) // count, 1)
+    names = index.names()
+    return [(names[host_id], index.host_keywords(host_id)) for host_id in host_ids[::step][:count]]
+
+def completions(hosts_dir, current_arg, previous_arg, comp_line, index=None):
+    '''
+    Calculate the tab-completion choices for the argument current_arg.
+    The file path completion after --load-from and --validate is not handled here.
 
+    If index is given, it is used as host index instead of loading it.
+    '''
     if previous_arg == '--timestamp':
         # timestamp completion
-        choices = timestamp_completions(find_substrings())
-    elif previous_arg in ('--load-from', '--validate'):
-        # file path completion
-        from shlex import quote
-        from subprocess import run
-        from sys import exit
-        compgen_cmd = "compgen -d -- " + quote(current_arg)
-        exit(run(["bash", "-c", compgen_cmd]).returncode)
+        choices = timestamp_completions(find_substrings(comp_line))
+    elif previous_arg in ('--grep', '--exec', '--jobs', '--speed', '--seek', '--max-idle'):
+        # free text or number
+        choices = []
     elif current_arg.startswith('-'):
         # option completion
-        choices = ['--help', '--load-from', '--replay', '--timestamp', '--update-hosts', '--validate', '--verbose', '--version']
+        choices = ['--close-masters', '--exec', '--grep', '--help', '--jobs', '--load-from', '--masters', '--max-idle', '--prune-recordings', '--replay', '--seek', '--speed', '--timestamp', '--update-hosts', '--validate', '--verbose', '--version']
     else:
         # substring completion
         try:
-            try:
-                with open(host_cache_path(), 'r') as f:
-                    hosts = load(f)
-            except FileNotFoundError:
-                hosts = parse_hosts(hosts_dir)
-            substrings = find_substrings()
-            host_choices = {h for h in hosts if contains_all_substrings([h] + hosts[h], substrings)}
+            substrings = find_substrings(comp_line)
+            if index is None:
+                with profiling.phase('load_index'):
+                    index = load_host_index(hosts_dir)
+            choice_bits = find_host_choices(index, substrings)
+            choice_ids = index.bitset_ids(choice_bits)
+            names = index.names()
+            host_choices = {names[host_id] for host_id in choice_ids}
             if len(host_choices) == 1 and list(host_choices)[0] in substrings:
                 # Only one host remaining and this host is already given explicitly. No further suggestions for the tab-completion
                 choices = []
             else:
-                keyword_options = {keyword for h in host_choices for keyword in hosts[h]}
-                keyword_choices = {keyword for keyword in keyword_options if restricts(keyword, host_choices, hosts)}
+                keyword_options = index.bitset_keywords(choice_bits, choice_ids)
+                sample = sample_hosts(index, choice_ids)
+                keyword_choices = {keyword for keyword in keyword_options if restricts(keyword, choice_bits, index, sample)}
                 choices = host_choices | keyword_choices
         except FileNotFoundError:
             choices = []
-    result = [x for x in choices if x.startswith(current_arg)]
+    return [x for x in choices if x.startswith(current_arg)]
+
+def server_socket_path():
+    # The completion server (see complete_server.py) listens on this socket
+    if environ.get('XDG_RUNTIME_DIR'):
+        return Path(environ['XDG_RUNTIME_DIR']) / 'lssh' / 'complete.sock'
+    return host_cache_path().parent / 'complete.sock'
+
+def query_server(hosts_dir, current_arg, previous_arg, comp_line):
+    # Returns the choices calculated by the completion server or None if it is not available
+    import json, socket
+    request = {
+        'hosts_dir': hosts_dir,
+        'current': current_arg,
+        'previous': previous_arg,
+        'comp_line': comp_line,
+    }
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(1)
+            s.connect(str(server_socket_path()))
+            s.sendall(json.dumps(request).encode() + b'\n')
+            s.shutdown(socket.SHUT_WR)
+            data = b''
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        response = json.loads(data)
+    except (OSError, ValueError):
+        return None
+    if type(response) is not dict or 'choices' not in response:
+        return None
+    return response['choices']
+
+def main(hosts_dir):
+    if len(argv) < 5:
+        return
+    current_arg = argv[3]
+    previous_arg = argv[4]
+    comp_line = environ.get('COMP_LINE')
+
+    if previous_arg in ('--load-from', '--validate'):
+        # file path completion
+        from shlex import quote
+        from subprocess import run
+        from sys import exit
+        compgen_cmd = "compgen -d -- " + quote(current_arg)
+        exit(run(["bash", "-c", compgen_cmd]).returncode)
+    with profiling.phase('query_server'):
+        result = query_server(hosts_dir, current_arg, previous_arg, comp_line)
+    if result is None:
+        # No completion server running, calculate it in this process
+        with profiling.phase('completions'):
+            result = completions(hosts_dir, current_arg, previous_arg, comp_line)
     print("\n".join(result))
@@ -0,0 +1,105 @@
+import io, sys, threading
+from lssh import profiling, ssh_agent
+
+# Speculative preparation of the connection, while the user is still selecting
+# the host in the tui dialog.
+#
+# A background thread first makes sure the ssh agent is running, then
+# prepares the connection to the host that is currently highlighted (only the
+# latest one, hosts that were passed by quickly are skipped). When another
+# host is highlighted, the running preparation is cancelled. The preparation
+# only warms caches and connections, so a host that is finally selected without
+# being prepared is connected as usual.
+#
+# The dialog is drawn on the terminal at the same time, so the warnings of the
+# background thread are kept and printed by get_environment.
+
+class Warmup:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.environment = None
+        self.error = None
+        self.messages = io.StringIO()
+        self.requested = None
+        # (host, cancel event) of the running preparation
+        self.running = None
+        self.prepared = set()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            with profiling.phase('agent_setup'):
+                environment = ssh_agent.get_environment(self.messages)
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+            return
+        with self.condition:
+            self.environment = environment
+            self.condition.notify_all()
+        while True:
+            with self.condition:
+                while not self.closed and (self.requested is None or self.requested[0] in self.prepared):
+                    self.condition.wait()
+                if self.closed:
+                    return
+                host, prepare = self.requested
+                cancelled = threading.Event()
+                self.running = (host, cancelled)
+            try:
+                prepare(environment, cancelled)
+            except Exception:
+                # The connection is prepared again when it is started
+                pass
+            with self.condition:
+                if not cancelled.is_set():
+                    self.prepared.add(host)
+                self.running = None
+                self.condition.notify_all()
+
+    def cancel_others(self, host):
+        # Cancel the running preparation unless it is for host, the lock must be held
+        if self.running is not None and self.running[0] != host:
+            self.running[1].set()
+
+    def highlight(self, host, prepare):
+        '''
+        Prepare the connection to host by calling prepare with the environment
+        of the ssh agent and an event that is set when the preparation is no
+        longer needed (another host is highlighted). Runs in the background
+        thread, prepare must not write to the terminal.
+        Called from the tui dialog, returns immediately.
+        '''
+        with self.condition:
+            self.requested = (host, prepare)
+            self.cancel_others(host)
+            self.condition.notify_all()
+
+    def get_environment(self):
+        '''
+        The environment with the ssh agent (see ssh_agent.get_environment),
+        waits until the agent has been started. Prints the kept warnings.
+        '''
+        with self.condition:
+            while self.environment is None and self.error is None:
+                self.condition.wait()
+            messages = self.messages.getvalue()
+            self.messages = io.StringIO()
+        if messages:
+            sys.stderr.write(messages)
+        with self.condition:
+            if self.error is not None:
+                raise self.error
+            return self.environment
+
+    def finish(self, host):
+        # Stop preparing, cancel the preparation of other hosts and wait until it has stopped
+        with self.condition:
+            self.closed = True
+            self.cancel_others(host)
+            self.condition.notify_all()
+            while self.running is not None:
+                self.condition.wait()
@@ -0,0 +1,91 @@
+import contextlib, io, os, sys, tempfile, unittest
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(tests_dir, '..'))
+
+from lssh import fanout
+
+class FakeSshTest(unittest.TestCase):
+    '''
+    Runs the --exec scheduler against tests/fake_ssh/ssh, which executes the
+    remote command locally and logs when each connection starts and ends.
+    '''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.tmp.name, 'ssh.log')
+        self.env = dict(os.environ, PATH=os.path.join(tests_dir, 'fake_ssh') + os.pathsep + os.environ['PATH'], FAKE_SSH_LOG=self.log)
+        self.saved = (fanout.MAX_PER_JUMPHOST, fanout.LINE_LIMIT)
+
+    def tearDown(self):
+        fanout.MAX_PER_JUMPHOST, fanout.LINE_LIMIT = self.saved
+        self.tmp.cleanup()
+
+    def run_fanout(self, targets, parallel):
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            with self.assertRaises(SystemExit) as exit_info:
+                fanout.main(targets, parallel, self.env)
+        return exit_info.exception.code, stdout.getvalue(), stderr.getvalue()
+
+    def max_parallel(self, jumphost=None):
+        # Highest number of connections running at the same time (through jumphost)
+        events = []
+        with open(self.log) as f:
+            for line in f:
+                event, timestamp, host, jump = line.split()
+                if jumphost is None or jump == jumphost:
+                    events.append((float(timestamp), 1 if event == 'start' else -1))
+        running = 0
+        highest = 0
+        # Ends before starts at the same time
+        for timestamp, change in sorted(events):
+            running += change
+            highest = max(highest, running)
+        return highest
+
+    def test_limits(self):
+        fanout.MAX_PER_JUMPHOST = 2
+        targets = []
+        for i in range(12):
+            host = 'host' + str(i)
+            jumphosts = ['jump1'] if i < 8 else []
+            command = ['ssh'] + (['-J', 'jump1'] if i < 8 else []) + [host, 'sleep 0.2']
+            targets.append((host, jumphosts, command))
+        code, stdout, stderr = self.run_fanout(targets, 4)
+        self.assertEqual(code, 0)
+        self.assertLessEqual(self.max_parallel(), 4)
+        self.assertGreater(self.max_parallel(), 2)
+        self.assertEqual(self.max_parallel('jump1'), 2)
+
+    def test_output_and_summary(self):
+        targets = [
+            ('web1', [], ['ssh', 'web1', 'echo out-web1; echo err-web1 >&2']),
+            ('db', [], ['ssh', 'db', 'echo out-db; exit 3']),
+        ]
+        code, stdout, stderr = self.run_fanout(targets, 4)
+        self.assertEqual(code, 1)
+        self.assertIn('web1 | out-web1\n', stdout)
+        self.assertIn('db   | out-db\n', stdout)
+        self.assertEqual(stderr, 'web1 | err-web1\n')
+        summary = stdout.split('\n\n', 1)[1].splitlines()
+        self.assertEqual(summary[0].split(), ['host', 'exit', 'time'])
+        rows = {line.split()[0]: line.split()[1:] for line in summary[1:-1]}
+        self.assertEqual(rows['web1'][0], '0')
+        self.assertEqual(rows['db'][0], '3')
+        self.assertEqual(rows['db'][2], 's')
+        self.assertEqual(summary[-1], '2 hosts, 1 failed')
+
+    def test_long_lines(self):
+        fanout.LINE_LIMIT = 16
+        targets = [('h', [], ['ssh', 'h', 'echo short; printf "%050d\\n" 0; printf x%.0s $(seq 40); echo; echo tail'])]
+        code, stdout, stderr = self.run_fanout(targets, 1)
+        self.assertEqual(code, 0)
+        output = stdout.split('\n\n', 1)[0].splitlines()
+        self.assertEqual(output[0], 'h | short')
+        self.assertEqual(output[-1], 'h | tail')
+        # The long lines may be forwarded in pieces, but nothing is lost
+        self.assertEqual(''.join(line[len('h | '):] for line in output[1:-1]), 50 * '0' + 40 * 'x')
+
+if __name__ == '__main__':
+    unittest.main()